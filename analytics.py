@@ -0,0 +1,359 @@
+from flask.cli import AppGroup
+from models import db, Story, StoryStep, Choice, StoryNode, StoryTreeStats, StepPicks, word_count
+from datetime import datetime
+from time import sleep
+import click
+import csv
+
+def record_story(story, choice_id=None, tokens=0):
+    """
+    Add a new story to its tree's aggregates.
+
+    A story without a choice starts a tree of its own. A continuation joins the tree of the story
+    its choice was made in: the new node, the parent's count of continuations, the picked step's
+    count and the tree's aggregates are all updated in place, so the cost doesn't depend on the
+    size of the tree. Continuations of stories written before analytics existed are left to
+    'flask analytics refresh --backfill'. Nothing is committed.
+
+    Args:
+        story (Story): The new story, already flushed.
+        choice_id (int, optional): The ID of the choice that led to the story.
+        tokens (int, optional): The LLM tokens spent writing the story.
+    """
+
+    words = story.word_count
+    ended = 1 if story.end else 0
+
+    if choice_id is None:
+        db.session.add(StoryNode(story_id=story.id, root_id=story.id, depth=0, words=words, tokens=tokens))
+        db.session.add(StoryTreeStats(root_id=story.id, nodes=1, max_depth=0, ended=ended, branching=0,
+                                      words=words, tokens=tokens))
+        return
+
+    parent = db.session.execute(
+        db.select(StoryNode.story_id, StoryNode.root_id, StoryNode.depth, Choice.from_step_id)
+        .join(StoryStep, StoryStep.story_id == StoryNode.story_id)
+        .join(Choice, Choice.from_step_id == StoryStep.id)
+        .where(Choice.id == choice_id)
+    ).first()
+
+    if parent is None:
+        return
+
+    depth = parent.depth + 1
+    db.session.add(StoryNode(story_id=story.id, root_id=parent.root_id, depth=depth, words=words, tokens=tokens))
+
+    children = db.session.execute(
+        db.update(StoryNode)
+        .where(StoryNode.story_id == parent.story_id)
+        .values(children=StoryNode.children + 1)
+        .returning(StoryNode.children)
+    ).scalar()
+
+    db.session.execute(
+        db.update(StoryTreeStats)
+        .where(StoryTreeStats.root_id == parent.root_id)
+        .values(nodes=StoryTreeStats.nodes + 1,
+                max_depth=db.case((StoryTreeStats.max_depth < depth, depth), else_=StoryTreeStats.max_depth),
+                ended=StoryTreeStats.ended + ended,
+                branching=StoryTreeStats.branching + (1 if children == 1 else 0),
+                words=StoryTreeStats.words + words,
+                tokens=StoryTreeStats.tokens + tokens,
+                updated_at=datetime.utcnow())
+    )
+
+    picked = db.session.execute(
+        db.update(StepPicks).where(StepPicks.step_id == parent.from_step_id).values(picks=StepPicks.picks + 1)
+    ).rowcount
+    if not picked:
+        db.session.add(StepPicks(step_id=parent.from_step_id, root_id=parent.root_id, picks=1))
+
+def mark_dirty(story_id):
+    """
+    Mark the tree a story belongs to for rebuilding, before the story is edited or deleted.
+
+    Nothing is committed.
+
+    Args:
+        story_id (int): The ID of the story.
+    """
+
+    db.session.execute(
+        db.update(StoryTreeStats)
+        .where(StoryTreeStats.root_id == db.select(StoryNode.root_id).where(StoryNode.story_id == story_id).scalar_subquery())
+        .values(dirty=True)
+    )
+
+def find_root(story_id):
+    """
+    Return the root of the tree a story belongs to, by walking its choices back.
+
+    Args:
+        story_id (int): The ID of the story.
+
+    Returns:
+        int or None: The ID of the root story, or None if the story doesn't exist.
+    """
+
+    chain = Story.chain_cte(story_id)
+
+    return db.session.scalar(
+        db.select(chain.c.story_id).join(Story, Story.id == chain.c.story_id)
+        .order_by(chain.c.depth.desc()).limit(1)
+    )
+
+def rebuild_tree(root_id):
+    """
+    Recompute a tree's nodes, step picks and aggregates from its stories.
+
+    Costs one walk of this tree only, which stops at deleted stories. Nodes that still point at
+    this root but are no longer reached from it, because a story above them was deleted, now
+    belong to trees of their own, which are rebuilt too. Stories whose chain length no longer
+    matches their depth are renumbered. Tokens can't be recomputed and are kept from the
+    existing nodes. Changes are committed.
+
+    Args:
+        root_id (int): The ID of the tree's root story.
+
+    Returns:
+        int: The number of trees rebuilt.
+    """
+
+    tree = (
+        db.select(Story.id.label('story_id'), db.literal(0).label('depth'))
+        .where(Story.id == root_id, Story.deleted_at.is_(None))
+        .cte('tree', recursive=True)
+    )
+    continued = db.aliased(Story)
+    tree = tree.union_all(
+        db.select(Choice.to_story_id, tree.c.depth + 1)
+        .join(StoryStep, StoryStep.story_id == tree.c.story_id)
+        .join(Choice, Choice.from_step_id == StoryStep.id)
+        .join(Story, Story.id == Choice.to_story_id)
+        .where(Story.deleted_at.is_(None))
+    )
+    children = (
+        db.select(db.func.count(Choice.id))
+        .join(StoryStep, StoryStep.id == Choice.from_step_id)
+        .join(continued, continued.id == Choice.to_story_id)
+        .where(StoryStep.story_id == Story.id, continued.deleted_at.is_(None))
+        .scalar_subquery()
+    )
+
+    rows = db.session.execute(
+        db.select(Story.id, Story.start_content, Story.end, Story.chain_length, tree.c.depth, children.label('children'))
+        .join(tree, Story.id == tree.c.story_id)
+    ).all()
+    reached = {row.id for row in rows}
+
+    renumbered = [{'id': row.id, 'chain_length': row.depth + 1} for row in rows if row.chain_length != row.depth + 1]
+    if renumbered:
+        db.session.execute(db.update(Story), renumbered)
+
+    nodes = {node.story_id: node for node in db.session.scalars(
+        db.select(StoryNode).where(db.or_(StoryNode.root_id == root_id,
+                                          StoryNode.story_id.in_(db.select(tree.c.story_id))))
+    )}
+
+    for row in rows:
+        node = nodes.get(row.id)
+        if node is None:
+            node = nodes[row.id] = StoryNode(story_id=row.id, tokens=0)
+            db.session.add(node)
+        node.root_id, node.depth, node.words, node.children = root_id, row.depth, word_count(row.start_content), row.children
+
+    orphans = [id for id in nodes if id not in reached]
+
+    db.session.execute(db.delete(StepPicks).where(db.or_(
+        StepPicks.root_id == root_id,
+        StepPicks.step_id.in_(db.select(StoryStep.id).join(tree, StoryStep.story_id == tree.c.story_id)),
+    )))
+    stats = db.session.get(StoryTreeStats, root_id)
+
+    if not rows:
+        if stats is not None:
+            db.session.delete(stats)
+    else:
+        if stats is None:
+            stats = StoryTreeStats(root_id=root_id)
+            db.session.add(stats)
+
+        stats.nodes = len(rows)
+        stats.max_depth = max(row.depth for row in rows)
+        stats.ended = sum(1 for row in rows if row.end)
+        stats.branching = sum(1 for row in rows if row.children)
+        stats.words = sum(nodes[id].words for id in reached)
+        stats.tokens = sum(nodes[id].tokens for id in reached)
+        stats.dirty = False
+        stats.updated_at = datetime.utcnow()
+
+        for step_id, picks in db.session.execute(
+            db.select(Choice.from_step_id, db.func.count())
+            .join(StoryStep, StoryStep.id == Choice.from_step_id)
+            .join(tree, StoryStep.story_id == tree.c.story_id)
+            .join(continued, continued.id == Choice.to_story_id)
+            .where(continued.deleted_at.is_(None))
+            .group_by(Choice.from_step_id)
+        ):
+            db.session.add(StepPicks(step_id=step_id, root_id=root_id, picks=picks))
+
+    db.session.commit()
+
+    roots = {id: find_root(id) for id in orphans}
+    gone = [id for id, root in roots.items() if root is None]
+    if gone:
+        db.session.execute(db.delete(StoryNode).where(StoryNode.story_id.in_(gone)))
+        db.session.commit()
+
+    rebuilt = 1
+    for root in set(roots.values()) - {None, root_id}:
+        rebuilt += rebuild_tree(root)
+
+    return rebuilt
+
+def refresh(limit=100, backfill=False):
+    """
+    Rebuild the trees marked dirty, and optionally the stories no tree accounts for yet.
+
+    Only dirty trees are walked, so a refresh costs as much as the trees that changed. The
+    backfill looks for stories without a node, which needs a scan of all stories; run it once
+    after deploying analytics, or after importing stories.
+
+    Args:
+        limit (int, optional): The most trees of each kind to rebuild.
+        backfill (bool, optional): Whether to add stories without a node.
+
+    Returns:
+        int: The number of trees rebuilt.
+    """
+
+    rebuilt = 0
+
+    for root_id in db.session.scalars(db.select(StoryTreeStats.root_id).where(StoryTreeStats.dirty).limit(limit)).all():
+        rebuilt += rebuild_tree(root_id)
+
+    if backfill:
+        untracked = ~db.exists().where(StoryNode.story_id == Story.id)
+        incoming = db.exists().where(Choice.to_story_id == Story.id)
+
+        for root_id in db.session.scalars(db.select(Story.id).where(untracked, ~incoming).order_by(Story.id).limit(limit)).all():
+            rebuilt += rebuild_tree(root_id)
+
+        for story_id in db.session.scalars(db.select(Story.id).where(untracked).order_by(Story.id).limit(limit)).all():
+            root_id = find_root(story_id)
+            if root_id is not None:
+                rebuilt += rebuild_tree(root_id)
+
+    return rebuilt
+
+def summary():
+    """
+    Summarize every story tree, from the aggregates alone.
+
+    Returns:
+        dict: 'trees', 'nodes', 'words' and 'tokens' totals; 'ended', the share of trees with at
+        least one ending; 'avg_nodes', 'avg_depth' and 'avg_branching' per tree; 'depths', a list
+        of (max depth, trees) pairs; and 'stale', the number of trees waiting to be rebuilt.
+    """
+
+    totals = db.session.execute(
+        db.select(db.func.count(), db.func.sum(StoryTreeStats.nodes), db.func.sum(StoryTreeStats.words),
+                  db.func.sum(StoryTreeStats.tokens), db.func.avg(StoryTreeStats.max_depth),
+                  db.func.sum(db.case((StoryTreeStats.ended > 0, 1), else_=0)),
+                  db.func.avg(db.case((StoryTreeStats.branching > 0, (StoryTreeStats.nodes - 1) * 1.0 / StoryTreeStats.branching))),
+                  db.func.sum(db.case((StoryTreeStats.dirty, 1), else_=0)))
+    ).one()
+    trees, nodes, words, tokens, avg_depth, ended, avg_branching, stale = totals
+
+    depths = db.session.execute(
+        db.select(StoryTreeStats.max_depth, db.func.count())
+        .group_by(StoryTreeStats.max_depth)
+        .order_by(StoryTreeStats.max_depth)
+    ).all()
+
+    return {
+        'trees': trees,
+        'nodes': nodes or 0,
+        'words': words or 0,
+        'tokens': tokens or 0,
+        'ended': (ended or 0) / trees if trees else 0,
+        'avg_nodes': (nodes or 0) / trees if trees else 0,
+        'avg_depth': avg_depth or 0,
+        'avg_branching': avg_branching or 0,
+        'depths': depths,
+        'stale': stale or 0,
+    }
+
+def top_steps(limit=20):
+    """
+    Return the story steps picked most often.
+
+    Args:
+        limit (int, optional): The number of steps to return.
+
+    Returns:
+        list: (StoryStep, picks) rows, most picked first.
+    """
+
+    return db.session.execute(
+        db.select(StoryStep, StepPicks.picks)
+        .join(StepPicks, StepPicks.step_id == StoryStep.id)
+        .order_by(StepPicks.picks.desc())
+        .limit(limit)
+    ).all()
+
+def largest_trees(limit=20):
+    """
+    Return the aggregates of the largest story trees.
+
+    Args:
+        limit (int, optional): The number of trees to return.
+
+    Returns:
+        list: StoryTreeStats, most nodes first.
+    """
+
+    return db.session.scalars(
+        db.select(StoryTreeStats).order_by(StoryTreeStats.nodes.desc()).limit(limit)
+    ).all()
+
+EXPORT_COLUMNS = ('root_id', 'nodes', 'max_depth', 'ended', 'branching', 'words', 'tokens', 'dirty', 'updated_at')
+
+analytics_cli = AppGroup('analytics', help="Maintain and export story-tree analytics.")
+
+@analytics_cli.command('refresh')
+@click.option('--backfill', is_flag=True, help="Also add stories no tree accounts for yet.")
+@click.option('--limit', default=100, help="Most trees of each kind to rebuild per pass.")
+@click.option('--watch', is_flag=True, help="Keep running, rebuilding every interval.")
+@click.option('--interval', default=60, help="Seconds between passes with --watch.")
+def refresh_command(backfill, limit, watch, interval):
+    """
+    Rebuild the aggregates of trees with edited or deleted stories.
+    """
+
+    while True:
+        rebuilt = refresh(limit, backfill)
+        click.echo(f"{rebuilt} trees rebuilt.")
+
+        if not watch:
+            break
+        sleep(interval)
+
+@analytics_cli.command('export')
+@click.argument('path', default='-')
+def export_command(path):
+    """
+    Write every tree's aggregates as CSV, to PATH or standard output.
+    """
+
+    with click.open_file(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(EXPORT_COLUMNS)
+
+        rows = db.session.execute(
+            db.select(*[getattr(StoryTreeStats, column) for column in EXPORT_COLUMNS])
+            .order_by(StoryTreeStats.root_id)
+            .execution_options(yield_per=1000)
+        )
+        for row in rows:
+            writer.writerow(row)
@@ -0,0 +1,375 @@
+from flask import Blueprint, request, current_app, abort
+from flask_login import login_required, current_user
+from models import db, Story, StoryStep, Choice, Character, GenerationRequest
+from replicas import read_only
+from functools import wraps
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+import json
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+STORY_FIELDS = ['id', 'title', 'start_content', 'created_at', 'updated_at', 'accessed_at', 'img_url', 'end', 'author_id',
+                'excerpt', 'word_count', 'chain_length']
+STORY_LIST_FIELDS = ['id', 'title', 'created_at', 'img_url', 'end', 'word_count', 'chain_length']
+STEP_FIELDS = ['id', 'content', 'created_at', 'story_id']
+CHOICE_FIELDS = ['id', 'choice_text', 'created_at', 'from_step_id', 'to_story_id']
+CHARACTER_FIELDS = ['id', 'name', 'description', 'img_url', 'created_at', 'user_id']
+CHARACTER_LIST_FIELDS = ['id', 'name', 'img_url']
+GENERATION_FIELDS = ['id', 'key', 'status', 'created_at', 'finished_at', 'story_id']
+
+def api_confirmed_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        """
+        API counterpart of `email_confirmed_required`.
+
+        Returns a 403 JSON error instead of redirecting when the user's email is not confirmed.
+        """
+
+        if not current_user.email_confirmed:
+            return error(403, "Please confirm your email address.")
+
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def json_response(data, status=200):
+    """
+    Serialize data compactly and attach a strong ETag, answering matching conditional requests with 304.
+
+    Args:
+        data (dict): The response body.
+        status (int, optional): The HTTP status code. Defaults to 200.
+
+    Returns:
+        Response: The JSON response.
+    """
+
+    body = json.dumps(data, separators=(',', ':'), default=_default)
+    response = current_app.response_class(body, status=status, mimetype='application/json')
+
+    if status == 200:
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+
+    return response
+
+def error(status, message):
+    """
+    Build a JSON error response.
+
+    Args:
+        status (int): The HTTP status code.
+        message (str): A human-readable description of the error.
+
+    Returns:
+        Response: The JSON error response.
+    """
+
+    return json_response({'error': message}, status=status)
+
+def requested_fields(allowed, default):
+    """
+    Parse the `fields=` query parameter into a list of column names.
+
+    Args:
+        allowed (list): Field names the resource exposes.
+        default (list): Field names returned when `fields` is not given.
+
+    Returns:
+        list: The requested field names, always including 'id'.
+    """
+
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(error(400, f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}."))
+
+    return ['id'] + [field for field in fields if field != 'id']
+
+def encode_cursor(id):
+    return urlsafe_b64encode(str(id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return int(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(error(400, "Invalid cursor."))
+
+def paginate(model, fields, *criteria):
+    """
+    Select a page of rows, newest first, loading only the requested columns.
+
+    Pagination is keyset-based: the cursor encodes the last id returned, so each page is a single
+    indexed range scan no matter how deep the client pages.
+
+    Args:
+        model (db.Model): The model to query.
+        fields (list): Column names to load.
+        *criteria: Filter expressions, such as the ownership check.
+
+    Returns:
+        dict: The page, with 'data' rows and a 'next' cursor (None on the last page).
+    """
+
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    query = db.select(*[getattr(model, field) for field in fields]).where(*criteria)
+
+    if request.args.get('cursor'):
+        query = query.where(model.id < decode_cursor(request.args['cursor']))
+
+    rows = db.session.execute(query.order_by(model.id.desc()).limit(limit + 1)).mappings().all()
+    next_cursor = encode_cursor(rows[limit - 1]['id']) if len(rows) > limit else None
+
+    return {'data': [dict(row) for row in rows[:limit]], 'next': next_cursor}
+
+def serialize(obj, fields):
+    return {field: getattr(obj, field) for field in fields}
+
+def owned_story_or_error(id):
+    """
+    Fetch a story, applying the same ownership check as `edit_story` and `delete_story`.
+
+    Args:
+        id (int): The story ID.
+
+    Returns:
+        Story: The story, if the current user is its author.
+    """
+
+    story = Story.query.get_or_404(id)
+
+    if not story.is_owned_by(current_user):
+        abort(error(403, "You do not have permission to view this story."))
+
+    return story
+
+@api.errorhandler(401)
+def unauthorized(e):
+    """
+    Answer requests without a logged-in user with a JSON 401.
+
+    `login_required` calls Flask-Login's unauthorized handling, which aborts with 401 since the
+    app has no login view; this keeps API clients from getting an HTML error page.
+    """
+
+    return error(401, "Please log in.")
+
+@api.errorhandler(404)
+def not_found(e):
+    return error(404, "Not found.")
+
+@api.route('/stories')
+@read_only
+@login_required
+@api_confirmed_required
+def list_stories():
+    """
+    List the current user's stories, newest first.
+
+    Query parameters:
+        fields (str, optional): Comma-separated story fields. Defaults to the card fields, without 'start_content'.
+        cursor (str, optional): The 'next' cursor of the previous page.
+        limit (int, optional): Page size, up to 100. Defaults to 20.
+
+    Returns:
+        Response: A JSON page of stories.
+    """
+
+    fields = requested_fields(STORY_FIELDS, STORY_LIST_FIELDS)
+
+    return json_response(paginate(Story, fields, Story.author_id == current_user.id))
+
+@api.route('/stories/<int:id>')
+@read_only
+@login_required
+@api_confirmed_required
+def get_story(id):
+    """
+    Return one of the current user's stories.
+
+    Query parameters:
+        fields (str, optional): Comma-separated story fields. Defaults to all fields.
+
+    Returns:
+        Response: The story as JSON.
+    """
+
+    fields = requested_fields(STORY_FIELDS, STORY_FIELDS)
+
+    return json_response({'data': serialize(owned_story_or_error(id), fields)})
+
+@api.route('/stories/<int:id>/chain')
+@read_only
+@login_required
+@api_confirmed_required
+def story_chain(id):
+    """
+    Return the chain of stories leading to a story, root first, as `read_story` shows it.
+
+    Query parameters:
+        fields (str, optional): Comma-separated story fields. Defaults to all fields.
+
+    Returns:
+        Response: The chain as JSON.
+    """
+
+    fields = requested_fields(STORY_FIELDS, STORY_FIELDS)
+    story = owned_story_or_error(id)
+
+    return json_response({'data': [serialize(node, fields) for node in Story.get_story_chain(story.id)]})
+
+@api.route('/stories/<int:id>/steps')
+@read_only
+@login_required
+@api_confirmed_required
+def list_steps(id):
+    """
+    Return the steps offered at the end of a story.
+
+    Query parameters:
+        fields (str, optional): Comma-separated step fields. Defaults to all fields.
+
+    Returns:
+        Response: The steps as JSON.
+    """
+
+    fields = requested_fields(STEP_FIELDS, STEP_FIELDS)
+    story = owned_story_or_error(id)
+    rows = db.session.execute(
+        db.select(*[getattr(StoryStep, field) for field in fields]).filter_by(story_id=story.id).order_by(StoryStep.id)
+    ).mappings()
+
+    return json_response({'data': [dict(row) for row in rows]})
+
+@api.route('/steps/<int:id>/choices')
+@read_only
+@login_required
+@api_confirmed_required
+def list_choices(id):
+    """
+    Return the choices made from a step, each pointing at the story it led to.
+
+    Query parameters:
+        fields (str, optional): Comma-separated choice fields. Defaults to all fields.
+
+    Returns:
+        Response: The choices as JSON.
+    """
+
+    fields = requested_fields(CHOICE_FIELDS, CHOICE_FIELDS)
+    step = StoryStep.query.get_or_404(id)
+    owned_story_or_error(step.story_id)
+    rows = db.session.execute(
+        db.select(*[getattr(Choice, field) for field in fields]).filter_by(from_step_id=step.id).order_by(Choice.id)
+    ).mappings()
+
+    return json_response({'data': [dict(row) for row in rows]})
+
+@api.route('/characters')
+@read_only
+@login_required
+@api_confirmed_required
+def list_characters():
+    """
+    List the current user's characters, newest first.
+
+    Query parameters:
+        fields (str, optional): Comma-separated character fields. Defaults to id, name and image.
+        cursor (str, optional): The 'next' cursor of the previous page.
+        limit (int, optional): Page size, up to 100. Defaults to 20.
+
+    Returns:
+        Response: A JSON page of characters.
+    """
+
+    fields = requested_fields(CHARACTER_FIELDS, CHARACTER_LIST_FIELDS)
+
+    return json_response(paginate(Character, fields, Character.user_id == current_user.id))
+
+@api.route('/characters/<int:id>')
+@read_only
+@login_required
+@api_confirmed_required
+def get_character(id):
+    """
+    Return one of the current user's characters.
+
+    Query parameters:
+        fields (str, optional): Comma-separated character fields. Defaults to all fields.
+
+    Returns:
+        Response: The character as JSON.
+    """
+
+    fields = requested_fields(CHARACTER_FIELDS, CHARACTER_FIELDS)
+    character = Character.query.get_or_404(id)
+
+    if character.user_id != current_user.id:
+        return error(403, "You do not have permission to view this character.")
+
+    return json_response({'data': serialize(character, fields)})
+
+@api.route('/generations')
+@read_only
+@login_required
+@api_confirmed_required
+def list_generations():
+    """
+    List the current user's story generations and continuations, newest first.
+
+    A client that posted a generation form with an idempotency key can poll for its outcome with
+    `key=generate:<key>` or `key=continue:<key>`.
+
+    Query parameters:
+        key (str, optional): Only the generation with this key.
+        fields (str, optional): Comma-separated generation fields. Defaults to all fields.
+        cursor (str, optional): The 'next' cursor of the previous page.
+        limit (int, optional): Page size, up to 100. Defaults to 20.
+
+    Returns:
+        Response: A JSON page of generations.
+    """
+
+    fields = requested_fields(GENERATION_FIELDS, GENERATION_FIELDS)
+    criteria = [GenerationRequest.user_id == current_user.id]
+
+    if request.args.get('key'):
+        criteria.append(GenerationRequest.key == request.args['key'])
+
+    return json_response(paginate(GenerationRequest, fields, *criteria))
+
+@api.route('/generations/<int:id>')
+@read_only
+@login_required
+@api_confirmed_required
+def get_generation(id):
+    """
+    Return one of the current user's generations: 'pending', 'done' with its story, or 'failed'.
+
+    Query parameters:
+        fields (str, optional): Comma-separated generation fields. Defaults to all fields.
+
+    Returns:
+        Response: The generation as JSON.
+    """
+
+    fields = requested_fields(GENERATION_FIELDS, GENERATION_FIELDS)
+    generation = GenerationRequest.query.get_or_404(id)
+
+    if generation.user_id != current_user.id:
+        return error(403, "You do not have permission to view this generation.")
+
+    return json_response({'data': serialize(generation, fields)})
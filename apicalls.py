@@ -1,19 +1,456 @@
-from models import db, Genre, Character, Story, StoryStep, Choice, StoryCharacters
+from models import db, Genre, Character, Story, StoryStep, Choice, StoryCharacters, StoryOpening
+from flask import current_app
 from flask_login import current_user
-import openai   
-import os
+from metrics import llm_timer, LLM_PARSE_FAILURES, LLM_REPAIRS
+from llmrouter import chat, chat_async, used_tokens
+from analytics import record_story
+import copy
+import json
+import re
+
+STORY_FUNCTIONS = {
+    'opening': {
+        "name": "write_story",
+        "description": "Write the opening of a choose your own adventure story.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string", "description": "A short title."},
+                "start_content": {"type": "string", "description": "The 400-500 word story."},
+                "choices": {"type": "array", "items": {"type": "string"},
+                            "description": "{count} short choices for what the reader does next."}
+            },
+            "required": ["title", "start_content", "choices"]
+        }
+    },
+    'continuation': {
+        "name": "continue_story",
+        "description": "Write the next part of a choose your own adventure story.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "start_content": {"type": "string", "description": "The 400-500 word continuation."},
+                "end": {"type": "boolean", "description": "True only if the story ends here."},
+                "choices": {"type": "array", "items": {"type": "string"},
+                            "description": "{count} short choices for what the reader does next; empty if the story ends."}
+            },
+            "required": ["start_content", "end", "choices"]
+        }
+    }
+}
+
+REPAIR_PROMPTS = {
+    'title': "a short title for the story",
+    'choices': "{count} short choice(s) for what the reader does next, different from any already given: {existing}",
+}
+
+REPAIR_PROPERTIES = {
+    'title': {"type": "string"},
+    'choices': {"type": "array", "items": {"type": "string"}},
+}
+
+class MalformedCompletion(ValueError):
+    """
+    Raised when a completion can't be turned into a valid story part, even after repair.
+    """
+
+def choice_count():
+    """
+    Return how many choices every story part that doesn't end offers, per 'STORY_CHOICES'.
+
+    Returns:
+        int: The number of choices.
+    """
+
+    return current_app.config.get('STORY_CHOICES', 2)
+
+def story_function(call):
+    """
+    Return the function schema for a kind of story part, asking for `choice_count()` choices.
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
+    Args:
+        call (str): 'opening' or 'continuation'.
+
+    Returns:
+        dict: The function schema.
+    """
+
+    count = choice_count()
+    function = copy.deepcopy(STORY_FUNCTIONS[call])
+    choices = function["parameters"]["properties"]["choices"]
+
+    choices["description"] = choices["description"].format(count=count)
+    choices["maxItems"] = count
+    if call == 'opening':
+        choices["minItems"] = count
+
+    return function
+
+def story_messages(genres, characters):
+    """
+    Build the chat messages asking for a new story.
+
+    Args:
+        genres (list): Genre names.
+        characters (list): (name, description) tuples.
+
+    Returns:
+        list: Chat messages for the completion request.
+    """
+
+    return [
+        {"role": "system", "content": "You are a storyteller, creating a choose your own adventure story, rated no higher than PG-13, with the genres of {} and the characters of {}. Do not end the story; provide {} choices.".format(genres, characters, choice_count())},
+        {"role": "system", "content": f"Return the story by calling write_story with a short title, a 400-500 word start_content and exactly {choice_count()} short choices."},
+        {"role": "system", "content": "After providing choices, stop the story; do not simulate making a choice. Do not use the word 'Choice' or 'Option' in the choices."}
+    ]
+
+def continuation_messages(start_content, choice_text):
+    """
+    Build the chat messages asking to continue a story from a choice.
+
+    Args:
+        start_content (str): The content of the story being continued.
+        choice_text (str): The text of the selected choice.
+
+    Returns:
+        list: Chat messages for the completion request.
+    """
+
+    return [
+        {"role": "system", "content": "You are a storyteller, continuing a choose your own adventure story, rated no higher than PG-13. The story should be long and engaging, not ending after a single branch."},
+        {"role": "user", "content": start_content + " " + choice_text},
+        {"role": "system", "content": f"Return the continuation by calling continue_story with a 400-500 word start_content and exactly {choice_count()} short choices. Only if the story ends, set end to true and give no choices."},
+        {"role": "system", "content": "After providing new choices, stop the story; do not simulate making a choice. Do not repeat anything from prompt. Do not use the word 'Choice' or 'Option' in the choices."}
+    ]
+
+def repair_messages(call, parts, missing):
+    """
+    Build the request for only the missing parts of a story part.
+
+    Args:
+        call (str): 'opening' or 'continuation'.
+        parts (dict): The valid parts received so far, including 'start_content'.
+        missing (list): The names of the missing parts.
+
+    Returns:
+        dict: Keyword arguments for the completion request: messages and a function schema
+        covering only the missing parts.
+    """
+
+    asked = [REPAIR_PROMPTS[field].format(count=choice_count() - len(parts['choices']), existing=parts['choices'])
+             for field in missing]
+    properties = {field: REPAIR_PROPERTIES[field] for field in missing}
+
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a storyteller completing a choose your own adventure story part that is missing some pieces. Provide only the requested pieces; do not rewrite the story."},
+            {"role": "user", "content": parts['start_content']},
+            {"role": "system", "content": "Call complete_story with " + "; and ".join(asked) + "."}
+        ],
+        "functions": [{"name": "complete_story", "parameters": {"type": "object", "properties": properties, "required": missing}}],
+        "function_call": {"name": "complete_story"},
+    }
+
+def parse_tagged(content):
+    """
+    Salvage what can be found in a completion written in the old tagged format.
+
+    Used when the model answers in plain text instead of calling the function. Unlike the old
+    parser it never raises; whatever is absent is simply left out.
+
+    Args:
+        content (str): The completion text, with [title], [start_content], [choice_text] and
+            [end_content] tags.
+
+    Returns:
+        dict: The parts found.
+    """
+
+    end = '[end_content]' in content
+    content = content.replace('[end_content]', '' if '[start_content]' in content else '[start_content]')
+    parts = re.split(r'\[(title|start_content|choice_text)\]', content)
+
+    data = {'choices': [], 'end': end}
+    for tag, text in zip(parts[1::2], parts[2::2]):
+        if tag == 'choice_text':
+            data['choices'].append(text)
+        else:
+            data.setdefault(tag, text)
+
+    if 'start_content' not in data and parts[0].strip():
+        data['start_content'] = parts[0]
+
+    return data
+
+def arguments(response, index=0):
+    """
+    Return the function-call arguments of a completion, falling back to the tagged text format.
+
+    Args:
+        response (dict): The completion response.
+        index (int, optional): Which of the response's candidates to read. Defaults to the first.
+
+    Returns:
+        dict or None: The arguments, or None if there is no function call and no text.
+    """
+
+    message = response['choices'][index]['message']
+    call = message.get('function_call')
+
+    if call:
+        try:
+            data = json.loads(call['arguments'])
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+
+    return parse_tagged(message.get('content') or '') if message.get('content') else None
+
+def validate(call, data):
+    """
+    Check the parts of a story part against its schema.
+
+    Strings must be non-empty. A story part that doesn't end needs `choice_count()` choices; extra
+    choices are dropped. Openings never end.
+
+    Args:
+        call (str): 'opening' or 'continuation'.
+        data (dict): The parts received.
+
+    Returns:
+        tuple: (parts, missing): the valid parts, with 'end' and 'choices' always present, and the
+        names of the missing or invalid ones.
+    """
+
+    parts, missing = {}, []
+
+    for field in ('title', 'start_content') if call == 'opening' else ('start_content',):
+        value = data.get(field)
+        if isinstance(value, str) and value.strip():
+            parts[field] = value.strip()
+        else:
+            missing.append(field)
+
+    choices = data.get('choices') if isinstance(data.get('choices'), list) else []
+    parts['choices'] = [choice.strip() for choice in choices if isinstance(choice, str) and choice.strip()][:choice_count()]
+    parts['end'] = call == 'continuation' and data.get('end') is True
+
+    if parts['end']:
+        parts['choices'] = []
+    elif len(parts['choices']) < choice_count():
+        missing.append('choices')
+
+    return parts, missing
+
+def structured_completion(call, messages, candidates=1):
+    """
+    The steps of getting valid story parts out of the model.
+
+    Each step yields (label, request keyword arguments) and receives the completion response.
+    The first request asks for the whole part through a function call, for `candidates` alternative
+    parts at once through the API's `n` parameter, so the prompt is only paid for once. Every
+    candidate that is valid as received is returned. If none is, the first one is fixed: if the
+    story text itself is unusable, a single part is requested again once, and if only the title
+    or choices are missing, a small repair request asks for just those. Sync and async callers
+    drive the same steps with `complete` and `complete_async`.
+
+    Args:
+        call (str): 'opening' or 'continuation'.
+        messages (list): Chat messages for the first request.
+        candidates (int, optional): How many alternative parts to ask for. Defaults to 1.
+
+    Returns:
+        list: The valid parts, each a dict of 'start_content', 'choices', 'end' and, for
+        openings, 'title'.
+
+    Raises:
+        MalformedCompletion: If no valid part could be obtained.
+    """
+
+    function = story_function(call)
+    request = {"messages": messages, "functions": [function], "function_call": {"name": function["name"]}}
+
+    response = yield call, {**request, "n": candidates} if candidates > 1 else request
+
+    checked = []
+    for index in range(len(response['choices'])):
+        data = arguments(response, index)
+        if data is None:
+            LLM_PARSE_FAILURES.labels(call, 'arguments').inc()
+            data = {}
+
+        parts, missing = validate(call, data)
+        for field in missing:
+            LLM_PARSE_FAILURES.labels(call, field).inc()
+        checked.append((parts, missing))
+
+    valid = [parts for parts, missing in checked if not missing]
+    if valid:
+        return valid
+
+    parts, missing = checked[0]
+
+    if 'start_content' in missing:
+        data = arguments((yield call, request)) or {}
+        parts, missing = validate(call, data)
+        LLM_REPAIRS.labels(call, 'regenerated' if 'start_content' not in missing else 'failed').inc()
+        if 'start_content' in missing:
+            raise MalformedCompletion(f"The {call} completion had no usable story text.")
+
+    if missing:
+        patch = arguments((yield 'repair', repair_messages(call, parts, missing))) or {}
+        if 'choices' in missing and isinstance(patch.get('choices'), list):
+            patch['choices'] = parts['choices'] + patch['choices']
+        parts, missing = validate(call, {**parts, **patch})
+        LLM_REPAIRS.labels(call, 'failed' if missing else 'repaired').inc()
+        if missing:
+            raise MalformedCompletion(f"The {call} completion is missing {', '.join(missing)} after repair.")
+
+    return [parts]
+
+def complete(call, messages, candidates=1):
+    """
+    Get valid story parts from the model, repairing them if needed.
+
+    Each request goes to the model `llmrouter.route` picks for its kind and the user's tier.
+
+    Args:
+        call (str): 'opening' or 'continuation'.
+        messages (list): Chat messages for the request.
+        candidates (int, optional): How many alternative parts to ask for. Defaults to 1.
+
+    Returns:
+        list: The valid parts, as returned by `structured_completion`; at least one, and at
+        most `candidates`. The first also has 'tokens', the tokens all the requests used.
+    """
+
+    steps = structured_completion(call, messages, candidates)
+    label, request = next(steps)
+    tokens = 0
+
+    while True:
+        with llm_timer(label):
+            response = chat(label, request)
+
+        tokens += used_tokens(response)
+
+        try:
+            label, request = steps.send(response)
+        except StopIteration as done:
+            done.value[0]['tokens'] = tokens
+            return done.value
+
+async def complete_async(call, messages, candidates=1):
+    """
+    Async counterpart of `complete`.
+
+    Args:
+        call (str): 'opening' or 'continuation'.
+        messages (list): Chat messages for the request.
+        candidates (int, optional): How many alternative parts to ask for. Defaults to 1.
+
+    Returns:
+        list: The valid parts, as returned by `complete`.
+    """
+
+    steps = structured_completion(call, messages, candidates)
+    label, request = next(steps)
+    tokens = 0
+
+    while True:
+        with llm_timer(label):
+            response = await chat_async(label, request)
+
+        tokens += used_tokens(response)
+
+        try:
+            label, request = steps.send(response)
+        except StopIteration as done:
+            done.value[0]['tokens'] = tokens
+            return done.value
+
+def save_story(title, start_content, choices, author_id, character_ids=(), end=False, alternates=(), genre_ids=(),
+               choice_id=None, tokens=0):
+    """
+    Create a story with its steps and character associations, and add it to the story-tree analytics.
+
+    Everything is committed in one transaction, along with any changes already pending, such as
+    the deletion of the pool opening the story is made from.
+
+    Args:
+        title (str): The story's title.
+        start_content (str): The story's content.
+        choices (list): Choice texts, saved as the story's steps.
+        author_id (int): The ID of the author.
+        character_ids (list, optional): IDs of characters featured in the story.
+        end (bool, optional): Whether the story is an ending.
+        alternates (list, optional): Other candidate openings, as parts dicts, that the author may
+            swap in until they continue the story.
+        genre_ids (list, optional): IDs of the story's genres, recorded with its alternates.
+        choice_id (int, optional): The ID of the choice the story continues from, linked to it in the
+            same transaction. Defaults to a new root story.
+        tokens (int, optional): The LLM tokens spent writing the story, for the analytics.
+
+    Returns:
+        Story: The new story.
+    """
+
+    chain_length = 1
+    if choice_id is not None:
+        # Computed inside the INSERT, from the story the choice was made in.
+        chain_length = db.func.coalesce(
+            db.select(Story.chain_length + 1)
+            .join(StoryStep, StoryStep.story_id == Story.id)
+            .join(Choice, Choice.from_step_id == StoryStep.id)
+            .where(Choice.id == choice_id)
+            .scalar_subquery(), 1)
+
+    # Flushed for its ID but not committed, so the story and everything below commit together.
+    new_story = Story(title=title, start_content=start_content, author_id=author_id, end=end, chain_length=chain_length)
+    db.session.add(new_story)
+    db.session.flush()
+
+    # One multi-row INSERT per table, however many steps, characters and alternates there are.
+    if choices:
+        db.session.execute(db.insert(StoryStep), [{'content': choice, 'story_id': new_story.id} for choice in choices])
+
+    if character_ids:
+        db.session.execute(db.insert(StoryCharacters),
+                           [{'story_id': new_story.id, 'character_id': id} for id in character_ids])
+
+    if alternates:
+        db.session.execute(db.insert(StoryOpening), [
+            {'genre_key': StoryOpening.key_for(genre_ids), 'title': parts['title'], 'start_content': parts['start_content'],
+             'choices': parts['choices'], 'story_id': new_story.id}
+            for parts in alternates
+        ])
+
+    if choice_id is not None:
+        db.session.execute(db.update(Choice).where(Choice.id == choice_id).values(to_story_id=new_story.id))
+
+    record_story(new_story, choice_id, tokens)
+
+    db.session.commit()
+    return new_story
 
 def make_api_request(selected_genres, selected_characters):
     """
     Use OpenAI's GPT-3.5-turbo model to generate a new story based on selected genres and characters.
 
     This function sends a request to the OpenAI API to generate a new story with selected genres and characters.
-    It then splits the received response into parts: title, start_content, and choices. It creates a new story 
+    The model returns the title, start_content, and choices through a function call, which is validated and,
+    if parts are missing, repaired (see `structured_completion`). It creates a new story 
     and related story steps in the database based on these parts. In addition, it creates new story character 
     associations for the selected characters.
 
+    Everything the prompt needs is read first and the session is closed, returning its connection to the
+    pool, before the completion call; the story is saved in a new short transaction afterwards. Pending
+    changes must be committed before calling this, and ORM objects loaded earlier are detached.
+
+    With 'OPENING_CANDIDATES' above 1, that many openings are requested in the same call. The first
+    becomes the story and the others are kept as alternates the user can swap in.
+
     Args:
         selected_genres (list): A list of genre IDs selected for the story.
         selected_characters (list): A list of character IDs selected for the story.
@@ -22,59 +459,53 @@ def make_api_request(selected_genres, selected_characters):
         Story: A new story instance created based on the generated content.
     """
 
-    genre_ids = [Genre.query.get(id) for id in selected_genres]
-    genres = [genre.name for genre in genre_ids]
-    character_ids = [(Character.query.get(id)) for id in selected_characters]
-    characters = [(character.name, character.description) for character in character_ids]
-    
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a storyteller, creating a formatted choose your own adventure story, rated no higher than PG-13, with the genres of {} and the characters of {}. Do not end the story; provide 2 choices.".format(genres, characters)},
-            {"role": "system", "content": "Use these exact tags to separate story parts. [title]generate a short title, [start_content] generate a 400-500 word story, [choice_text] generate first short choice, [choice_text] generate second short choice"},
-            {"role": "system", "content": "After providing choices, stop the story; do not simulate making a choice. Include all tags; do not include extra tags. Do not include choices unless preceeded by [choice_text] tag. Do not use the word 'Choice' or 'Option' in lieu of [choice_text]. All tags lower-case."}
-        ]
-    )
-
-    print(response)
-
-    if response:
-        response_content = response['choices'][0]['message']['content']
-        response_parts = response_content.split('[choice_text]')
+    genres = [genre.name for genre in Genre.query.filter(Genre.id.in_(selected_genres))]
+    characters = [(character.name, character.description)
+                  for character in Character.query.filter(Character.id.in_(selected_characters))]
+    author_id = current_user.id
+    db.session.close()
 
-        title_start_content = response_parts[0].split('[start_content]')
-        title = title_start_content[0].strip().replace('[title]', '').strip()
-        start_content = title_start_content[1].strip()
+    first, *alternates = complete('opening', story_messages(genres, characters), current_app.config.get('OPENING_CANDIDATES', 1))
 
-        choice1 = response_parts[1].strip()
-        choice2 = response_parts[2].strip()
+    return save_story(first['title'], first['start_content'], first['choices'], author_id, selected_characters,
+                      alternates=alternates, genre_ids=selected_genres, tokens=first['tokens'])
 
-        new_story = Story.create_story(title=title, start_content=start_content, author_id=current_user.id)
+async def make_api_request_async(genres, characters):
+    """
+    Async counterpart of `make_api_request`'s completion call.
 
-        step1 = StoryStep(content=choice1, story_id=new_story.id)
-        step2 = StoryStep(content=choice2, story_id=new_story.id)
+    Only the completion request happens here, over OpenAI's aiohttp-based client, so no database
+    session or connection is held while waiting; the caller reads its inputs before and saves the
+    result after.
 
-        db.session.add(step1)
-        db.session.add(step2)
-        db.session.commit()
+    Args:
+        genres (list): Genre names.
+        characters (list): (name, description) tuples.
 
-        for id in selected_characters:
-            new_storycharacters = StoryCharacters(story_id=new_story.id, character_id=id)
+    Returns:
+        tuple: (title, start_content, choices, alternates, tokens), where alternates are the other
+        candidate openings' parts when 'OPENING_CANDIDATES' is above 1, and tokens is what the
+        completion used.
+    """
 
-            db.session.add(new_storycharacters)
-            db.session.commit()
+    first, *alternates = await complete_async('opening', story_messages(genres, characters),
+                                              current_app.config.get('OPENING_CANDIDATES', 1))
 
-    return new_story
+    return first['title'], first['start_content'], first['choices'], alternates, first['tokens']
 
 def next_step(id, new_choice):
     """
     Use OpenAI's GPT-3.5-turbo model to continue an existing story based on a selected choice.
 
     This function sends a request to the OpenAI API to generate the continuation of a story based on the 
-    initial story content and a selected choice. The received response is then used to either end the current 
-    story or create new story steps, based on the received tags in the response. A new story is created in the 
+    initial story content and a selected choice. The validated response is then used to either end the current 
+    story or create new story steps, based on its 'end' flag. A new story is created in the 
     database based on this new content.
 
+    As in `make_api_request`, no database connection is held during the completion call: the story
+    and choice are read first, the session is closed, and the new story is saved afterwards, with
+    the choice linked to it in the same transaction.
+
     Args:
         id (int): The ID of the initial story to be continued.
         new_choice (Choice): The choice instance selected to continue the story.
@@ -85,59 +516,27 @@ def next_step(id, new_choice):
 
     story = Story.query.get_or_404(id)
     choice = Choice.query.get_or_404(new_choice.id)
+    title, messages, author_id = story.title, continuation_messages(story.start_content, choice.choice_text), current_user.id
+    choice_id = choice.id
+    db.session.close()
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a storyteller, continuing a formatted choose your own adventure story, rated no higher than PG-13. The story should be long and engaging, not ending after a single branch."},
-            {"role": "user", "content": story.start_content + " " + choice.choice_text},
-            {"role": "system", "content": "Use these exact tags to separate story parts. [start_content] generate a 400-500 word story, [choice_text] generate first short choice, [choice_text] generate second short choice. Only if the story ends, use [end_content]."},
-            {"role": "system", "content": "After providing new choices, stop the story; do not simulate making a choice. Do not repeat anything from prompt. Include all tags; do not include extra tags. Do not include choices unless preceeded by [choice_text] tag. Do not use the word 'Choice' or 'Option' in lieu of [choice_text]. All tags lower-case."}
-        ]
-    )
-
-    print(response)
-    if response:
-        response_content = response['choices'][0]['message']['content'].replace('[start_content]', '').strip()
-
-        if '[end_content]' in response_content and '[choice_text]' in response_content:
-            response_content = response_content.replace('[end_content]', '').strip()
-            response_parts = response_content.split('[choice_text]')
-        
-            start_content = response_parts[0].strip()
-        
-            choice1 = response_parts[1].strip()
-            choice2 = response_parts[2].strip()
-        
-            new_story = Story.create_story(title=story.title, start_content=start_content, author_id=current_user.id)
-        
-            step1 = StoryStep(content=choice1, story_id=new_story.id)
-            step2 = StoryStep(content=choice2, story_id=new_story.id)
-        
-            db.session.add(step1)
-            db.session.add(step2)
-            db.session.commit()
-
-        elif '[end_content]' in response_content:
-            end_content = response_content.replace('[end_content]', '').strip()
-            new_story = Story.create_story(title=story.title, start_content=end_content, author_id=current_user.id, end=True)
-        
-        else:
-            response_parts = response_content.split('[choice_text]')
+    parts, = complete('continuation', messages)
 
-            start_content = response_parts[0].strip()
+    return save_story(title, parts['start_content'], parts['choices'], author_id, end=parts['end'],
+                      choice_id=choice_id, tokens=parts['tokens'])
 
-            choice1 = response_parts[1].strip()
-            choice2 = response_parts[2].strip()
-
-            new_story = Story.create_story(title=story.title, start_content=start_content, author_id=current_user.id)
+async def next_step_async(start_content, choice_text):
+    """
+    Async counterpart of `next_step`'s completion call.
 
-            step1 = StoryStep(content=choice1, story_id=new_story.id)
-            step2 = StoryStep(content=choice2, story_id=new_story.id)
+    Args:
+        start_content (str): The content of the story being continued.
+        choice_text (str): The text of the selected choice.
 
-            db.session.add(step1)
-            db.session.add(step2)
-            db.session.commit()
+    Returns:
+        tuple: (start_content, choices, end, tokens). An ending has no choices and end is True.
+    """
 
-    return new_story
+    parts, = await complete_async('continuation', continuation_messages(start_content, choice_text))
 
+    return parts['start_content'], parts['choices'], parts['end'], parts['tokens']
@@ -1,43 +1,171 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, session
+from flask import Flask, render_template, redirect, url_for, request, flash, session, make_response, current_app, abort, stream_template, Response, stream_with_context
 from flask_login import LoginManager, login_required, current_user, logout_user, login_user
-from models import db, connect_db, User, Story, StoryStep, Choice, Genre, Character, UserGenre
+from models import db, connect_db, User, Story, StoryStep, Choice, Genre, Character, UserGenre, StoryOpening
 from forms import AddUserForm, LoginForm, EditUserForm, GenreForm, CharacterForm, EditStoryForm, ResetPasswordForm
-from flask_mail import Mail, Message
-from utils import email_confirmed_required, send_confirmation_email, confirm_token, send_reset_email
+from utils import email_confirmed_required, admin_required, send_confirmation_email, confirm_token, send_reset_email
 
 from apicalls import make_api_request, next_step
+from api import api
+from analytics import analytics_cli, mark_dirty, summary, top_steps, largest_trees
+from deletion import deletion_cli, mark_story_deleted, mark_user_deleted
+from compression import compression_cli, decode_timing
+from contentencoding import encoding_cli, init_content_encoding
+from export import export_cli
+from library import library_cli, export_lines, gzip_chunks
+from previews import previews_cli
+from llmrouter import llm_cli
+from images import images_cli, init_images
+from media import media_cli, init_media, ingest_image, ImageRejected
+from openings import openings_cli, claim_opening, release_alternates, swap_alternate
+from extensions import get_mail, LazyMigrateGroup
+from metrics import init_metrics
+from querybudget import query_budget
+from replicas import read_only, replica_binds
+from singleflight import single_flight, generation_key, new_idempotency_key, GenerationFailed
+from scheduler import admit, QuotaExceeded, queued_response
+from slowquery import init_slow_query_log, summarize, recent_entries
+from pagecache import get_cached_chain, store_chain, invalidate_story, user_etag
 from sqlalchemy import func
+from sqlalchemy.orm import load_only
 from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+from markupsafe import Markup
 from datetime import datetime
 from time import time
-from flask_migrate import Migrate
+import json
 import os
-import openai
 
-app = Flask (__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = (os.environ.get("DATABASE_URL", "postgresql:///ai_venture"))
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
+login_manager = LoginManager()
+
+routes = []
 
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")
-app.config['MAIL_DEFAULT_SENDER'] = os.getenv("MAIL_USERNAME")
-app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")
-app.config['SECURITY_PASSWORD_SALT'] = os.getenv("SECURITY_PASSWORD_SALT")
+def route(rule, **options):
+    """
+    Record a view to be registered on the app by `create_app`.
 
-mail = Mail(app)
+    Works like `app.route`, for views defined before any app exists.
 
-login_manager = LoginManager()
-login_manager.init_app(app)
+    Args:
+        rule (str): The URL rule.
+        **options: Options passed to `app.add_url_rule`, such as 'methods'.
+
+    Returns:
+        function: The decorator.
+    """
+
+    def decorator(f):
+        routes.append((rule, f, options))
+        return f
+
+    return decorator
+
+def create_app(config=None):
+    """
+    Create and configure the application.
+
+    Configuration is read from the environment, then overridden by `config`. Only the pieces
+    every request needs (the database, logins, routes, metrics) are set up here. Mail, the OpenAI client
+    and Flask-Migrate are imported and initialized the first time they are used, so CLI commands,
+    seed.py and tests don't pay for them.
+
+    Args:
+        config (dict, optional): Configuration values overriding the defaults.
 
-migrate = Migrate(app, db)
+    Returns:
+        Flask: The application.
+    """
 
-connect_db(app)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = (os.environ.get("DATABASE_URL", "postgresql:///ai_venture"))
+    app.config["SQLALCHEMY_BINDS"] = replica_binds([url for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url])
+    app.config["DB_REPLICA_MAX_LAG"] = float(os.getenv("DB_REPLICA_MAX_LAG", "2"))
+    app.config["DB_STICKY_SECONDS"] = float(os.getenv("DB_STICKY_SECONDS", "5"))
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ECHO"] = os.getenv("SQLALCHEMY_ECHO", "").lower() in ("1", "true", "yes")
+    app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
+    app.config["STORY_COMPRESSION"] = os.getenv("STORY_COMPRESSION", "").lower() in ("1", "true", "yes")
+    app.config["STORY_ZSTD_DICT_DIR"] = os.getenv("STORY_ZSTD_DICT_DIR")
+    app.config["RESPONSE_COMPRESSION"] = os.getenv("RESPONSE_COMPRESSION", "true").lower() in ("1", "true", "yes")
+    app.config["RESPONSE_COMPRESSION_MIN_BYTES"] = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+    app.config["RESPONSE_GZIP_LEVEL"] = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+    app.config["RESPONSE_BROTLI_QUALITY"] = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
+    app.config["READ_CACHE_DIR"] = os.getenv("READ_CACHE_DIR")
+    app.config["READ_CHAPTERS_PER_PAGE"] = int(os.getenv("READ_CHAPTERS_PER_PAGE", "10"))
+    app.config["EXPORT_DIR"] = os.getenv("EXPORT_DIR")
+    app.config["IMAGE_BUILD_DIR"] = os.getenv("IMAGE_BUILD_DIR")
+    app.config["IMAGE_STORE_DIR"] = os.getenv("IMAGE_STORE_DIR")
+    app.config["IMAGE_MAX_BYTES"] = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+    app.config["IMAGE_FETCH_TIMEOUT"] = float(os.getenv("IMAGE_FETCH_TIMEOUT", "10"))
+    app.config["IMAGE_FETCH_ALLOW_PRIVATE"] = os.getenv("IMAGE_FETCH_ALLOW_PRIVATE", "").lower() in ("1", "true", "yes")
+    app.config["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+    app.config["LLM_BACKEND"] = os.getenv("LLM_BACKEND", "openai")
+    app.config["LLM_ROUTES"] = json.loads(os.getenv("LLM_ROUTES", "{}"))
+    app.config["LLM_USER_TIERS"] = json.loads(os.getenv("LLM_USER_TIERS", "{}"))
+    app.config["LLM_PRICES"] = json.loads(os.getenv("LLM_PRICES", "{}"))
+    app.config["LLM_HEDGE"] = os.getenv("LLM_HEDGE", "").lower() in ("1", "true", "yes")
+    app.config["LLM_HEDGE_MODELS"] = json.loads(os.getenv("LLM_HEDGE_MODELS", "{}"))
+    app.config["LLM_SCHEDULER"] = os.getenv("LLM_SCHEDULER", "true").lower() in ("1", "true", "yes")
+    app.config["LLM_MAX_CONCURRENCY"] = int(os.getenv("LLM_MAX_CONCURRENCY", "20"))
+    app.config["LLM_USER_RPM"] = float(os.getenv("LLM_USER_RPM", "6"))
+    app.config["LLM_USER_TPM"] = float(os.getenv("LLM_USER_TPM", "20000"))
+    app.config["LLM_TIER_WEIGHTS"] = json.loads(os.getenv("LLM_TIER_WEIGHTS", "{}"))
+    app.config["LLM_QUEUE_MAX_WAIT"] = float(os.getenv("LLM_QUEUE_MAX_WAIT", "30"))
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
+    app.config["DELETION_BATCH"] = int(os.getenv("DELETION_BATCH", "500"))
+    app.config["LIBRARY_BATCH"] = int(os.getenv("LIBRARY_BATCH", "1000"))
+    app.config["OPENING_POOL_SIZE"] = int(os.getenv("OPENING_POOL_SIZE", "50"))
+    app.config["OPENING_POOL_COMBINATIONS"] = int(os.getenv("OPENING_POOL_COMBINATIONS", "10"))
+    app.config["OPENING_REFILL_BATCH"] = int(os.getenv("OPENING_REFILL_BATCH", "5"))
+    app.config["OPENING_CANDIDATES"] = int(os.getenv("OPENING_CANDIDATES", "1"))
+    app.config["STORY_CHOICES"] = int(os.getenv("STORY_CHOICES", "2"))
+    app.config["GENERATION_WAIT_SECONDS"] = float(os.getenv("GENERATION_WAIT_SECONDS", "90"))
+    app.config["GENERATION_STALE_SECONDS"] = float(os.getenv("GENERATION_STALE_SECONDS", "300"))
+    app.config["ADMIN_USERNAMES"] = [name for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name]
+    app.config["SLOW_QUERY_MS"] = os.getenv("SLOW_QUERY_MS")
+    app.config["SLOW_QUERY_LOG"] = os.getenv("SLOW_QUERY_LOG")
+    app.config["SLOW_QUERY_EXPLAIN_RATE"] = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.1"))
+
+    app.config['MAIL_SERVER'] = 'smtp.gmail.com'
+    app.config['MAIL_PORT'] = 587
+    app.config['MAIL_USE_TLS'] = True
+    app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")
+    app.config['MAIL_DEFAULT_SENDER'] = os.getenv("MAIL_USERNAME")
+    app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")
+    app.config['SECURITY_PASSWORD_SALT'] = os.getenv("SECURITY_PASSWORD_SALT")
+
+    if config:
+        app.config.from_mapping(config)
+
+    login_manager.init_app(app)
+
+    connect_db(app)
+    init_metrics(app)
+    init_slow_query_log(app)
+    init_images(app)
+    init_media(app)
+    init_content_encoding(app)
+
+    app.jinja_env.globals['idempotency_key'] = new_idempotency_key
+    app.register_error_handler(Exception, handle_exception)
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+
+    app.register_blueprint(api)
+    app.cli.add_command(LazyMigrateGroup(app, db))
+    app.cli.add_command(compression_cli)
+    app.cli.add_command(encoding_cli)
+    app.cli.add_command(export_cli)
+    app.cli.add_command(llm_cli)
+    app.cli.add_command(openings_cli)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(media_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(deletion_cli)
+    app.cli.add_command(library_cli)
+    app.cli.add_command(previews_cli)
+
+    return app
 
-@app.errorhandler(Exception)
 def handle_exception(e):
     """
     Handle general exceptions.
@@ -58,7 +186,8 @@ def handle_exception(e):
     
     return redirect(url_for('unhandled_exception'))
 
-@app.route('/oops')
+@route('/oops')
+@query_budget(0)
 def unhandled_exception():
     """
     Handle unhandled exceptions.
@@ -90,7 +219,9 @@ def load_user(user_id):
 
     return User.query.get(int(user_id))
 
-@app.route('/', methods=["GET", "POST"])
+@route('/', methods=["GET", "POST"])
+@query_budget(5)
+@read_only
 def homepage():
     """
     Render the homepage.
@@ -117,7 +248,8 @@ def homepage():
     else:
         return render_template('home-anon.html')
 
-@app.route('/user/signup', methods=["GET", "POST"])
+@route('/user/signup', methods=["GET", "POST"])
+@query_budget(4)
 def signup():
     """
     Handle the user sign-up process.
@@ -140,11 +272,12 @@ def signup():
 
     if request.method == "POST" and form.validate_on_submit():
         user_data = {field.name: getattr(form, field.name).data for field in form}
+        user_data['image_url'] = ingest_image(user_data.get('image_url'))
         new_user = User.signup(user_data)
 
         db.session.commit()
         login_user(new_user)
-        send_confirmation_email(mail, app, new_user.email)       
+        send_confirmation_email(get_mail(), current_app, new_user.email)       
         flash("Confirmation email sent.", "info")
 
         return redirect(url_for('thanks'))
@@ -152,7 +285,8 @@ def signup():
 
     return render_template('/users/signup.html', form=form)
 
-@app.route('/user/login', methods=["GET", "POST"])
+@route('/user/login', methods=["GET", "POST"])
+@query_budget(1)
 def login():
     """
     Manage the user login process.
@@ -193,7 +327,8 @@ def login():
 
     return render_template('/users/login.html', form=form)
 
-@app.route('/user/confirm', methods=["GET", "POST"])
+@route('/user/confirm', methods=["GET", "POST"])
+@query_budget(0)
 @login_required
 def unconfirmed():
     """
@@ -229,14 +364,15 @@ def unconfirmed():
                 flash('Please check your spam folder, or wait 5 minutes to try again.', 'danger')
                 return render_template('unconfirmed.html')
             
-        send_confirmation_email(mail, app, current_user.email)
+        send_confirmation_email(get_mail(), current_app, current_user.email)
         flash("Confirmation email sent.", "info")
         session[key] = time()
         return redirect(url_for('thanks'))
 
     return render_template('unconfirmed.html')
 
-@app.route('/user/confirm/<token>', methods=["GET", "POST"])
+@route('/user/confirm/<token>', methods=["GET", "POST"])
+@query_budget(2)
 def confirm_email(token):
     """
     Validate the user's email confirmation token.
@@ -261,7 +397,7 @@ def confirm_email(token):
     """
 
     try:
-        email = confirm_token(app, token)
+        email = confirm_token(current_app, token)
 
     except:
         flash('The confirmation link is invalid or has expired.', 'danger')
@@ -284,7 +420,8 @@ def confirm_email(token):
 
     return redirect(url_for('homepage'))
 
-@app.route('/user/info')
+@route('/user/info')
+@query_budget(0)
 def thanks():
     """
     Render a 'Thank You' page.
@@ -300,7 +437,8 @@ def thanks():
 
     return render_template('thanks.html', source=source)
 
-@app.route('/user/logout')
+@route('/user/logout')
+@query_budget(0)
 @login_required
 def logout():
     """
@@ -318,7 +456,8 @@ def logout():
 
     return redirect(url_for('homepage'))
 
-@app.route('/user/password', methods=["GET", "POST"])
+@route('/user/password', methods=["GET", "POST"])
+@query_budget(1)
 def password_email():
     """
     Handle user password reset request via email.
@@ -355,7 +494,7 @@ def password_email():
 
         if User.query.filter_by(email=email).first():
 
-            send_reset_email(mail, app, email)
+            send_reset_email(get_mail(), current_app, email)
             flash("Reset email sent.", "info")
             session[key] = time()
             
@@ -367,7 +506,8 @@ def password_email():
 
     return render_template('/users/forgot.html', form=form)
 
-@app.route('/user/password/<token>', methods=["GET", "POST"])
+@route('/user/password/<token>', methods=["GET", "POST"])
+@query_budget(3)
 def password_reset(token):
     """
     Handle user password reset via confirmation token.
@@ -394,7 +534,7 @@ def password_reset(token):
     """
 
     try:
-        email = confirm_token(app, token)
+        email = confirm_token(current_app, token)
 
     except:
         flash('The reset link is invalid or has expired.', 'danger')
@@ -420,7 +560,9 @@ def password_reset(token):
             
     return render_template('/users/reset.html', form=form)
 
-@app.route('/user/<int:id>')
+@route('/user/<int:id>')
+@query_budget(2)
+@read_only
 @login_required
 @email_confirmed_required
 def show_user(id):
@@ -429,7 +571,7 @@ def show_user(id):
 
     This function handles GET requests to the '/user/<int:id>' route. It retrieves the user's 
     profile details, their most recent story, and the steps associated with that story, 
-    then displays this information. Note that this route requires the user to be logged in,
+    then displays this information, along with any alternate openings the user can swap in. Note that this route requires the user to be logged in,
     as enforced by the '@login_required' decorator.
 
     Parameters:
@@ -438,7 +580,7 @@ def show_user(id):
     Returns:
         Rendered template or Werkzeug Response: If the user trying to access the page is the same 
         user as the profile being viewed, it returns the 'users/detail.html' template with 
-        the user, story and steps as context variables. 
+        the user, story, steps and alternates as context variables. 
         If the user trying to access the page is not the same user as the profile being viewed, 
         it redirects the user to the homepage with a failure message.
     """
@@ -453,17 +595,19 @@ def show_user(id):
         )
 
     if story is not None:
-        steps = StoryStep.query.filter_by(story_id=story.id).all()
+        steps = StoryStep.query.filter_by(story_id=story.id).order_by(StoryStep.id).all()
+        alternates = story.alternates if not story.end else []
     else:
-        steps = []
+        steps = alternates = []
 
     if current_user.id != id:
         flash("You do not have permission to view this page.", "danger")
         return redirect(url_for('homepage'))
 
-    return render_template('/users/detail.html', user=user, story=story, steps=steps)
+    return render_template('/users/detail.html', user=user, story=story, steps=steps, alternates=alternates)
 
-@app.route('/user/edit', methods=["GET", "POST"])
+@route('/user/edit', methods=["GET", "POST"])
+@query_budget(5)
 @login_required
 @email_confirmed_required
 def edit_user():
@@ -474,7 +618,8 @@ def edit_user():
     For a GET request, it displays a form populated with the current user's details. 
     For a POST request, it validates the form, checks the user's password for security reasons,
     and either updates the user's details or deletes the user, depending on which submit 
-    button was clicked. Note that this route requires the user to be logged in,
+    button was clicked. A deleted user and their stories are hidden immediately and removed in
+    the background by 'flask deletion reap'. Note that this route requires the user to be logged in,
     as enforced by the '@login_required' decorator.
 
     Returns:
@@ -485,7 +630,7 @@ def edit_user():
     """
 
     user = User.query.filter_by(id=current_user.id).first()
-    form = EditUserForm(request.form, obj=user)
+    form = EditUserForm(obj=user)
 
     if request.method == "POST" and form.validate_on_submit():
 
@@ -496,16 +641,22 @@ def edit_user():
             if request.form['submit-btn'] == 'delete':
 
                 logout_user()
-                db.session.delete(user)
-                db.session.commit()
+                mark_user_deleted(user)
 
                 return redirect(url_for('homepage'))
             
             if request.form['submit-btn'] == 'update':
 
-                user_data = {field.name: field.data for field in form if field.name not in ['username', 'password']}
+                try:
+                    image_url = ingest_image(form.image_url.data, form.image_file.data)
+                except ImageRejected as e:
+                    form.image_file.errors.append(str(e))
+                    return render_template('/users/edit.html', form=form)
+
+                user_data = {field.name: field.data for field in form if field.name not in ['username', 'password', 'image_file']}
                 for field, value in user_data.items():
                     setattr(user, field, value)
+                user.image_url = image_url
                 db.session.commit()  
 
                 flash("Profile updated!", "info") 
@@ -513,7 +664,28 @@ def edit_user():
     
     return render_template('/users/edit.html', form=form)
 
-@app.route('/character/add', methods=["GET", "POST"])
+@route('/user/library.jsonl.gz')
+@query_budget(0)
+@read_only
+@login_required
+@email_confirmed_required
+def export_library():
+    """
+    Download the current user's stories and characters as gzip-compressed JSON lines.
+
+    The export is compressed and sent as it is read from the database (see 'library.py'), in a
+    chunked response, so neither the server's memory nor the time to the first byte grows with
+    the size of the library. It can be added to an account with 'flask library import'.
+
+    Returns:
+        Werkzeug Response: The streamed export, as an attachment.
+    """
+
+    return Response(stream_with_context(gzip_chunks(export_lines(current_user))), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename="library-{current_user.username}.jsonl.gz"'})
+
+@route('/character/add', methods=["GET", "POST"])
+@query_budget(2)
 @login_required
 @email_confirmed_required
 def add_character():
@@ -537,6 +709,13 @@ def add_character():
     if request.method == "POST" and form.validate_on_submit():
          
         character_data = {field.name: getattr(form, field.name).data for field in form}
+
+        try:
+            character_data['image_url'] = ingest_image(form.img_url.data, form.img_file.data)
+        except ImageRejected as e:
+            form.img_file.errors.append(str(e))
+            return render_template('/characters/add.html', form=form)
+
         character = Character.create_character(character_data, current_user.id)
 
         db.session.commit()
@@ -545,7 +724,9 @@ def add_character():
 
     return render_template('/characters/add.html', form=form)
 
-@app.route('/character/index', methods=["GET", "POST"])
+@route('/character/index', methods=["GET", "POST"])
+@query_budget(2)
+@read_only
 @login_required
 @email_confirmed_required
 def show_characters():
@@ -568,7 +749,8 @@ def show_characters():
 
     return render_template('/characters/index.html', characters=characters, form=form)
 
-@app.route('/character/edit/<int:id>', methods=["GET", "POST"])
+@route('/character/edit/<int:id>', methods=["GET", "POST"])
+@query_budget(3)
 @login_required
 @email_confirmed_required
 def edit_character(id):
@@ -596,8 +778,15 @@ def edit_character(id):
 
     if character and character.user_id == current_user.id:
         if request.method == "POST" and form.validate_on_submit():
-        
+
+            try:
+                img_url = ingest_image(form.img_url.data, form.img_file.data)
+            except ImageRejected as e:
+                form.img_file.errors.append(str(e))
+                return render_template('/characters/edit.html', form=form)
+
             form.populate_obj(character)
+            character.img_url = img_url
 
             db.session.commit()
             flash("Character updated!", "info")
@@ -610,7 +799,8 @@ def edit_character(id):
     
     return render_template('/characters/edit.html', form=form)
 
-@app.route('/character/delete/<int:id>', methods=["POST"])
+@route('/character/delete/<int:id>', methods=["POST"])
+@query_budget(2)
 @login_required
 @email_confirmed_required
 def delete_character(id):
@@ -645,7 +835,9 @@ def delete_character(id):
         flash("You do not have permission to view this page.", "danger")
         return redirect(url_for('homepage'))
     
-@app.route('/story/index', methods=["GET", "POST"])
+@route('/story/index', methods=["GET", "POST"])
+@query_budget(2)
+@read_only
 @login_required
 @email_confirmed_required
 def show_stories():
@@ -654,19 +846,28 @@ def show_stories():
 
     This function handles both GET and POST requests to the '/story/index' route. It retrieves all
     stories that belong to the current logged-in user and passes them to the 'stories/index.html'
-    template for rendering. Note that this route requires the user to be logged in, as enforced by
-    the '@login_required' decorator.
+    template for rendering. Only the columns the cards show are loaded: the precomputed excerpt
+    and word count stand in for start_content. Note that this route requires the user to be logged in,
+    as enforced by the '@login_required' decorator.
 
     Returns:
         str: A string of HTML rendered by the 'stories/index.html' template, which includes a list
         of all stories associated with the current user.
     """
     page = request.args.get('page', 1, type=int)
-    stories = Story.query.filter_by(author_id=current_user.id).order_by((Story.created_at).desc()).paginate(page=page, per_page=6)
+    stories = (
+        Story.query
+        .options(load_only(Story.id, Story.title, Story.img_url, Story.end, Story.created_at,
+                           Story.excerpt, Story.word_count, Story.chain_length))
+        .filter_by(author_id=current_user.id)
+        .order_by((Story.created_at).desc())
+        .paginate(page=page, per_page=6)
+        )
 
     return render_template('/stories/index.html', stories=stories)
 
-@app.route('/story/edit/<int:id>', methods=["GET", "POST"])
+@route('/story/edit/<int:id>', methods=["GET", "POST"])
+@query_budget(5)
 @login_required
 @email_confirmed_required
 def edit_story(id):
@@ -694,11 +895,13 @@ def edit_story(id):
     story = Story.query.get_or_404(id)
     form = EditStoryForm(obj=story)
 
-    if story.author_id == current_user.id:
+    if story.is_owned_by(current_user):
         if request.method == "POST" and form.validate_on_submit():
             form.populate_obj(story)
+            story.img_url = ingest_image(story.img_url)
 
             db.session.commit()
+            invalidate_story(story.id)
             flash("Story updated!", "info")
 
             return redirect(url_for('show_stories'))
@@ -709,7 +912,8 @@ def edit_story(id):
         
     return render_template('/stories/edit.html', form=form)
 
-@app.route('/story/delete/<int:id>', methods=["POST"])
+@route('/story/delete/<int:id>', methods=["POST"])
+@query_budget(4)
 @login_required
 @email_confirmed_required
 def delete_story(id):
@@ -718,8 +922,9 @@ def delete_story(id):
 
     This function handles POST requests to the '/story/delete/<int:id>' route. It retrieves the
     story specified by the `id` and checks whether the current user is the author of that story.
-    If the user is the author, the story is deleted from the database and the user is redirected 
-    to the story index page with a success message. If the user is not the author, they are 
+    If the user is the author, the story is marked as deleted, which hides it at once, and the user
+    is redirected to the story index page with a success message. Its rows are removed later by
+    'flask deletion reap' (see 'deletion.py'). If the user is not the author, they are 
     redirected to the homepage with an error message. Note that this route requires the user to be 
     logged in, as enforced by the '@login_required' decorator.
 
@@ -733,9 +938,8 @@ def delete_story(id):
 
     story = Story.query.get_or_404(id)
 
-    if story.author_id == current_user.id:
-        db.session.delete(story)
-        db.session.commit()
+    if story.is_owned_by(current_user):
+        mark_story_deleted(story)
         flash("Story deleted.", "info")
 
         return redirect(url_for('show_stories'))
@@ -744,7 +948,8 @@ def delete_story(id):
         flash("You do not have permission to view this page.", "danger")
         return redirect(url_for('homepage'))
 
-@app.route('/story/generate', methods=["GET", "POST"])
+@route('/story/generate', methods=["GET", "POST"])
+@query_budget(23)
 @login_required
 @email_confirmed_required
 def generate_story():
@@ -756,7 +961,11 @@ def generate_story():
     homepage. For POST requests, it checks if the submitted form is valid. If the form is valid, 
     it increments the user's genre preference count for the selected genres, creates a prompt 
     using the selected genres and characters, and makes an API request to generate the story. The 
-    user is then redirected to the user detail page where the new story can be viewed.
+    user is then redirected to the user detail page where the new story can be viewed. Duplicate
+    submissions of the same form share a single generation (see 'singleflight.py'), and a user over
+    their generation quota gets a page that resubmits the form when the wait is over (see 'scheduler.py').
+    A story with no characters is taken from the warm pool of pre-generated openings when one is
+    ready for exactly the selected genres (see 'openings.py').
 
     Note that this route requires the user to be logged in, as enforced by the '@login_required' 
     decorator.
@@ -773,12 +982,23 @@ def generate_story():
     if request.method == "POST" and form.validate_on_submit():
             selected_genres = form.genres.data
             selected_characters = request.form.getlist('characters')
-            genres = [Genre.query.get_or_404(id) for id in selected_genres]
-
-            for genre in genres:
-                UserGenre.increment_count(user_id=current_user.id, genre_id=genre.id)
 
-            make_api_request(selected_genres, selected_characters)
+            def generate():
+                admit(current_user.id)
+                UserGenre.increment_counts(user_id=current_user.id, genre_ids=selected_genres)
+                if not selected_characters:
+                    story = claim_opening(selected_genres, current_user.id)
+                    if story:
+                        return story
+                return make_api_request(selected_genres, selected_characters)
+
+            try:
+                if single_flight(generation_key('generate'), generate) is None:
+                    flash("Your story is still being written. Check back in a moment.", "warning")
+            except QuotaExceeded as e:
+                return queued_response(e)
+            except GenerationFailed:
+                flash("Your story could not be written. Please try again.", "danger")
 
             return redirect(url_for('show_user', id=current_user.id))
     
@@ -787,7 +1007,8 @@ def generate_story():
     
     return render_template('home.html', form=form, characters=characters)
 
-@app.route('/story/view/<int:id>')
+@route('/story/view/<int:id>')
+@query_budget(3)
 @login_required
 @email_confirmed_required
 def show_story(id):
@@ -824,7 +1045,8 @@ def show_story(id):
         flash("You do not have permission to view this page.", "danger")
         return redirect(url_for('homepage'))
     
-@app.route('/story/continue/<int:id>', methods=["POST"])
+@route('/story/continue/<int:id>', methods=["POST"])
+@query_budget(23)
 @login_required
 @email_confirmed_required
 def continue_story(id):
@@ -836,6 +1058,9 @@ def continue_story(id):
     author, it adds a new choice to the story using the selected story step's content, commits 
     the choice to the database, and uses the 'next_step' function to determine the new story. 
     The user is then redirected to their user detail page where the updated story can be viewed.
+    Duplicate submissions of the same form, identified by its idempotency key, share a single
+    continuation (see 'singleflight.py'). A user over their generation quota gets a page that
+    resubmits the form when the wait is over (see 'scheduler.py').
     
     If the story was not authored by the current user or the request method is not "POST", the function 
     redirects the user to the homepage with an error message.
@@ -858,17 +1083,26 @@ def continue_story(id):
 
     if request.method == "POST":
     
-        step_id = request.form.get('step_id')
-        step = StoryStep.query.get(step_id)
+        step = StoryStep.query.filter_by(id=request.form.get('step_id', type=int), story_id=id).first_or_404()
+        step_id, choice_text = step.id, step.content
 
-        new_choice = Choice(choice_text=step.content, from_step_id=step_id)
-        db.session.add(new_choice)
-        db.session.commit()
+        def generate():
+            admit(current_user.id)
 
-        new_story = next_step(id, new_choice)
+            new_choice = Choice(choice_text=choice_text, from_step_id=step_id)
+            db.session.add(new_choice)
+            release_alternates(id)
+            db.session.commit()
 
-        new_choice.to_story_id = new_story.id
-        db.session.commit()
+            return next_step(id, new_choice)
+
+        try:
+            if single_flight(generation_key('continue'), generate) is None:
+                flash("Your story is still being written. Check back in a moment.", "warning")
+        except QuotaExceeded as e:
+            return queued_response(e)
+        except GenerationFailed:
+            flash("Your story could not be written. Please try again.", "danger")
 
         return redirect(url_for('show_user', id=current_user.id))
     
@@ -876,7 +1110,45 @@ def continue_story(id):
         flash("You do not have permission to view this page.", "danger")
         return redirect(url_for('homepage'))
     
-@app.route('/story/read/<int:id>')
+@route('/story/<int:id>/alternate/<int:opening_id>', methods=["POST"])
+@query_budget(7)
+@login_required
+@email_confirmed_required
+def use_alternate(id, opening_id):
+    """
+    Swap one of a story's alternate openings in for its current opening.
+
+    Stories generated with 'OPENING_CANDIDATES' above 1 keep the other candidates as alternates
+    until the story is continued. The replaced opening becomes an alternate itself, so the user
+    can switch back.
+
+    Args:
+        id (int): The ID of the story.
+        opening_id (int): The ID of the alternate to use.
+
+    Returns:
+        Werkzeug Response: A redirect to the user detail page, or to the homepage with an error
+        message if the user doesn't own the story or the alternate is no longer offered.
+    """
+
+    story = Story.query.get_or_404(id)
+    opening = db.session.get(StoryOpening, opening_id)
+
+    if not story.is_owned_by(current_user) or opening is None or opening.story_id != story.id:
+        flash("That opening is no longer available.", "danger")
+        return redirect(url_for('homepage'))
+
+    # Read before the commit expires the user, which would cost a query to reload it.
+    user_id = current_user.id
+    mark_dirty(story.id)
+    swap_alternate(story, opening)
+    invalidate_story(id)
+
+    return redirect(url_for('show_user', id=user_id))
+
+@route('/story/read/<int:id>')
+@query_budget(1)
+@read_only
 @login_required
 @email_confirmed_required
 def read_story(id):
@@ -887,6 +1159,16 @@ def read_story(id):
     starting from and including the specified story. It then renders a template with the sequence 
     of stories (referred to as a 'chain').
 
+    Chains longer than 'READ_CHAPTERS_PER_PAGE' stories are streamed with only their first page of
+    chapters; the reader's browser fetches the following pages from 'read_chapters' as they scroll,
+    so neither the memory a read takes nor the time to its first byte grows with the chain's depth.
+    Those pages are not cached.
+
+    Once a chain has ended its content no longer changes, so the rendered chain is cached (see 
+    'pagecache.py') and served with a strong ETag and Last-Modified. A conditional request that 
+    matches gets a 304 without touching the stories or rendering anything, and a cache hit 
+    skips 'get_story_chain' entirely. Editing or deleting any story in the chain drops the entry.
+
     Note that this route requires the user to be logged in, as enforced by the '@login_required' decorator.
 
     Args:
@@ -894,9 +1176,135 @@ def read_story(id):
 
     Returns:
         Werkzeug Response: The rendered template for the '/stories/read.html' page with the 
-        chain of stories.
+        chain of stories, or an empty 304 response for a matching conditional request of a 
+        finished chain. A 'Server-Timing' header reports the cost of decoding compressed story text.
+    """
+
+    entry = get_cached_chain(id)
+
+    if entry is None:
+        per_page = current_app.config.get('READ_CHAPTERS_PER_PAGE', 10)
+        page = Story.get_story_chain_page(id, limit=per_page + 1)
+
+        if not page:
+            abort(404)
+
+        if len(page) > per_page:
+            return stream_template('/stories/read_stream.html', title=page[0].Story.title,
+                                   chapters=page[:per_page], next_url=chapters_url(id, page[:per_page]))
+
+        chain = [story for story, depth in page]
+        chain_html = render_template('/stories/_chain.html', chain=chain)
+
+        if not chain[-1].end:
+            response = make_response(render_template('/stories/read.html', chain_html=Markup(chain_html)))
+            response.headers['Server-Timing'] = decode_timing()
+            return response
+
+        entry = store_chain(id, chain, chain_html)
+
+    if '_flashes' in session:
+        response = make_response(render_template('/stories/read.html', chain_html=Markup(entry['html'])))
+        response.headers['Server-Timing'] = decode_timing()
+        return response
+
+    etag = user_etag(entry, current_user)
+
+    if is_resource_modified(request.environ, etag=etag, last_modified=entry['last_modified']):
+        response = make_response(render_template('/stories/read.html', chain_html=Markup(entry['html'])))
+    else:
+        response = make_response('', 304)
+
+    response.set_etag(etag)
+    response.last_modified = entry['last_modified']
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.headers['Server-Timing'] = decode_timing()
+
+    return response
+
+def chapters_url(id, chapters):
+    """
+    Return the URL of the page of chapters that follows the given ones.
+
+    Args:
+        id (int): The ID of the last story of the chain.
+        chapters (list): The (Story, depth) rows of the current page.
+
+    Returns:
+        str or None: The 'read_chapters' URL, or None if the page ends the chain.
+    """
+
+    depth = chapters[-1].depth
+
+    return url_for('read_chapters', id=id, before=depth) if depth > 0 else None
+
+@route('/story/read/<int:id>/chapters')
+@query_budget(1)
+@read_only
+@login_required
+@email_confirmed_required
+def read_chapters(id):
+    """
+    Return the next page of chapters of a chain being read with 'read_story'.
+
+    The page is an HTML fragment the reading page appends as the reader scrolls. It ends with a
+    placeholder pointing at the page after it, or with the end of the story. The 'before' query
+    parameter is the depth, counted back from story `id`, of the last chapter already shown.
+
+    Args:
+        id (int): The ID of the last story of the chain.
+
+    Returns:
+        Werkzeug Response: The rendered '/stories/_chapters.html' fragment, or 404 if no chapters
+        come after the given one.
+    """
+
+    before = request.args.get('before', type=int)
+    if before is None or before <= 0:
+        abort(404)
+
+    chapters = Story.get_story_chain_page(id, before=before, limit=current_app.config.get('READ_CHAPTERS_PER_PAGE', 10))
+    if not chapters:
+        abort(404)
+
+    return render_template('/stories/_chapters.html', chapters=chapters, next_url=chapters_url(id, chapters))
+
+@route('/admin/analytics')
+@query_budget(4)
+@read_only
+@login_required
+@admin_required
+def show_analytics():
+    """
+    Display how deep story trees go, how often they reach an ending, how much they branch and
+    which choices readers pick most.
+
+    Everything is read from the aggregates kept by 'analytics.py', never from the stories
+    themselves, so the page costs the same however many stories there are.
+
+    Returns:
+        Rendered template: The '/admin/analytics.html' template.
     """
 
-    chain = Story.get_story_chain(id)
+    return render_template('/admin/analytics.html', summary=summary(), steps=top_steps(), trees=largest_trees())
+
+@route('/admin/slow-queries')
+@query_budget(0)
+@login_required
+@admin_required
+def show_slow_queries():
+    """
+    Display the slow SQL statements recorded by 'slowquery.py'.
+
+    Statements from every worker's log are grouped by their normalized fingerprint and sorted by
+    total time, each with the code that issued it, the endpoints it ran under and an example
+    execution with its parameters and, when one was sampled, its EXPLAIN (ANALYZE, BUFFERS) plan.
+    The most recent entries seen by this worker are listed below the groups.
+
+    Returns:
+        Rendered template: The '/admin/slow_queries.html' template.
+    """
 
-    return render_template('/stories/read.html', chain=chain)
\ No newline at end of file
+    return render_template('/admin/slow_queries.html', groups=summarize(current_app),
+                           recent=recent_entries(), threshold=current_app.config.get('SLOW_QUERY_MS'))
@@ -0,0 +1,353 @@
+from flask import request, flash, redirect, url_for, render_template
+from flask_login import current_user
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+from models import db, Story, StoryStep, Choice, Genre, Character, UserGenre
+from forms import GenreForm
+from apicalls import make_api_request_async, next_step_async, save_story
+from singleflight import generation_key, claim, finish, fail, abandon, wait_async, GenerationFailed, GenerationAbandoned
+from scheduler import admit, QuotaExceeded, queued_response
+from openings import claim_opening, release_alternates
+from io import BytesIO
+import asyncio
+import re
+import sys
+
+app = create_app()
+wsgi_application = WsgiToAsgi(app)
+
+def _build_environ(scope, body):
+    """
+    Build a WSGI environ from an ASGI HTTP scope and its request body.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        body (bytes): The complete request body.
+
+    Returns:
+        dict: The WSGI environ.
+    """
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('UTF-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('UTF-8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value.decode('latin1')}" if name in environ else value.decode('latin1')
+
+    return environ
+
+async def dispatch(scope, receive, send, view, **kwargs):
+    """
+    Run an async view inside a Flask request context and send its response over ASGI.
+
+    The request goes through the same before/after request hooks, error handlers and session
+    handling as a request served by Flask itself, so flashes, logins and CSRF work unchanged.
+    Flask's contexts live in context variables, so each in-flight request sees only its own.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        receive (callable): The ASGI receive channel.
+        send (callable): The ASGI send channel.
+        view (coroutine function): The view to run.
+        **kwargs: URL parameters passed to the view.
+    """
+
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    ctx = app.request_context(_build_environ(scope, body))
+    ctx.push()
+
+    try:
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = await view(**kwargs)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+
+        response = app.process_response(app.make_response(rv))
+    finally:
+        ctx.pop()
+
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+def _check_user():
+    """
+    Apply the checks of '@login_required' and '@email_confirmed_required'.
+
+    Returns:
+        Werkzeug Response or None: A redirect if the user may not generate stories, otherwise None.
+    """
+
+    if not current_user.is_authenticated:
+        return app.login_manager.unauthorized()
+
+    if not current_user.email_confirmed:
+        flash('Please confirm your email address.', 'danger')
+        return redirect(url_for('unconfirmed'))
+
+    return None
+
+async def _claim_or_wait(read):
+    """
+    Run a view's `read` step on a worker thread, and wait for a duplicate's generation if that
+    request claimed the key first.
+
+    If the duplicate's generation is abandoned, `read` runs again, so this request claims the
+    key itself, or waits for whichever request did.
+
+    Args:
+        read (function): Returns (response, None) to answer at once, or (None, (user_id, key,
+            inputs)), where inputs is None if another request claimed the key.
+
+    Returns:
+        tuple: (response, None) if the request is answered, or (None, (user_id, key, inputs))
+        if it claimed the key and should run the generation.
+    """
+
+    while True:
+        response, prepared = await asyncio.to_thread(read)
+        if response is not None or prepared[2] is not None:
+            return response, prepared
+
+        author_id, key, inputs = prepared
+        try:
+            story_id = await wait_async(author_id, key)
+        except GenerationAbandoned:
+            continue
+        except GenerationFailed:
+            flash("Your story could not be written. Please try again.", "danger")
+            return redirect(url_for('show_user', id=author_id)), None
+
+        if story_id is None:
+            flash("Your story is still being written. Check back in a moment.", "warning")
+
+        return redirect(url_for('show_user', id=author_id)), None
+
+async def generate_story():
+    """
+    Async variant of `app.generate_story` for POST requests.
+
+    Form validation, genre counting and the lookups the prompt needs run on a worker thread
+    before the completion call. The session is closed, returning its connection to the pool,
+    while the completion is awaited on the event loop, and the story is saved on a worker
+    thread afterwards. Hundreds of these can wait on OpenAI at once in a single process.
+    Duplicate submissions of the same form wait for the first one's story instead of starting
+    their own generation. A story with no characters is taken from the warm pool of openings
+    when it can be, with no completion call at all.
+
+    Returns:
+        Werkzeug Response: A redirect to the user detail page on success, or the same response
+        the sync view gives for an invalid form.
+    """
+
+    def read():
+        denied = _check_user()
+        if denied:
+            return denied, None
+
+        form = GenreForm()
+        form.genres.choices = [(genre.id, genre.name) for genre in Genre.query.all()]
+
+        if not form.validate_on_submit():
+            page = request.args.get('page', 1, type=int)
+            characters = Character.query.filter_by(user_id=current_user.id).paginate(page=page, per_page=20)
+            return render_template('home.html', form=form, characters=characters), None
+
+        key = generation_key('generate')
+        if not claim(current_user.id, key):
+            prepared = (current_user.id, key, None)
+            db.session.close()
+            return None, prepared
+
+        try:
+            admit(current_user.id)
+
+            selected_characters = request.form.getlist('characters')
+            names = dict(form.genres.choices)
+
+            UserGenre.increment_counts(user_id=current_user.id, genre_ids=form.genres.data)
+
+            if not selected_characters:
+                story = claim_opening(form.genres.data, current_user.id)
+                if story:
+                    finish(current_user.id, key, story.id)
+                    return redirect(url_for('show_user', id=current_user.id)), None
+
+            prompt = {
+                'genre_ids': form.genres.data,
+                'genres': [names[id] for id in form.genres.data],
+                'characters': [(character.name, character.description)
+                               for character in Character.query.filter(Character.id.in_(selected_characters))]
+            }
+        except QuotaExceeded as e:
+            abandon(current_user.id, key)
+            return queued_response(e), None
+        except Exception:
+            fail(current_user.id, key)
+            raise
+
+        prepared = (current_user.id, key, (prompt, selected_characters))
+        db.session.close()
+
+        return None, prepared
+
+    def save(title, start_content, choices, alternates, tokens, genre_ids, author_id, selected_characters, key):
+        new_story = save_story(title, start_content, choices, author_id, selected_characters,
+                               alternates=alternates, genre_ids=genre_ids, tokens=tokens)
+        finish(author_id, key, new_story.id)
+        return new_story.id
+
+    response, prepared = await _claim_or_wait(read)
+    if response is not None:
+        return response
+
+    author_id, key, (prompt, selected_characters) = prepared
+
+    try:
+        title, start_content, choices, alternates, tokens = await make_api_request_async(prompt['genres'], prompt['characters'])
+        await asyncio.to_thread(save, title, start_content, choices, alternates, tokens, prompt['genre_ids'],
+                                author_id, selected_characters, key)
+    except QuotaExceeded as e:
+        await asyncio.to_thread(abandon, author_id, key)
+        return queued_response(e)
+    except Exception:
+        await asyncio.to_thread(fail, author_id, key)
+        raise
+
+    return redirect(url_for('show_user', id=author_id))
+
+async def continue_story(id):
+    """
+    Async variant of `app.continue_story`.
+
+    Reads the story and step and records the choice on a worker thread, awaits the completion
+    with no database connection held, then saves the new story and links the choice to it.
+    Duplicate submissions of the same form share the first one's continuation.
+
+    Args:
+        id (int): The ID of the story to be continued.
+
+    Returns:
+        Werkzeug Response: A redirect to the user detail page if the story was continued successfully,
+        or a redirect to the homepage with an error message otherwise.
+    """
+
+    def read():
+        denied = _check_user()
+        if denied:
+            return denied, None
+
+        story = Story.query.get_or_404(id)
+
+        if not story.is_owned_by(current_user):
+            flash("You do not have permission to continue this story.", "danger")
+            return redirect(url_for('homepage')), None
+
+        step = StoryStep.query.filter_by(id=request.form.get('step_id', type=int), story_id=id).first_or_404()
+        step_id, choice_text = step.id, step.content
+
+        key = generation_key('continue')
+        if not claim(current_user.id, key):
+            prepared = (current_user.id, key, None)
+            db.session.close()
+            return None, prepared
+
+        try:
+            admit(current_user.id)
+
+            new_choice = Choice(choice_text=choice_text, from_step_id=step_id)
+            db.session.add(new_choice)
+            release_alternates(id)
+            db.session.commit()
+        except QuotaExceeded as e:
+            abandon(current_user.id, key)
+            return queued_response(e), None
+        except Exception:
+            fail(current_user.id, key)
+            raise
+
+        prepared = (current_user.id, key, (story.title, story.start_content, new_choice.choice_text, new_choice.id))
+        db.session.close()
+
+        return None, prepared
+
+    def save(title, start_content, choices, end, tokens, choice_id, author_id, key):
+        new_story = save_story(title, start_content, choices, author_id, end=end, choice_id=choice_id, tokens=tokens)
+        finish(author_id, key, new_story.id)
+        return new_story.id
+
+    response, prepared = await _claim_or_wait(read)
+    if response is not None:
+        return response
+
+    author_id, key, (title, story_content, choice_text, choice_id) = prepared
+
+    try:
+        start_content, choices, end, tokens = await next_step_async(story_content, choice_text)
+        await asyncio.to_thread(save, title, start_content, choices, end, tokens, choice_id, author_id, key)
+    except QuotaExceeded as e:
+        await asyncio.to_thread(abandon, author_id, key)
+        return queued_response(e)
+    except Exception:
+        await asyncio.to_thread(fail, author_id, key)
+        raise
+
+    return redirect(url_for('show_user', id=author_id))
+
+ASYNC_ROUTES = [
+    (re.compile(r'^/story/generate$'), generate_story),
+    (re.compile(r'^/story/continue/(?P<id>\d+)$'), continue_story),
+]
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point.
+
+    POSTs to the LLM-bound routes are served by the async views above; everything else is
+    handed to the regular Flask app on asgiref's thread pool. Serve with an ASGI server, e.g.
+    'uvicorn asgi:application' or 'gunicorn -k uvicorn.workers.UvicornWorker asgi:application'.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        receive (callable): The ASGI receive channel.
+        send (callable): The ASGI send channel.
+    """
+
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        for pattern, view in ASYNC_ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                kwargs = {name: int(value) for name, value in match.groupdict().items()}
+                return await dispatch(scope, receive, send, view, **kwargs)
+
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,117 @@
+from statistics import median
+from time import perf_counter
+import tempfile
+import sys
+import os
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup(stories, chain):
+    """
+    Create the app against a fresh SQLite database, with one user owning a library of stories.
+
+    Args:
+        stories (int): The number of stories in the library.
+        chain (int): The number of stories in the chain ending at the last one.
+
+    Returns:
+        tuple: The app, the ID of the last story of the chain and the ID of a character.
+    """
+
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{tempfile.mkdtemp()}/benchmark.sqlite",
+        'FLASK_SECRET_KEY': os.getenv('FLASK_SECRET_KEY', 'benchmark'),
+        'SECURITY_PASSWORD_SALT': os.getenv('SECURITY_PASSWORD_SALT', 'benchmark'),
+        'LLM_BACKEND': 'fake',
+        'OPENING_POOL_SIZE': '0',
+    })
+    sys.path.insert(0, ROOT)
+
+    from app import create_app
+    from models import db, User, Story, StoryStep, Choice, Character
+
+    app = create_app({'WTF_CSRF_ENABLED': False, 'QUERY_BUDGET_MODE': 'off'})
+
+    with app.app_context():
+        db.create_all()
+        user = User.signup({'username': 'benchmark', 'first_name': 'Bench', 'last_name': 'Mark',
+                            'email': 'benchmark@example.com', 'password': 'Benchmark1!'})
+        user.email_confirmed = True
+        db.session.commit()
+
+        character = Character(name='Ada', description='A curious inventor. ' * 20, user_id=user.id)
+        db.session.add(character)
+        db.session.commit()
+
+        for i in range(stories - chain):
+            Story.create_story(f"Story {i}", 'Once upon a time, a page was rendered. ' * 60, user.id)
+
+        previous = None
+        for depth in range(1, chain + 1):
+            story = Story.create_story('The Chain', 'And then the story went on. ' * 60, user.id,
+                                       end=depth == chain, chain_length=depth)
+            if previous is not None:
+                db.session.add(Choice(choice_text=previous.content, from_step_id=previous.id, to_story_id=story.id))
+            previous = StoryStep(content='Go on.', story_id=story.id)
+            db.session.add(previous)
+            db.session.commit()
+
+        return app, story.id, character.id
+
+def measure(client, url, runs, headers=None):
+    """
+    Request a URL `runs` times.
+
+    Returns:
+        tuple: The status code, the body size in bytes and the median milliseconds per request.
+    """
+
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        response = client.get(url, headers=headers or {})
+        times.append((perf_counter() - start) * 1000)
+
+    return response.status_code, len(response.get_data()), median(times)
+
+@click.command()
+@click.option('--stories', default=60, help="Stories in the user's library.")
+@click.option('--chain', default=10, help="Stories in the chain that is read.")
+@click.option('--runs', default=50, help="Requests timed per route.")
+def main(stories, chain, runs):
+    """
+    Compare bytes and latency per request of the HTML pages with the JSON API routes serving the same data.
+
+    Runs in-process against a throwaway SQLite database, so it measures the app, not the network:
+    'python benchmarks/api_vs_html.py --stories 200 --chain 20'.
+    """
+
+    app, end_id, character_id = setup(stories, chain)
+    client = app.test_client()
+    client.post('/user/login', data={'username': 'benchmark', 'password': 'Benchmark1!'})
+
+    pairs = [
+        ('story list', '/story/index', '/api/v1/stories?limit=6'),
+        ('story list, titles only', '/story/index', '/api/v1/stories?limit=6&fields=title'),
+        ('story', f'/story/edit/{end_id}', f'/api/v1/stories/{end_id}'),
+        ('chain', f'/story/read/{end_id}', f'/api/v1/stories/{end_id}/chain'),
+        ('characters', '/character/index', '/api/v1/characters'),
+        ('character', f'/character/edit/{character_id}', f'/api/v1/characters/{character_id}'),
+    ]
+
+    click.echo(f"{'route':<24} {'html bytes':>11} {'html ms':>8} {'api bytes':>10} {'api ms':>7}")
+    with app.app_context():
+        for name, html_url, api_url in pairs:
+            html_status, html_bytes, html_ms = measure(client, html_url, runs)
+            api_status, api_bytes, api_ms = measure(client, api_url, runs)
+            assert (html_status, api_status) == (200, 200), (name, html_status, api_status)
+            click.echo(f"{name:<24} {html_bytes:>11} {html_ms:>8.2f} {api_bytes:>10} {api_ms:>7.2f}")
+
+        etag = client.get(f'/api/v1/stories/{end_id}/chain').headers['ETag']
+        status, size, ms = measure(client, f'/api/v1/stories/{end_id}/chain', runs, {'If-None-Match': etag})
+        assert status == 304, status
+        click.echo(f"{'chain, revalidated':<24} {'':>11} {'':>8} {size:>10} {ms:>7.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import urlencode
+import tempfile
+import asyncio
+import uuid
+import sys
+import os
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup(latency, concurrency):
+    """
+    Create the app against a fresh SQLite database and the fake LLM backend, with one user and story.
+
+    Quotas and the upstream concurrency limit are raised so the scheduler never holds a request
+    back; only the simulated model latency is left.
+
+    Args:
+        latency (float): Median seconds the fake model takes per completion.
+        concurrency (int): The most completions allowed in flight at once.
+
+    Returns:
+        tuple: The `asgi` module, the ID of the story and the ID of its step.
+    """
+
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{tempfile.mkdtemp()}/benchmark.sqlite",
+        'FLASK_SECRET_KEY': os.getenv('FLASK_SECRET_KEY', 'benchmark'),
+        'SECURITY_PASSWORD_SALT': os.getenv('SECURITY_PASSWORD_SALT', 'benchmark'),
+        'LLM_BACKEND': 'fake',
+        'LLM_MAX_CONCURRENCY': str(concurrency),
+        'LLM_USER_RPM': '1000000',
+        'LLM_USER_TPM': '1000000000',
+        'OPENING_POOL_SIZE': '0',
+    })
+    sys.path.insert(0, ROOT)
+
+    import asgi
+    from models import db, User, Story, StoryStep
+
+    asgi.app.config.update(WTF_CSRF_ENABLED=False, FAKE_LLM_TIME_SCALE=1.0,
+                           FAKE_LLM_LATENCY={'gpt-3.5-turbo': latency, 'gpt-3.5-turbo-16k': latency, 'gpt-4': latency})
+
+    with asgi.app.app_context():
+        db.create_all()
+        user = User.signup({'username': 'benchmark', 'first_name': 'Bench', 'last_name': 'Mark',
+                            'email': 'benchmark@example.com', 'password': 'Benchmark1!'})
+        user.email_confirmed = True
+        db.session.commit()
+
+        story = Story.create_story('Benchmark', 'Once upon a time, a request was made. ' * 20, user.id)
+        step = StoryStep(content='Wait for the model.', story_id=story.id)
+        db.session.add(step)
+        db.session.commit()
+
+        return asgi, story.id, step.id
+
+def form(step_id):
+    return {'step_id': step_id, 'idempotency_key': uuid.uuid4().hex}
+
+def run_sync(app, story_id, step_id, count):
+    """
+    Continue the story `count` times, one request after another, as a sync worker serves them.
+
+    Returns:
+        float: The wall-clock seconds taken.
+    """
+
+    client = app.test_client()
+    client.post('/user/login', data={'username': 'benchmark', 'password': 'Benchmark1!'})
+
+    start = perf_counter()
+    for _ in range(count):
+        response = client.post(f'/story/continue/{story_id}', data=form(step_id))
+        assert response.status_code == 302, response.status_code
+
+    return perf_counter() - start
+
+async def post(application, path, cookie, data):
+    body = urlencode(data).encode('ascii')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode('ascii'), 'query_string': b'',
+        'root_path': '', 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+        'headers': [(b'host', b'localhost'), (b'cookie', f'session={cookie}'.encode('latin1')),
+                    (b'content-type', b'application/x-www-form-urlencoded'),
+                    (b'content-length', str(len(body)).encode('ascii'))],
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    return status[0]
+
+async def run_async(asgi, story_id, step_id, count):
+    """
+    Send `count` continuations to the ASGI app at once, sampling how many completions are in flight.
+
+    Returns:
+        tuple: The wall-clock seconds taken and the most completions seen in flight at once.
+    """
+
+    import fakellm
+
+    client = asgi.app.test_client()
+    client.post('/user/login', data={'username': 'benchmark', 'password': 'Benchmark1!'})
+    cookie = client.get_cookie('session').value
+    peak = 0
+    done = False
+
+    async def sample():
+        nonlocal peak
+        while not done:
+            peak = max(peak, fakellm.in_flight)
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.ensure_future(sample())
+    start = perf_counter()
+    statuses = await asyncio.gather(*(post(asgi.application, f'/story/continue/{story_id}', cookie, form(step_id))
+                                      for _ in range(count)))
+    elapsed = perf_counter() - start
+    done = True
+    await sampler
+
+    assert all(status == 302 for status in statuses), statuses
+    return elapsed, peak
+
+@click.command()
+@click.option('--requests', 'count', default=50, help="Concurrent continuations sent to the async app.")
+@click.option('--sync-requests', default=3, help="Continuations sent one after another to the sync app.")
+@click.option('--latency', default=1.0, help="Median seconds the fake model takes per completion.")
+def main(count, sync_requests, latency):
+    """
+    Compare story continuations served by a sync worker with the same requests served by the ASGI app.
+
+    Runs against a throwaway SQLite database and the fake LLM backend, so no API key or
+    Postgres server is needed: 'python benchmarks/async_generations.py --requests 200'.
+    """
+
+    asgi, story_id, step_id = setup(latency, max(count, sync_requests))
+
+    elapsed = run_sync(asgi.app, story_id, step_id, sync_requests)
+    click.echo(f"sync:  {sync_requests} sequential requests in {elapsed:.2f}s "
+               f"({sync_requests / elapsed:.1f} req/s per worker)")
+
+    elapsed, peak = asyncio.run(run_async(asgi, story_id, step_id, count))
+    click.echo(f"async: {count} concurrent requests in {elapsed:.2f}s "
+               f"({count / elapsed:.1f} req/s), at most {peak} completions in flight")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+from time import sleep
+import subprocess
+import tempfile
+import signal
+import socket
+import json
+import sys
+import os
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter per sample, so nothing is already imported.
+STARTUP = """
+from time import perf_counter
+import json
+start = perf_counter()
+from app import create_app
+create_app()
+elapsed = perf_counter() - start
+status = dict(line.split(':', 1) for line in open('/proc/self/status'))
+print(json.dumps({'ms': elapsed * 1000, 'rss_kb': int(status['VmRSS'].split()[0])}))
+"""
+
+def environment():
+    database = f"sqlite:///{tempfile.mkdtemp()}/benchmark.sqlite"
+    return {**os.environ, 'DATABASE_URL': os.getenv('DATABASE_URL', database),
+            'FLASK_SECRET_KEY': os.getenv('FLASK_SECRET_KEY', 'benchmark'),
+            'SECURITY_PASSWORD_SALT': os.getenv('SECURITY_PASSWORD_SALT', 'benchmark')}
+
+def startup_samples(runs):
+    """
+    Time importing the app module and building the app, each in a new Python process.
+
+    Args:
+        runs (int): The number of processes started.
+
+    Returns:
+        list: A dict per run with the milliseconds taken ('ms') and the resident set size ('rss_kb').
+    """
+
+    env = environment()
+    return [json.loads(subprocess.run([sys.executable, '-c', STARTUP], cwd=ROOT, env=env, check=True,
+                                      capture_output=True, text=True).stdout.splitlines()[-1])
+            for _ in range(runs)]
+
+def pss_kb(pid):
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+
+    return 0
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def worker_pss(workers, preload, settle):
+    """
+    Start gunicorn with the repo's config and measure the proportional set size of each worker.
+
+    PSS splits pages shared between processes across them, so it shows how much of a worker's
+    memory preloading the app in the master saves.
+
+    Args:
+        workers (int): The number of workers.
+        preload (bool): Whether the app is imported in the master before forking.
+        settle (float): Seconds to wait for the workers to boot.
+
+    Returns:
+        list: The PSS of each worker, in kB.
+    """
+
+    env = {**environment(), 'WEB_CONCURRENCY': str(workers), 'GUNICORN_PRELOAD': 'true' if preload else 'false',
+           'GUNICORN_BIND': f'127.0.0.1:{free_port()}', 'PROMETHEUS_MULTIPROC_DIR': tempfile.mkdtemp()}
+    master = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        sleep(settle)
+        with open(f'/proc/{master.pid}/task/{master.pid}/children') as f:
+            pids = [int(pid) for pid in f.read().split()]
+        return [pss_kb(pid) for pid in pids]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+@click.command()
+@click.option('--runs', default=3, help="Number of fresh processes timed.")
+@click.option('--workers', default=4, help="Number of gunicorn workers measured; 0 skips gunicorn.")
+@click.option('--settle', default=5.0, help="Seconds to let gunicorn's workers boot before measuring.")
+def main(runs, workers, settle):
+    """
+    Measure how long the app takes to import and build, and how much memory its workers use.
+
+    Linux only, as memory is read from /proc. Run it on two checkouts to compare them:
+    'python benchmarks/cold_start.py --runs 5'.
+    """
+
+    samples = startup_samples(runs)
+    times = sorted(sample['ms'] for sample in samples)
+    click.echo(f"import + create app ({runs} runs)  {times[0]:.0f}-{times[-1]:.0f} ms, "
+               f"{max(sample['rss_kb'] for sample in samples) / 1024:.0f} MB RSS")
+
+    if not workers:
+        return
+
+    for preload in (False, True):
+        sizes = sorted(worker_pss(workers, preload, settle))
+        if not sizes:
+            raise click.ClickException("gunicorn started no workers; is it installed?")
+        click.echo(f"gunicorn, {len(sizes)} workers, PSS  {'preload   ' if preload else 'no preload'} "
+                   f"{sizes[0] / 1024:.0f}-{sizes[-1] / 1024:.0f} MB/worker")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+from flask import current_app, g, has_app_context, has_request_context
+from flask.cli import AppGroup
+from sqlalchemy import types, select, update, text
+from time import perf_counter_ns
+import click
+import os
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+_compressors = {}
+_decompressors = {}
+
+class CompressedText(types.TypeDecorator):
+    """
+    Transparent compressed text column type.
+
+    With 'STORY_COMPRESSION' off, the column is plain text and values are bound as strings, as
+    before compression existed. With it on, the column is binary: values are written as UTF-8
+    bytes, compressed as zstd frames using a dictionary trained on our own stories, and are always
+    read back as plain strings. Rows written before compression was enabled (plain UTF-8) and rows
+    written with an older dictionary remain readable, since every zstd frame records the id of the
+    dictionary it was compressed with. On Postgres, existing text columns are converted with
+    'flask compression migrate' before compression is turned on.
+
+    Values shorter than 'STORY_COMPRESSION_MIN_BYTES', or that would not shrink, are stored
+    uncompressed. Decode time is accumulated on `flask.g` so views can report the cost per request.
+
+    SQLAlchemy caches a type's dialect implementation per engine, so the setting at the time a
+    table is created only picks the column type in the DDL. Values are bound and read without the
+    implementation's processors, and the setting is checked for every value, so changing it takes
+    effect at once: strings and bytes are passed to the driver as they are, and both are read back.
+    """
+
+    impl = types.Text
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if compression_enabled():
+            return dialect.type_descriptor(types.LargeBinary())
+
+        return dialect.type_descriptor(types.Text())
+
+    def bind_processor(self, dialect):
+        def process(value):
+            return self.process_bind_param(value, dialect)
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            return self.process_result_value(value, dialect)
+
+        return process
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not compression_enabled():
+            return value
+
+        raw = value.encode('UTF-8')
+
+        if len(raw) < current_app.config.get('STORY_COMPRESSION_MIN_BYTES', 256):
+            return raw
+
+        compressed = get_compressor().compress(raw)
+
+        return compressed if len(compressed) < len(raw) else raw
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        if isinstance(value, str):
+            return value
+
+        start = perf_counter_ns()
+        value = decode(bytes(value))
+
+        if has_request_context():
+            g.decode_ns = g.get('decode_ns', 0) + perf_counter_ns() - start
+            g.decode_count = g.get('decode_count', 0) + 1
+
+        return value
+
+def compression_enabled():
+    """
+    Check whether story text should be compressed on write.
+
+    Returns:
+        bool: True if 'STORY_COMPRESSION' is set in the current app config and zstandard is installed.
+    """
+
+    if zstd is None or not has_app_context():
+        return False
+
+    return bool(current_app.config.get('STORY_COMPRESSION'))
+
+def dict_dir():
+    """
+    Return the directory holding trained zstd dictionaries.
+
+    Returns:
+        str: The 'STORY_ZSTD_DICT_DIR' config value, or 'zstd-dicts' in the app's instance folder.
+    """
+
+    return current_app.config.get('STORY_ZSTD_DICT_DIR') or os.path.join(current_app.instance_path, 'zstd-dicts')
+
+def load_dict(dict_id):
+    """
+    Load a trained dictionary from disk by its zstd dictionary id.
+
+    Args:
+        dict_id (int): The id recorded in the zstd frame header.
+
+    Returns:
+        zstd.ZstdCompressionDict: The dictionary.
+
+    Raises:
+        FileNotFoundError: If the dictionary is not present in the dictionary directory.
+    """
+
+    with open(os.path.join(dict_dir(), f"{dict_id}.zdict"), 'rb') as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+def current_dict_id():
+    """
+    Return the id of the dictionary new rows should be compressed with.
+
+    Returns:
+        int or None: The id stored in the 'current' pointer file, or None if no dictionary has been trained.
+    """
+
+    try:
+        with open(os.path.join(dict_dir(), 'current')) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def get_compressor():
+    """
+    Return a compressor for the current dictionary, creating and caching it on first use.
+
+    Falls back to plain zstd (no dictionary) when no dictionary has been trained yet.
+
+    Returns:
+        zstd.ZstdCompressor or None: The compressor, or None if zstandard is not installed.
+    """
+
+    if zstd is None:
+        return None
+
+    dict_id = current_dict_id()
+    level = current_app.config.get('STORY_COMPRESSION_LEVEL', 9)
+
+    if (dict_id, level) not in _compressors:
+        if dict_id is None:
+            _compressors[(dict_id, level)] = zstd.ZstdCompressor(level=level)
+        else:
+            _compressors[(dict_id, level)] = zstd.ZstdCompressor(level=level, dict_data=load_dict(dict_id))
+
+    return _compressors[(dict_id, level)]
+
+def decode(data):
+    """
+    Decode a stored value into text.
+
+    Args:
+        data (bytes): Either plain UTF-8 or a zstd frame.
+
+    Returns:
+        str: The decoded text.
+    """
+
+    if not data.startswith(ZSTD_MAGIC):
+        return data.decode('UTF-8')
+
+    if zstd is None:
+        raise RuntimeError("zstandard is required to read compressed story text")
+
+    dict_id = zstd.get_frame_parameters(data).dict_id
+
+    if dict_id not in _decompressors:
+        if dict_id == 0:
+            _decompressors[dict_id] = zstd.ZstdDecompressor()
+        else:
+            _decompressors[dict_id] = zstd.ZstdDecompressor(dict_data=load_dict(dict_id))
+
+    return _decompressors[dict_id].decompress(data).decode('UTF-8')
+
+def decode_timing():
+    """
+    Build a Server-Timing header value for the text decoded during this request.
+
+    Returns:
+        str: A Server-Timing entry with the decode duration in milliseconds and the number of values decoded.
+    """
+
+    ms = g.get('decode_ns', 0) / 1_000_000
+
+    return f'decode;dur={ms:.3f};desc="{g.get("decode_count", 0)} values"'
+
+def compressed_columns():
+    """
+    Return the columns stored with CompressedText.
+
+    Returns:
+        list: (table, column) pairs of SQLAlchemy Table and Column objects.
+    """
+
+    from models import Story, StoryStep, StoryOpening
+
+    return [(Story.__table__, Story.__table__.c.start_content),
+            (StoryStep.__table__, StoryStep.__table__.c.content),
+            (StoryOpening.__table__, StoryOpening.__table__.c.start_content)]
+
+def column_type(session, table, column):
+    """
+    Look up a column's type in a Postgres database.
+
+    Args:
+        session (Session): The session to query with.
+        table (Table): The table.
+        column (Column or str): The column, or its name.
+
+    Returns:
+        str or None: The 'data_type' from information_schema, such as 'text' or 'bytea', or None
+        if the column doesn't exist.
+    """
+
+    return session.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = :t AND column_name = :c"
+    ), {'t': table.name, 'c': getattr(column, 'name', column)}).scalar()
+
+compression_cli = AppGroup('compression', help="Manage compressed story text.")
+
+@compression_cli.command('train-dict')
+@click.option('--size', default=112640, help="Dictionary size in bytes.")
+@click.option('--samples', default=5000, help="Maximum number of rows to sample per column.")
+def train_dict(size, samples):
+    """
+    Train a zstd dictionary on existing stories and steps and make it current.
+    """
+
+    from models import db
+
+    if zstd is None:
+        raise click.ClickException("zstandard is not installed.")
+
+    corpus = []
+    for table, column in compressed_columns():
+        rows = db.session.execute(select(column).order_by(table.c.id.desc()).limit(samples))
+        corpus.extend(value.encode('UTF-8') for (value,) in rows)
+
+    if not corpus:
+        raise click.ClickException("No stories to train on.")
+
+    try:
+        trained = zstd.train_dictionary(size, corpus)
+    except zstd.ZstdError as e:
+        raise click.ClickException(f"Could not train dictionary on {len(corpus)} samples: {e}")
+
+    os.makedirs(dict_dir(), exist_ok=True)
+
+    with open(os.path.join(dict_dir(), f"{trained.dict_id()}.zdict"), 'wb') as f:
+        f.write(trained.as_bytes())
+    with open(os.path.join(dict_dir(), 'current'), 'w') as f:
+        f.write(str(trained.dict_id()))
+
+    _compressors.clear()
+    click.echo(f"Trained dictionary {trained.dict_id()} on {len(corpus)} samples.")
+
+@compression_cli.command('migrate')
+@click.option('--batch-size', default=1000, help="Rows copied per transaction.")
+@click.option('--swap', is_flag=True, help="Swap the copies in for the text columns once they are complete.")
+def migrate(batch_size, swap):
+    """
+    Convert the story text columns from text to bytea on Postgres without locking the tables.
+
+    Each text column gets a bytea copy, '<column>_bin', kept up to date by a trigger while
+    existing rows are copied over in committed batches; the command can be interrupted and re-run.
+    A NOT NULL check on the copy is then validated without blocking writes. With --swap, the
+    copy replaces the text column in one short transaction, using the validated check instead of
+    scanning the table. Run the swap as the release step of the deploy that turns on
+    'STORY_COMPRESSION', then 'flask compression recompress' to compress the rows.
+    """
+
+    from models import db
+
+    if db.engine.dialect.name != 'postgresql':
+        click.echo("Only Postgres stores the columns as text; nothing to migrate.")
+        return
+
+    for table, column in compressed_columns():
+        name, copy = column.name, f"{column.name}_bin"
+        function, constraint = f"{table.name}_{copy}_sync", f"{table.name}_{copy}_not_null"
+
+        if column_type(db.session, table, name) == 'bytea':
+            click.echo(f"{table.name}.{name} is already bytea")
+            continue
+
+        db.session.execute(text("SET LOCAL lock_timeout = '5s'"))
+        db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {copy} bytea"))
+        db.session.execute(text(
+            f"CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ "
+            f"BEGIN NEW.{copy} := convert_to(NEW.{name}, 'UTF8'); RETURN NEW; END $$ LANGUAGE plpgsql"
+        ))
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {function} ON {table.name}"))
+        db.session.execute(text(
+            f"CREATE TRIGGER {function} BEFORE INSERT OR UPDATE OF {name} ON {table.name} "
+            f"FOR EACH ROW EXECUTE FUNCTION {function}()"
+        ))
+        db.session.commit()
+
+        last_id = total = 0
+        while True:
+            ids = db.session.execute(text(
+                f"UPDATE {table.name} SET {copy} = convert_to({name}, 'UTF8') WHERE id IN "
+                f"(SELECT id FROM {table.name} WHERE id > :last AND {copy} IS NULL ORDER BY id LIMIT :n) "
+                f"RETURNING id"
+            ), {'last': last_id, 'n': batch_size}).scalars().all()
+            db.session.commit()
+
+            if not ids:
+                break
+
+            last_id = max(ids)
+            total += len(ids)
+            click.echo(f"{table.name}.{name}: {total} rows copied")
+
+        exists = db.session.execute(text("SELECT 1 FROM pg_constraint WHERE conname = :c"), {'c': constraint}).scalar()
+        if not exists:
+            db.session.execute(text("SET LOCAL lock_timeout = '5s'"))
+            db.session.execute(text(
+                f"ALTER TABLE {table.name} ADD CONSTRAINT {constraint} CHECK ({copy} IS NOT NULL) NOT VALID"
+            ))
+            db.session.commit()
+        db.session.execute(text(f"ALTER TABLE {table.name} VALIDATE CONSTRAINT {constraint}"))
+        db.session.commit()
+
+        if not swap:
+            click.echo(f"{table.name}.{copy} is complete; run again with --swap to replace {name}")
+            continue
+
+        db.session.execute(text("SET LOCAL lock_timeout = '5s'"))
+        db.session.execute(text(f"DROP TRIGGER {function} ON {table.name}"))
+        db.session.execute(text(f"ALTER TABLE {table.name} DROP COLUMN {name}"))
+        db.session.execute(text(f"ALTER TABLE {table.name} RENAME COLUMN {copy} TO {name}"))
+        db.session.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {name} SET NOT NULL"))
+        db.session.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {constraint}"))
+        db.session.execute(text(f"DROP FUNCTION {function}()"))
+        db.session.commit()
+        click.echo(f"{table.name}.{name} swapped to bytea")
+
+@compression_cli.command('recompress')
+@click.option('--batch-size', default=500, help="Rows rewritten per transaction.")
+def recompress(batch_size):
+    """
+    Rewrite existing story text with the current compression settings, in batches.
+
+    On Postgres the columns must already have the type the settings call for: bytea (see
+    'flask compression migrate') with 'STORY_COMPRESSION' on, text with it off.
+    Rows are walked by primary key so the command can be interrupted and re-run safely.
+    """
+
+    from models import db
+
+    if db.engine.dialect.name == 'postgresql':
+        expected = 'bytea' if compression_enabled() else 'text'
+        for table, column in compressed_columns():
+            if column_type(db.session, table, column) != expected:
+                raise click.ClickException(
+                    f"{table.name}.{column.name} isn't {expected}; run 'flask compression migrate --swap' "
+                    f"and turn on STORY_COMPRESSION together.")
+
+    for table, column in compressed_columns():
+        last_id = 0
+        total = 0
+
+        while True:
+            rows = db.session.execute(
+                select(table.c.id, column).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            for id, value in rows:
+                db.session.execute(update(table).where(table.c.id == id).values({column.name: value}))
+
+            db.session.commit()
+            last_id = rows[-1][0]
+            total += len(rows)
+            click.echo(f"{table.name}.{column.name}: {total} rows rewritten")
+
+@compression_cli.command('report')
+@click.option('--batch-size', default=1000, help="Rows decoded per query.")
+def report(batch_size):
+    """
+    Report stored versus raw bytes for each compressed column, and the average decode cost per row.
+    """
+
+    from models import db
+
+    for table, column in compressed_columns():
+        raw_col = db.type_coerce(column, types.LargeBinary)
+        last_id = 0
+        rows_seen = stored = raw = decode_ns = 0
+
+        while True:
+            rows = db.session.execute(
+                select(table.c.id, raw_col).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            for id, value in rows:
+                value = value.encode('UTF-8') if isinstance(value, str) else bytes(value)
+                start = perf_counter_ns()
+                raw += len(decode(value).encode('UTF-8'))
+                decode_ns += perf_counter_ns() - start
+                stored += len(value)
+
+            rows_seen += len(rows)
+            last_id = rows[-1][0]
+
+        saved = 100 * (1 - stored / raw) if raw else 0
+        per_row = decode_ns / rows_seen / 1000 if rows_seen else 0
+        click.echo(f"{table.name}.{column.name}: {rows_seen} rows, {raw} raw bytes, {stored} stored bytes "
+                   f"({saved:.1f}% saved), {per_row:.1f}us decode per row")
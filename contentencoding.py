@@ -0,0 +1,383 @@
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+from werkzeug.security import safe_join
+from metrics import current_endpoint, RESPONSE_BYTES, RESPONSE_BYTES_SENT, COMPRESSION_CPU
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
+from mimetypes import guess_type
+from time import thread_time
+import gzip
+import zlib
+import click
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first, when the client accepts both equally.
+ENCODINGS = ('br', 'gzip')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+STATIC_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+
+# A compressed stream is flushed to the client after at least this much of the body went in.
+STREAM_FLUSH_BYTES = 16 * 1024
+
+def available_encodings():
+    """
+    Return the encodings this process can produce.
+
+    Returns:
+        list: Encoding names from ENCODINGS; brotli only if the brotli package is installed.
+    """
+
+    return [encoding for encoding in ENCODINGS if encoding != 'br' or brotli is not None]
+
+def negotiate(encodings):
+    """
+    Pick the encoding to send, from the request's Accept-Encoding.
+
+    Args:
+        encodings (list): The encodings that could be sent, preferred first.
+
+    Returns:
+        str or None: The accepted encoding with the highest quality, or None to send the body as is.
+    """
+
+    accepted = [(request.accept_encodings[encoding], -i, encoding) for i, encoding in enumerate(encodings)
+                if request.accept_encodings[encoding] > 0]
+
+    return max(accepted)[2] if accepted else None
+
+def compress(data, encoding):
+    """
+    Compress a response body at the configured level.
+
+    Args:
+        data (bytes): The body.
+        encoding (str): 'br' or 'gzip'.
+
+    Returns:
+        bytes: The compressed body.
+    """
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=current_app.config.get('RESPONSE_BROTLI_QUALITY', 4))
+
+    return gzip.compress(data, compresslevel=current_app.config.get('RESPONSE_GZIP_LEVEL', 6), mtime=0)
+
+def compress_stream(chunks, encoding, charset, endpoint, level):
+    """
+    Compress a streamed body as it is produced, like `library.gzip_chunks`.
+
+    The compressor is flushed whenever STREAM_FLUSH_BYTES of the body went in since the last
+    flush, so the client can start rendering before the stream ends, without flushing after
+    every one of the small pieces a template stream yields. Bytes and CPU time are counted per
+    endpoint as they go. The body is produced after the request ends, so nothing here reads
+    the app's config.
+
+    Args:
+        chunks (iterable): The body's pieces, as bytes or str.
+        encoding (str): 'br' or 'gzip'.
+        charset (str): The encoding of str pieces.
+        endpoint (str): The endpoint label for the metrics.
+        level (int): The brotli quality or gzip level.
+
+    Yields:
+        bytes: Pieces of the compressed body.
+    """
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        feed, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        feed, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    pending = 0
+
+    def account(data, cpu):
+        RESPONSE_BYTES_SENT.labels(endpoint, encoding).inc(len(data))
+        COMPRESSION_CPU.labels(endpoint, encoding).inc(cpu)
+        return data
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            RESPONSE_BYTES.labels(endpoint).inc(len(chunk))
+            pending += len(chunk)
+
+            start = thread_time()
+            data = feed(chunk)
+            if pending >= STREAM_FLUSH_BYTES:
+                data += flush()
+                pending = 0
+
+            if data:
+                yield account(data, thread_time() - start)
+
+        start = thread_time()
+        yield account(finish(), thread_time() - start)
+    finally:
+        # Closing the wrapped stream ends the request context 'stream_with_context' keeps.
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def compressible(response):
+    """
+    Check whether a response's body may be compressed on the fly.
+
+    Args:
+        response (Response): The response.
+
+    Returns:
+        bool: True for successful responses of a text-like type that aren't encoded yet, whether
+        complete or streamed.
+    """
+
+    return (not response.direct_passthrough
+            and response.status_code not in (204, 206, 304) and response.status_code >= 200
+            and 'Content-Encoding' not in response.headers
+            and (response.mimetype or '').startswith(COMPRESSIBLE_TYPES))
+
+def compress_response(response):
+    """
+    Compress dynamic responses with gzip or brotli, as negotiated with the client.
+
+    Bodies shorter than 'RESPONSE_COMPRESSION_MIN_BYTES' are sent as is. Streamed bodies, whose
+    length isn't known up front, are compressed as they are produced (see `compress_stream`). A
+    strong ETag becomes weak, since the compressed bytes differ from the identity ones, which
+    conditional requests still match; a 304 to a client that would be sent a compressed body
+    gets the same weak ETag, so it matches the one the client has. The time spent compressing a
+    complete body is reported in Server-Timing, and the bytes before and after compression and
+    the CPU time are counted per endpoint.
+
+    Args:
+        response (Response): The response.
+
+    Returns:
+        Response: The same response, possibly compressed.
+    """
+
+    if response.status_code == 304:
+        etag, weak = response.get_etag()
+        if etag and not weak and current_app.config.get('RESPONSE_COMPRESSION', True) and negotiate(available_encodings()):
+            response.vary.add('Accept-Encoding')
+            response.set_etag(etag, weak=True)
+        return response
+
+    if not compressible(response):
+        return response
+
+    endpoint = current_endpoint()
+
+    if response.is_streamed:
+        encoding = negotiate(available_encodings()) if current_app.config.get('RESPONSE_COMPRESSION', True) else None
+        response.vary.add('Accept-Encoding')
+
+        if encoding is not None:
+            level = current_app.config.get('RESPONSE_BROTLI_QUALITY', 4) if encoding == 'br' else current_app.config.get('RESPONSE_GZIP_LEVEL', 6)
+            response.response = compress_stream(response.response, encoding, response.charset, endpoint, level)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+
+            etag, weak = response.get_etag()
+            if etag and not weak:
+                response.set_etag(etag, weak=True)
+
+        return response
+    data = response.get_data()
+    RESPONSE_BYTES.labels(endpoint).inc(len(data))
+
+    encoding = None
+    if current_app.config.get('RESPONSE_COMPRESSION', True) and len(data) >= current_app.config.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024):
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(available_encodings())
+
+    if encoding is None:
+        RESPONSE_BYTES_SENT.labels(endpoint, 'identity').inc(len(data))
+        return response
+
+    start = thread_time()
+    compressed = compress(data, encoding)
+    cpu = thread_time() - start
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+    timing = f'compress;dur={cpu * 1000:.3f};desc="{encoding} {len(data)}>{len(compressed)}"'
+    response.headers['Server-Timing'] = ', '.join(filter(None, [response.headers.get('Server-Timing'), timing]))
+
+    RESPONSE_BYTES_SENT.labels(endpoint, encoding).inc(len(compressed))
+    COMPRESSION_CPU.labels(endpoint, encoding).inc(cpu)
+
+    return response
+
+def precompressed(filename):
+    """
+    Return the encodings a static file has up-to-date precompressed siblings for.
+
+    Args:
+        filename (str): The file's path relative to the static folder.
+
+    Returns:
+        list: Encoding names, preferred first.
+    """
+
+    path = safe_join(current_app.static_folder, filename)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except (TypeError, FileNotFoundError, NotADirectoryError):
+        return []
+
+    encodings = []
+    for encoding in ENCODINGS:
+        try:
+            if os.stat(path + SUFFIXES[encoding]).st_mtime >= mtime:
+                encodings.append(encoding)
+        except FileNotFoundError:
+            pass
+
+    return encodings
+
+def static_file(filename):
+    """
+    Serve a static file, from its precompressed '.br' or '.gz' sibling if the client accepts it.
+
+    Replaces Flask's static view. The siblings are written by 'flask encoding build-static';
+    without them, or if they are older than the file, the file is served as usual.
+
+    Args:
+        filename (str): The file's path relative to the static folder.
+
+    Returns:
+        Response: The file.
+    """
+
+    encodings = precompressed(filename)
+    encoding = negotiate(encodings) if encodings else None
+
+    if encoding is None:
+        response = current_app.send_static_file(filename)
+    else:
+        response = send_from_directory(current_app.static_folder, filename + SUFFIXES[encoding],
+                                       mimetype=guess_type(filename)[0] or 'application/octet-stream',
+                                       max_age=current_app.get_send_file_max_age(filename))
+        response.headers['Content-Encoding'] = encoding
+
+    if encodings:
+        response.vary.add('Accept-Encoding')
+
+    return response
+
+def init_content_encoding(app):
+    """
+    Compress an application's dynamic responses and serve its static files precompressed.
+
+    Args:
+        app (Flask application): The application.
+    """
+
+    app.after_request(compress_response)
+    app.view_functions['static'] = static_file
+
+def build_static(folder):
+    """
+    Write '.br' and '.gz' siblings, at maximum compression, for the text assets in a folder.
+
+    Siblings that wouldn't be smaller than the file are removed instead.
+
+    Args:
+        folder (str): The static folder.
+
+    Returns:
+        list: (path, original bytes, {encoding: bytes}) for each asset.
+    """
+
+    results = []
+
+    for root, dirs, files in os.walk(folder):
+        for name in sorted(files):
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            sizes = {}
+            for encoding in available_encodings():
+                compressed = brotli.compress(data, quality=11) if encoding == 'br' else gzip.compress(data, compresslevel=9, mtime=0)
+                sibling = path + SUFFIXES[encoding]
+
+                if len(compressed) < len(data):
+                    with open(f"{sibling}.{os.getpid()}.tmp", 'wb') as f:
+                        f.write(compressed)
+                    os.replace(f"{sibling}.{os.getpid()}.tmp", sibling)
+                    sizes[encoding] = len(compressed)
+                elif os.path.exists(sibling):
+                    os.remove(sibling)
+
+            results.append((os.path.relpath(path, folder), len(data), sizes))
+
+    return results
+
+# The metrics `report` reads, and what it calls them.
+REPORT_SAMPLES = {
+    'http_request_duration_seconds_count': 'requests',
+    'http_response_bytes_total': 'raw',
+    'http_response_bytes_sent_total': 'sent',
+    'response_compression_cpu_seconds_total': 'cpu',
+}
+
+encoding_cli = AppGroup('encoding', help="Manage compressed responses.")
+
+@encoding_cli.command('build-static')
+def build_static_command():
+    """
+    Precompress the static text assets. Run as part of every deploy.
+    """
+
+    for path, size, sizes in build_static(current_app.static_folder):
+        compressed = ', '.join(f"{encoding} {compressed}" for encoding, compressed in sizes.items()) or "not compressible"
+        click.echo(f"{path}: {size} bytes -> {compressed}")
+
+@encoding_cli.command('report')
+def report():
+    """
+    Report bytes on the wire and compression CPU time per endpoint, from the collected metrics.
+
+    With 'PROMETHEUS_MULTIPROC_DIR' set, every worker's traffic is included.
+    """
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    rows = {}
+    for family in registry.collect():
+        for sample in family.samples:
+            field = REPORT_SAMPLES.get(sample.name)
+            if field:
+                row = rows.setdefault(sample.labels['endpoint'], {})
+                row[field] = row.get(field, 0) + sample.value
+
+    click.echo(f"{'endpoint':<24} {'requests':>8} {'raw/req':>9} {'wire/req':>9} {'saved':>6} {'cpu/req':>9}")
+    for endpoint, row in sorted(rows.items(), key=lambda item: -item[1].get('raw', 0)):
+        if 'raw' not in row:
+            continue
+
+        count = row.get('requests') or 1
+        raw, sent = row.get('raw', 0), row.get('sent', 0)
+        click.echo(f"{endpoint:<24} {count:>8.0f} {raw / count / 1024:>7.1f}KB {sent / count / 1024:>7.1f}KB "
+                   f"{1 - sent / raw if raw else 0:>6.1%} {row.get('cpu', 0) / count * 1000:>7.2f}ms")
@@ -0,0 +1,208 @@
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, User, Story, Character, StoryNode, StoryTreeStats
+from pagecache import invalidate_story
+from analytics import mark_dirty
+from datetime import datetime
+from time import sleep
+import click
+
+def mark_story_deleted(story):
+    """
+    Delete a story as far as everyone can tell, leaving the rows to the reaper.
+
+    The story is hidden from every query at once (see `models._hide_deleted`), its tree is marked
+    for an analytics rebuild and its cached chains are dropped; no child row is touched. Its
+    continuations are cut off from the chain above it (see `Story.chain_cte`), and the rebuild
+    makes each of them the root of a tree of its own, with chain lengths counted from there.
+    Changes are committed.
+
+    Args:
+        story (Story): The story.
+    """
+
+    story_id = story.id
+    mark_dirty(story_id)
+    story.deleted_at = datetime.utcnow()
+    db.session.commit()
+
+    invalidate_story(story_id)
+
+def mark_user_deleted(user):
+    """
+    Delete an account as far as everyone can tell, leaving the rows to the reaper.
+
+    The user and all their stories are hidden with two UPDATEs whatever the size of the account,
+    and the username and email are released so they can be used to sign up again right away.
+    Cached chains through any of the stories are dropped. Changes are committed.
+
+    Args:
+        user (User): The user.
+    """
+
+    now = datetime.utcnow()
+
+    db.session.execute(
+        db.update(StoryTreeStats)
+        .where(StoryTreeStats.root_id.in_(
+            db.select(StoryNode.root_id).join(Story, Story.id == StoryNode.story_id).where(Story.author_id == user.id)
+        ))
+        .values(dirty=True)
+    )
+    ids = db.session.scalars(
+        db.update(Story).where(Story.author_id == user.id, Story.deleted_at.is_(None)).values(deleted_at=now)
+        .returning(Story.id)
+    ).all()
+
+    user.deleted_at = now
+    user.username = f"deleted-{user.id}"
+    user.email = f"deleted-{user.id}@invalid"
+    db.session.commit()
+
+    for id in ids:
+        invalidate_story(id)
+
+def batch_size():
+    return current_app.config.get('DELETION_BATCH', 500)
+
+def delete_stories(ids):
+    """
+    Remove stories' rows, letting the database cascade to their steps, choices and other children.
+
+    Their trees are marked for an analytics rebuild again, since a rebuild before now still
+    walked through them to the stories continued from them.
+
+    Args:
+        ids (list): The IDs of the stories.
+    """
+
+    db.session.execute(
+        db.update(StoryTreeStats)
+        .where(StoryTreeStats.root_id.in_(db.select(StoryNode.root_id).where(StoryNode.story_id.in_(ids))))
+        .values(dirty=True)
+    )
+    db.session.execute(db.delete(Story).where(Story.id.in_(ids)).execution_options(synchronize_session=False))
+    db.session.commit()
+
+    for id in ids:
+        invalidate_story(id)
+
+def reap_once():
+    """
+    Remove one batch of deleted rows, bottom-up.
+
+    Deleted stories go first, then the stories and characters of deleted users, and then the users
+    themselves once nothing of theirs is left, along with the small rows the database cascades to.
+    Each statement removes at most 'DELETION_BATCH' rows and is committed on its own, so no
+    transaction holds locks for long however big the account or story tree is.
+
+    Returns:
+        dict: The number of 'stories', 'characters' and 'users' removed.
+    """
+
+    removed = {'stories': 0, 'characters': 0, 'users': 0}
+
+    ids = db.session.scalars(
+        db.select(Story.id).where(Story.deleted_at.is_not(None)).limit(batch_size())
+        .execution_options(include_deleted=True)
+    ).all()
+    if ids:
+        delete_stories(ids)
+        removed['stories'] = len(ids)
+        return removed
+
+    user_id = db.session.scalar(
+        db.select(User.id).where(User.deleted_at.is_not(None)).order_by(User.deleted_at).limit(1)
+        .execution_options(include_deleted=True)
+    )
+    if user_id is None:
+        return removed
+
+    ids = db.session.scalars(
+        db.select(Story.id).where(Story.author_id == user_id).limit(batch_size())
+        .execution_options(include_deleted=True)
+    ).all()
+    if ids:
+        delete_stories(ids)
+        removed['stories'] = len(ids)
+        return removed
+
+    removed['characters'] = db.session.execute(
+        db.delete(Character)
+        .where(Character.id.in_(db.select(Character.id).where(Character.user_id == user_id).limit(batch_size())))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if removed['characters']:
+        db.session.commit()
+        return removed
+
+    removed['users'] = db.session.execute(
+        db.delete(User).where(User.id == user_id).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    return removed
+
+def reap():
+    """
+    Remove every deleted row, one batch at a time.
+
+    Returns:
+        dict: The number of 'stories', 'characters' and 'users' removed.
+    """
+
+    total = {'stories': 0, 'characters': 0, 'users': 0}
+
+    while True:
+        removed = reap_once()
+        if not any(removed.values()):
+            return total
+
+        for kind, count in removed.items():
+            total[kind] += count
+
+def pending():
+    """
+    Count the rows waiting for the reaper.
+
+    Returns:
+        dict: The number of deleted 'stories' and 'users' not removed yet.
+    """
+
+    return {
+        'stories': db.session.scalar(
+            db.select(db.func.count()).select_from(Story).where(Story.deleted_at.is_not(None))
+            .execution_options(include_deleted=True)),
+        'users': db.session.scalar(
+            db.select(db.func.count()).select_from(User).where(User.deleted_at.is_not(None))
+            .execution_options(include_deleted=True)),
+    }
+
+deletion_cli = AppGroup('deletion', help="Remove deleted accounts and stories.")
+
+@deletion_cli.command('reap')
+@click.option('--watch', is_flag=True, help="Keep running, reaping every interval.")
+@click.option('--interval', default=60, help="Seconds between passes with --watch.")
+def reap_command(watch, interval):
+    """
+    Remove the rows of deleted accounts and stories in batches of 'DELETION_BATCH'.
+
+    Relies on the database's ON DELETE CASCADE foreign keys for the rows below each story and user.
+    """
+
+    while True:
+        removed = reap()
+        click.echo(f"{removed['stories']} stories, {removed['characters']} characters, {removed['users']} users removed.")
+
+        if not watch:
+            break
+        sleep(interval)
+
+@deletion_cli.command('report')
+def report():
+    """
+    Show how many deleted accounts and stories are waiting to be removed.
+    """
+
+    waiting = pending()
+    click.echo(f"{waiting['stories']} stories and {waiting['users']} users waiting.")
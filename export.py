@@ -0,0 +1,259 @@
+from flask import current_app, render_template
+from flask.cli import AppGroup
+from models import db, Story, StoryStep, Choice
+from markupsafe import escape
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from itertools import groupby
+from io import BytesIO
+from time import sleep
+import zipfile
+import shutil
+import click
+import json
+import os
+
+def export_dir():
+    """
+    Return the directory static exports are written to.
+
+    Returns:
+        str: The 'EXPORT_DIR' config value, or 'export' in the app's instance folder.
+    """
+
+    return current_app.config.get('EXPORT_DIR') or os.path.join(current_app.instance_path, 'export')
+
+def chain_fingerprint(chain):
+    """
+    Fingerprint a chain by the identity and modification time of each of its stories.
+
+    The fingerprint changes whenever a story is added to, edited in, or removed from the chain,
+    without having to render anything.
+
+    Args:
+        chain (list): The Story objects in the chain, root first, or rows with their 'id',
+            'updated_at' and 'created_at'.
+
+    Returns:
+        str: A hex digest.
+    """
+
+    parts = [f"{story.id}:{(story.updated_at or story.created_at).isoformat()}" for story in chain]
+
+    return sha256('|'.join(parts).encode('UTF-8')).hexdigest()
+
+def finished_chain_fingerprints():
+    """
+    Fingerprint every finished chain at once, without loading any story text.
+
+    A single recursive query walks back from every finished story to the root of its chain,
+    reading only the ID and modification times of each story on the way, so checking which
+    exports are stale costs one query whatever the size of the library.
+
+    Returns:
+        dict: The fingerprint of each finished chain, keyed by the ID of its last story.
+    """
+
+    chains = (
+        db.select(Story.id.label('end_id'), Story.id.label('story_id'), db.literal(0).label('depth'))
+        .where(Story.end, Story.deleted_at.is_(None))
+        .cte('chains', recursive=True)
+    )
+    chains = chains.union_all(
+        db.select(chains.c.end_id, StoryStep.story_id, chains.c.depth + 1)
+        .join(Choice, Choice.to_story_id == chains.c.story_id)
+        .join(StoryStep, StoryStep.id == Choice.from_step_id)
+        .join(Story, Story.id == StoryStep.story_id)
+        .where(Story.deleted_at.is_(None))
+    )
+
+    rows = db.session.execute(
+        db.select(chains.c.end_id, Story.id, Story.updated_at, Story.created_at)
+        .join(chains, Story.id == chains.c.story_id)
+        .order_by(chains.c.end_id, chains.c.depth.desc())
+    )
+
+    return {end_id: chain_fingerprint(list(chain)) for end_id, chain in groupby(rows, key=lambda row: row.end_id)}
+
+def build_epub(chain):
+    """
+    Build a minimal EPUB 3 book from a chain, with one chapter per story.
+
+    Args:
+        chain (list): The Story objects in the chain, root first.
+
+    Returns:
+        bytes: The EPUB file.
+    """
+
+    title = escape(chain[0].title)
+    chapters = [f"chapter-{i}.xhtml" for i in range(1, len(chain) + 1)]
+    buffer = BytesIO()
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml',
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+            '</container>')
+
+        manifest = ''.join(f'<item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>'
+                           for i, name in enumerate(chapters, 1))
+        spine = ''.join(f'<itemref idref="c{i}"/>' for i in range(1, len(chapters) + 1))
+        epub.writestr('OEBPS/content.opf',
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="uid">cyoai-story-{chain[-1].id}</dc:identifier>'
+            f'<dc:title>{title}</dc:title><dc:language>en</dc:language>'
+            f'<meta property="dcterms:modified">{(chain[-1].updated_at or chain[-1].created_at).strftime("%Y-%m-%dT%H:%M:%SZ")}</meta>'
+            '</metadata>'
+            f'<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>{manifest}</manifest>'
+            f'<spine>{spine}</spine>'
+            '</package>')
+
+        links = ''.join(f'<li><a href="{name}">Chapter {i}</a></li>' for i, name in enumerate(chapters, 1))
+        epub.writestr('OEBPS/nav.xhtml',
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<head><title>{title}</title></head>'
+            f'<body><nav epub:type="toc"><ol>{links}</ol></nav></body></html>')
+
+        for i, (name, story) in enumerate(zip(chapters, chain), 1):
+            epub.writestr(f'OEBPS/{name}',
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<html xmlns="http://www.w3.org/1999/xhtml">'
+                f'<head><title>{title}</title></head>'
+                f'<body><h2>Chapter {i}</h2><p>{escape(story.start_content)}</p></body></html>')
+
+    return buffer.getvalue()
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def export_story(app, story_id, epub=False):
+    """
+    Export the chain ending at a story.
+
+    Runs in a worker thread, so it pushes its own application context. The fingerprint recorded
+    is that of the chain as loaded here, so an edit made since the caller's check is picked up
+    by the next run.
+
+    Args:
+        app (Flask application): The application to export from.
+        story_id (int): The ID of the finished story ending the chain.
+        epub (bool): Whether to also write an EPUB file.
+
+    Returns:
+        dict or None: The manifest entry for the export, with 'fingerprint', 'html' and optionally 'epub'
+        paths relative to the export directory, or None if the chain is broken.
+    """
+
+    with app.app_context():
+        try:
+            chain = Story.get_story_chain(story_id)
+        except ValueError:
+            return None
+
+        story_dir = os.path.join(export_dir(), 'stories', str(story_id))
+        os.makedirs(story_dir, exist_ok=True)
+
+        html = render_template('/stories/export.html', chain=chain).encode('UTF-8')
+        entry = {'fingerprint': chain_fingerprint(chain),
+                 'html': f"stories/{story_id}/{sha256(html).hexdigest()[:16]}.html"}
+        _write_atomic(os.path.join(export_dir(), entry['html']), html)
+        _write_atomic(os.path.join(story_dir, 'index.html'), html)
+
+        if epub:
+            book = build_epub(chain)
+            entry['epub'] = f"stories/{story_id}/{sha256(book).hexdigest()[:16]}.epub"
+            _write_atomic(os.path.join(export_dir(), entry['epub']), book)
+
+        keep = {os.path.basename(entry['html']), os.path.basename(entry.get('epub', '')), 'index.html'}
+        for name in os.listdir(story_dir):
+            if name not in keep and not name.endswith('.tmp'):
+                os.remove(os.path.join(story_dir, name))
+
+        return entry
+
+def export_finished_stories(epub=False, workers=4):
+    """
+    Export every finished chain, rebuilding only the ones that changed since the last run.
+
+    Stale chains are found from `finished_chain_fingerprints`, and only those are loaded and
+    exported, on a bounded thread pool. Exports of chains that no longer exist (their last
+    story was deleted) are removed. The manifest at 'manifest.json' in the export
+    directory records the fingerprint and file names of each export.
+
+    Args:
+        epub (bool): Whether to also write EPUB files.
+        workers (int): The maximum number of chains exported concurrently.
+
+    Returns:
+        tuple: The number of chains (rebuilt, unchanged, removed).
+    """
+
+    manifest_path = os.path.join(export_dir(), 'manifest.json')
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    fingerprints = finished_chain_fingerprints()
+    db.session.remove()
+
+    new_manifest, stale = {}, []
+    for id, fingerprint in fingerprints.items():
+        previous = manifest.get(str(id))
+        if previous and previous['fingerprint'] == fingerprint and (previous.get('epub') or not epub):
+            new_manifest[str(id)] = previous
+        else:
+            stale.append(id)
+
+    app = current_app._get_current_object()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = pool.map(lambda id: export_story(app, id, epub), stale)
+        new_manifest.update((str(id), entry) for id, entry in zip(stale, entries) if entry is not None)
+
+    new_manifest = {str(id): new_manifest[str(id)] for id in fingerprints if str(id) in new_manifest}
+    rebuilt = sum(1 for id in stale if str(id) in new_manifest)
+    removed = [id for id in manifest if id not in new_manifest]
+
+    for id in removed:
+        shutil.rmtree(os.path.join(export_dir(), 'stories', id), ignore_errors=True)
+
+    os.makedirs(export_dir(), exist_ok=True)
+    _write_atomic(manifest_path, json.dumps(new_manifest, indent=1).encode('UTF-8'))
+
+    return rebuilt, len(new_manifest) - rebuilt, len(removed)
+
+export_cli = AppGroup('export', help="Pre-render finished stories to static files.")
+
+@export_cli.command('stories')
+@click.option('--epub', is_flag=True, help="Also write EPUB files.")
+@click.option('--workers', default=4, help="Maximum number of chains exported concurrently.")
+@click.option('--watch', is_flag=True, help="Keep running, re-exporting changed chains every interval.")
+@click.option('--interval', default=300, help="Seconds between passes with --watch.")
+def export_stories(epub, workers, watch, interval):
+    """
+    Write self-contained HTML (and optionally EPUB) files for every finished story chain.
+
+    The output directory can be served directly by nginx: each chain is available at
+    'stories/<id>/index.html', alongside content-hashed copies that are safe to cache forever.
+    """
+
+    while True:
+        rebuilt, unchanged, removed = export_finished_stories(epub=epub, workers=workers)
+        click.echo(f"{rebuilt} rebuilt, {unchanged} unchanged, {removed} removed.")
+
+        if not watch:
+            break
+        sleep(interval)
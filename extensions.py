@@ -0,0 +1,51 @@
+from flask import current_app
+import click
+
+def get_mail():
+    """
+    Return the app's Flask-Mail instance, importing and initializing Flask-Mail on first use.
+
+    Returns:
+        Mail: The Mail instance bound to the current app.
+    """
+
+    if 'mail_instance' not in current_app.extensions:
+        from flask_mail import Mail
+
+        current_app.extensions['mail_instance'] = Mail(current_app._get_current_object())
+
+    return current_app.extensions['mail_instance']
+
+class LazyMigrateGroup(click.MultiCommand):
+    """
+    Stand-in for Flask-Migrate's 'flask db' command group.
+
+    Importing Flask-Migrate pulls in Alembic, which only the 'flask db' commands need. This group
+    takes its place on the app's CLI and initializes Flask-Migrate, then delegates to its real
+    command group, only when a 'flask db' command is actually listed or run.
+
+    Args:
+        app (Flask application): The application to migrate.
+        db (SQLAlchemy): The database extension holding the models' metadata.
+    """
+
+    def __init__(self, app, db):
+        super().__init__('db', help="Perform database migrations.")
+        self.app = app
+        self.db = db
+
+    def _group(self):
+        if 'migrate' not in self.app.extensions:
+            from flask_migrate import Migrate
+
+            Migrate(self.app, self.db)
+
+        from flask_migrate.cli import db as db_cli_group
+
+        return db_cli_group
+
+    def list_commands(self, ctx):
+        return self._group().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._group().get_command(ctx, name)
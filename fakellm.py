@@ -0,0 +1,148 @@
+from threading import Lock
+import random
+import asyncio
+import time
+import json
+
+# Median latency in seconds per model; 'FAKE_LLM_LATENCY' adds to or overrides these.
+LATENCY = {
+    "gpt-3.5-turbo": 6.0,
+    "gpt-3.5-turbo-16k": 7.0,
+    "gpt-4": 18.0,
+}
+
+SLOW_RATE = 0.05
+SLOW_FACTOR = 4
+
+settings = {'latency': dict(LATENCY), 'time_scale': 1.0}
+
+calls = []
+in_flight = 0
+_lock = Lock()
+
+def configure(config):
+    """
+    Apply the app's fake backend settings.
+
+    Args:
+        config (Config): The app config; reads 'FAKE_LLM_LATENCY' and 'FAKE_LLM_TIME_SCALE'.
+    """
+
+    settings['latency'] = {**LATENCY, **config.get('FAKE_LLM_LATENCY', {})}
+    settings['time_scale'] = config.get('FAKE_LLM_TIME_SCALE', 1.0)
+
+def delay(model):
+    """
+    Draw a simulated latency: log-normal around the model's median, with occasional stalls.
+
+    Args:
+        model (str): The model name.
+
+    Returns:
+        float: Seconds to wait, already scaled by 'FAKE_LLM_TIME_SCALE'.
+    """
+
+    seconds = random.lognormvariate(0, 0.25) * settings['latency'].get(model, LATENCY["gpt-3.5-turbo"])
+    if random.random() < SLOW_RATE:
+        seconds *= SLOW_FACTOR
+
+    return seconds * settings['time_scale']
+
+def fake_arguments(function):
+    arguments = {}
+
+    for name, schema in function["parameters"]["properties"].items():
+        if schema["type"] == "string":
+            arguments[name] = "Lorem ipsum " * (220 if name == 'start_content' else 3)
+        elif schema["type"] == "array":
+            arguments[name] = [f"Go down path {i}." for i in range(1, schema.get("maxItems", 2) + 1)]
+        elif schema["type"] == "boolean":
+            arguments[name] = random.random() < 0.1
+
+    if arguments.get('end'):
+        arguments['choices'] = []
+
+    return json.dumps(arguments)
+
+def answer(model, messages, functions=None, function_call=None, n=1, **kwargs):
+    """
+    Build a response calling the requested function with placeholder arguments.
+
+    Args:
+        model (str): The model name.
+        messages (list): The chat messages.
+        functions (list, optional): The function schemas offered.
+        function_call (dict, optional): The function the model must call.
+        n (int, optional): The number of candidates to return.
+
+    Returns:
+        dict: A response shaped like the chat completions API's.
+    """
+
+    function = next(function for function in functions if function["name"] == function_call["name"])
+    contents = [fake_arguments(function) for _ in range(n)]
+
+    return {
+        "model": model,
+        "choices": [{"index": i, "message": {"role": "assistant", "content": None,
+                                             "function_call": {"name": function["name"], "arguments": content}}}
+                    for i, content in enumerate(contents)],
+        "usage": {"prompt_tokens": sum(len(message["content"]) for message in messages) // 4,
+                  "completion_tokens": sum(len(content) for content in contents) // 4},
+    }
+
+def _start():
+    global in_flight
+    with _lock:
+        in_flight += 1
+
+def _finish(model, response):
+    global in_flight
+    with _lock:
+        in_flight -= 1
+        calls.append({'model': model, **response['usage']})
+
+def cost(entry, prices):
+    """
+    Return the cost of a recorded call.
+
+    Args:
+        entry (dict): An entry of `calls`.
+        prices (dict): (prompt, completion) dollars per 1,000 tokens, by model.
+
+    Returns:
+        float: Dollars.
+    """
+
+    prompt, completion = prices.get(entry['model'], (0, 0))
+    return (entry['prompt_tokens'] * prompt + entry['completion_tokens'] * completion) / 1000
+
+class ChatCompletion:
+    """
+    Simulated stand-in for `openai.ChatCompletion`.
+
+    Used in place of the openai module when 'LLM_BACKEND' is 'fake'. Completions answer the
+    requested function with placeholder text after a random, long-tailed delay, and report token
+    usage like the real API, so routing, hedging and cost accounting can be exercised locally and
+    by 'flask llm report' without spending anything.
+    """
+
+    @classmethod
+    def create(cls, model, **kwargs):
+        _start()
+        response = answer(model, **kwargs)
+        try:
+            time.sleep(delay(model))
+        finally:
+            _finish(model, response)
+        return response
+
+    @classmethod
+    async def acreate(cls, model, **kwargs):
+        _start()
+        response = answer(model, **kwargs)
+        try:
+            await asyncio.sleep(delay(model))
+        finally:
+            _finish(model, response)
+        return response
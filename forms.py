@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, EmailField, PasswordField, TextAreaField, SelectMultipleField
 from wtforms.validators import ValidationError, DataRequired, Email, Length, EqualTo
 from wtforms.widgets import CheckboxInput, ListWidget
@@ -6,6 +7,10 @@ from models import User, Character
 from flask_login import current_user
 import re
 
+# Image uploads are checked again, by content, when they are stored (see 'media.py').
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'webp']
+IMAGE_MESSAGE = "Upload a PNG, JPEG, GIF or WebP image."
+
 class UniqueUser(object):
     """
     Validator to check if a username already exists.
@@ -138,6 +143,7 @@ class EditUserForm(FlaskForm):
         last_name (StringField): Field for the last name. This field is required.
         email (EmailField): Field for the email address. This field is required and must contain a valid email format.
         image_url (StringField): Optional field for a profile image URL.
+        image_file (FileField): Optional profile image upload, used instead of the URL.
         password (PasswordField): Field for the password. This field is required and its length must be at least 8 characters.
     """
     
@@ -146,6 +152,7 @@ class EditUserForm(FlaskForm):
     email = EmailField('E-mail', validators=[DataRequired(), 
                                              Email()])
     image_url = StringField('(Optional) Profile Image URL')
+    image_file = FileField('(Optional) Upload a profile image', validators=[FileAllowed(IMAGE_EXTENSIONS, IMAGE_MESSAGE)])
     password = PasswordField('Password', validators=[DataRequired(),
                                                      Length(min=8)])
     
@@ -188,6 +195,7 @@ class CharacterForm(FlaskForm):
                                      It also uses the `UniquePerUser` custom validator to ensure unique character names per user.
         description (wtforms.TextAreaField): Field to input the character's description. Requires data and has a length limit.
         image_url (wtforms.StringField): Optional field to input a URL for a character image.
+        img_file (flask_wtf.file.FileField): Optional character image upload, used instead of the URL.
 
     Note:
         This form does not handle the submission of data to the database itself, 
@@ -200,6 +208,7 @@ class CharacterForm(FlaskForm):
     description = TextAreaField('Description', validators=[DataRequired(),
                                                            Length(max=250)])
     img_url = StringField('(Optional) Character Image URL')
+    img_file = FileField('(Optional) Upload a character image', validators=[FileAllowed(IMAGE_EXTENSIONS, IMAGE_MESSAGE)])
 
 class GenreLimit(object):
     """
@@ -0,0 +1,54 @@
+import multiprocessing
+import shutil
+import os
+
+# Each worker writes its metrics here so /metrics can aggregate across all of them. This has to
+# be set before prometheus_client is first imported.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/cyoai-metrics")
+
+wsgi_app = "app:create_app()"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+# Import the app once in the master so workers share its code pages copy-on-write.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+def on_starting(server):
+    """
+    Start every run with an empty metrics directory.
+    """
+
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+def when_ready(server):
+    """
+    Warm the lazily imported subsystems in the master when preloading, so every worker
+    inherits them already imported instead of importing its own copy on first use.
+    """
+
+    if preload_app:
+        import openai
+        import flask_mail
+
+def post_fork(server, worker):
+    """
+    Drop any database connections inherited from the master; each worker opens its own.
+    """
+
+    if not server.cfg.preload_app:
+        return
+
+    from models import db
+
+    with worker.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+
+def child_exit(server, worker):
+    """
+    Tell the metrics collector a worker is gone, so its live samples stop being reported.
+    """
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,363 @@
+from flask import current_app, send_from_directory, url_for, abort
+from flask.cli import AppGroup
+from models import Story, Character, User
+from markupsafe import Markup, escape
+from hashlib import sha256
+from io import BytesIO
+import click
+import json
+import re
+import os
+
+# Widths, in pixels, of the variants built for each image; images are never enlarged.
+WIDTHS = (40, 64, 160, 320, 640, 960, 1280, 1920)
+
+# Preferred first: browsers take the first <source> whose type they support.
+FORMATS = ('avif', 'webp')
+QUALITY = {'avif': 55, 'webp': 78}
+
+SOURCE_PREFIX = '/static/images/'
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Variant file names contain a hash of their content, so they can be cached forever.
+CACHE_SECONDS = 365 * 24 * 3600
+
+_manifest = {'mtime': None, 'entries': {}}
+
+def build_dir():
+    """
+    Return the directory image variants and their manifest are written to.
+
+    Returns:
+        str: The 'IMAGE_BUILD_DIR' config value, or 'images' in the app's instance folder.
+    """
+
+    return current_app.config.get('IMAGE_BUILD_DIR') or os.path.join(current_app.instance_path, 'images')
+
+def source_dir():
+    return os.path.join(current_app.static_folder, 'images')
+
+def formats():
+    """
+    Return the variant formats this Pillow build can write.
+
+    Returns:
+        list: Format names from FORMATS, best first.
+    """
+
+    try:
+        from PIL import features
+    except ImportError:
+        return []
+
+    return [format for format in FORMATS if features.check(format)]
+
+def manifest():
+    """
+    Return the variants built for each source image, reloading the manifest when it changes.
+
+    Returns:
+        dict: Manifest entries by source file name, as written by `build_images`. Empty if
+        nothing was built.
+    """
+
+    path = os.path.join(build_dir(), 'manifest.json')
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return {}
+
+    if mtime != _manifest['mtime']:
+        with open(path) as f:
+            _manifest['entries'] = json.load(f)
+        _manifest['mtime'] = mtime
+
+    return _manifest['entries']
+
+def encode(image, format):
+    buffer = BytesIO()
+    image.save(buffer, format=format.upper(), quality=QUALITY[format])
+    return buffer.getvalue()
+
+def build_image(path, previous=None):
+    """
+    Build resized variants of one image in every supported format.
+
+    Args:
+        path (str): The source image.
+        previous (dict, optional): The image's manifest entry from the last build, reused if the
+            source is unchanged and every variant file still exists.
+
+    Returns:
+        dict: The manifest entry: the source's 'hash', 'width', 'height' and 'bytes', and
+        'variants', a list of {'format', 'width', 'file', 'bytes'} sorted by format and width.
+    """
+
+    with open(path, 'rb') as f:
+        source_hash = sha256(f.read()).hexdigest()
+
+    if (previous and previous['hash'] == source_hash
+            and all(os.path.exists(os.path.join(build_dir(), variant['file'])) for variant in previous['variants'])
+            and {variant['format'] for variant in previous['variants']} == set(formats())):
+        return previous
+
+    from PIL import Image
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    entry = {'hash': source_hash, 'bytes': os.path.getsize(path), 'variants': []}
+
+    with Image.open(path) as image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        entry['width'], entry['height'] = image.size
+
+        for width in [width for width in WIDTHS if width < image.width] + [image.width]:
+            resized = image if width == image.width else image.resize(
+                (width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+            for format in formats():
+                data = encode(resized, format)
+                name = f"{stem}-{width}.{sha256(data).hexdigest()[:12]}.{format}"
+
+                if not os.path.exists(os.path.join(build_dir(), name)):
+                    tmp_path = os.path.join(build_dir(), f"{name}.{os.getpid()}.tmp")
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, os.path.join(build_dir(), name))
+
+                entry['variants'].append({'format': format, 'width': width, 'file': name, 'bytes': len(data)})
+
+    entry['variants'].sort(key=lambda variant: (FORMATS.index(variant['format']), variant['width']))
+    return entry
+
+def build_images():
+    """
+    Build variants of every image in 'static/images', rebuilding only the ones that changed.
+
+    Variant files no longer listed in the manifest are removed.
+
+    Returns:
+        dict: The new manifest.
+    """
+
+    try:
+        import PIL
+    except ImportError:
+        raise click.ClickException("Building image variants requires Pillow.")
+
+    os.makedirs(build_dir(), exist_ok=True)
+    previous = manifest()
+
+    entries = {}
+    for name in sorted(os.listdir(source_dir())):
+        if name.lower().endswith(SOURCE_EXTENSIONS):
+            entries[name] = build_image(os.path.join(source_dir(), name), previous.get(name))
+
+    keep = {variant['file'] for entry in entries.values() for variant in entry['variants']} | {'manifest.json'}
+    for name in os.listdir(build_dir()):
+        if name not in keep and not name.endswith('.tmp'):
+            os.remove(os.path.join(build_dir(), name))
+
+    path = os.path.join(build_dir(), 'manifest.json')
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(entries, f, indent=1)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    return entries
+
+def lookup(src):
+    """
+    Return the manifest entry for an image URL, if variants were built for it.
+
+    Images in the local image store have their thumbnails looked up in 'media.py' instead.
+
+    Args:
+        src (str): The image URL, such as '/static/images/library3.png'.
+
+    Returns:
+        dict or None: The manifest entry, or None for other URLs and unbuilt images.
+    """
+
+    # media imports this module, so it's imported here.
+    from media import MEDIA_PREFIX, stored_entry
+
+    if src and src.startswith(MEDIA_PREFIX):
+        return stored_entry(src)
+
+    if not src or not src.startswith(SOURCE_PREFIX):
+        return None
+
+    return manifest().get(src[len(SOURCE_PREFIX):])
+
+def responsive_image(src, alt='', width=None, sizes=None, **attributes):
+    """
+    Render an image as a <picture> offering resized AVIF and WebP variants.
+
+    Available in templates as `responsive_image()`. The browser picks the best format it supports
+    and the smallest variant that covers the displayed size; the original stays the fallback.
+    Images without built variants, such as external URLs not fetched yet, render as a plain <img>.
+
+    Args:
+        src (str): The image URL.
+        alt (str, optional): The alternative text.
+        width (int, optional): The width the image is displayed at, in CSS pixels.
+        sizes (str, optional): The 'sizes' attribute, for images whose width depends on the
+            viewport. Defaults to the width, or '100vw'.
+        **attributes: Other attributes for the <img>; 'class_' sets its class.
+
+    Returns:
+        Markup: The HTML.
+    """
+
+    html_attributes = ''.join(f' {name.rstrip("_").replace("_", "-")}="{escape(value)}"'
+                              for name, value in attributes.items())
+    img = Markup(f'<img src="{escape(src)}" alt="{escape(alt)}"{html_attributes}>')
+
+    entry = lookup(src)
+    if entry is None:
+        return img
+
+    sizes = sizes or (f"{width}px" if width else "100vw")
+    sources = ''
+    for format in FORMATS:
+        srcset = ', '.join(f"{variant.get('url') or url_for('image_variant', filename=variant['file'])} {variant['width']}w"
+                           for variant in entry['variants'] if variant['format'] == format)
+        if srcset:
+            sources += f'<source type="image/{format}" srcset="{srcset}" sizes="{escape(sizes)}">'
+
+    return Markup(f'<picture>{sources}{img}</picture>')
+
+def image_variant(filename):
+    """
+    Serve a built image variant with far-future, immutable caching.
+
+    Args:
+        filename (str): The variant's file name.
+
+    Returns:
+        Response: The image.
+    """
+
+    if filename == 'manifest.json':
+        abort(404)
+
+    response = send_from_directory(build_dir(), filename, max_age=CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+def init_images(app):
+    """
+    Add the '/img/<filename>' route for image variants and the `responsive_image` template helper.
+
+    Args:
+        app (Flask application): The application.
+    """
+
+    app.add_url_rule('/img/<path:filename>', view_func=image_variant)
+    app.jinja_env.globals['responsive_image'] = responsive_image
+
+def chosen_variant(entry, width):
+    """
+    Return the variant a browser with support for every format would download.
+
+    Args:
+        entry (dict): The manifest entry.
+        width (int): The displayed width in device pixels.
+
+    Returns:
+        dict: The smallest variant of the best format at least `width` wide, or the largest.
+    """
+
+    best = [variant for variant in entry['variants'] if variant['format'] == entry['variants'][0]['format']]
+
+    return next((variant for variant in best if variant['width'] >= width), best[-1])
+
+# Where templates take images from a column, the page weight is estimated with its default.
+COLUMN_DEFAULTS = {'story.img_url': Story.__table__.c.img_url, 'character.img_url': Character.__table__.c.img_url,
+                   'current_user.image_url': User.__table__.c.image_url}
+
+def page_images(template):
+    """
+    Find the images a template displays through `responsive_image`, including its base templates.
+
+    Args:
+        template (str): The template name.
+
+    Returns:
+        list: (source file name, displayed width or None) tuples.
+    """
+
+    source = current_app.jinja_env.loader.get_source(current_app.jinja_env, template)[0]
+    images = []
+
+    for args in re.findall(r"responsive_image\(([^)]*)\)", source):
+        src = args.split(',')[0].strip()
+        width = re.search(r"width=(\d+)", args)
+
+        if src[0] in '\'"':
+            url = src.strip('\'"')
+        elif src in COLUMN_DEFAULTS:
+            url = COLUMN_DEFAULTS[src].default.arg
+        else:
+            continue
+
+        if url.startswith(SOURCE_PREFIX):
+            images.append((url[len(SOURCE_PREFIX):], int(width.group(1)) if width else None))
+
+    parent = re.search(r"{%\s*extends\s+['\"]([^'\"]+)['\"]", source)
+    if parent:
+        images += page_images(parent.group(1))
+
+    return images
+
+images_cli = AppGroup('images', help="Build optimized image variants.")
+
+@images_cli.command('build')
+def build():
+    """
+    Write resized AVIF and WebP variants of 'static/images' with content-hashed names.
+
+    Run as part of every deploy; unchanged images are skipped. The output directory can also be
+    served by nginx at '/img/'.
+    """
+
+    entries = build_images()
+    built = sum(len(entry['variants']) for entry in entries.values())
+    click.echo(f"{len(entries)} images, {built} variants in {', '.join(formats())} written to {build_dir()}.")
+
+@images_cli.command('report')
+@click.option('--viewport', default=1280, help="Viewport width in CSS pixels, for full-width images.")
+@click.option('--dpr', default=1.0, help="Device pixel ratio.")
+def report(viewport, dpr):
+    """
+    Report the image bytes each page downloads before and after optimization.
+
+    A page's images are found in its template and the templates it extends; each distinct image
+    is counted once, as the browser caches it.
+    """
+
+    entries = manifest()
+    if not entries:
+        raise click.ClickException("No image variants; run 'flask images build' first.")
+
+    pages = sorted(name for name in current_app.jinja_env.list_templates()
+                   if name.endswith('.html') and not name.startswith(('admin/', 'base')))
+
+    click.echo(f"{'page':<28} {'images':>6} {'original':>10} {'optimized':>10} {'saved':>6}")
+    for page in pages:
+        images = {}
+        for name, width in page_images(page):
+            if name in entries:
+                images[name] = max(images.get(name, 0), round((width or viewport) * dpr))
+
+        if not images:
+            continue
+
+        original = sum(entries[name]['bytes'] for name in images)
+        optimized = sum(chosen_variant(entries[name], width)['bytes'] for name, width in images.items())
+        click.echo(f"{page:<28} {len(images):>6} {original / 1024:>8.0f}KB {optimized / 1024:>8.0f}KB "
+                   f"{1 - optimized / original:>6.1%}")
@@ -0,0 +1,259 @@
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, User, Story, StoryStep, Choice, StoryCharacters, Character, excerpt_of, word_count
+from datetime import datetime
+import zlib
+import gzip
+import click
+import json
+
+FORMAT_VERSION = 1
+
+# The kinds of rows in an export, in the order they are written and must be imported, with
+# the columns left out because they belong to the exporting account or instance.
+KINDS = {
+    'character': (Character, {'user_id'}),
+    'story': (Story, {'author_id', 'deleted_at'}),
+    'story_step': (StoryStep, set()),
+    'choice': (Choice, set()),
+    'story_character': (StoryCharacters, set()),
+}
+
+# The IDs each kind refers to, by column, and the kind they are IDs of. A row whose required
+# reference isn't in the export is skipped; other references to rows outside it, such as a
+# choice continued by another user's story, are cleared.
+REFERENCES = {
+    'story_step': {'story_id': 'story'},
+    'choice': {'story_id': 'story', 'from_step_id': 'story_step', 'to_story_id': 'story'},
+    'story_character': {'story_id': 'story', 'character_id': 'character'},
+}
+REQUIRED = {'story_step': 'story_id', 'choice': 'from_step_id', 'story_character': 'story_id'}
+
+def batch_size():
+    return current_app.config.get('LIBRARY_BATCH', 1000)
+
+def library_queries(user_id):
+    """
+    Build the queries for every row of a user's library, one per kind.
+
+    Deleted stories and the rows below them are left out.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        list: (kind, select) pairs, in the order of KINDS.
+    """
+
+    live = (Story.author_id == user_id, Story.deleted_at.is_(None))
+    queries = {
+        'character': db.select(Character.__table__).where(Character.user_id == user_id),
+        'story': db.select(Story.__table__).where(*live),
+        'story_step': db.select(StoryStep.__table__).join(Story, Story.id == StoryStep.story_id).where(*live),
+        'choice': (db.select(Choice.__table__).join(StoryStep, StoryStep.id == Choice.from_step_id)
+                   .join(Story, Story.id == StoryStep.story_id).where(*live)),
+        'story_character': (db.select(StoryCharacters.__table__)
+                            .join(Story, Story.id == StoryCharacters.story_id).where(*live)),
+    }
+
+    return [(kind, queries[kind]) for kind in KINDS]
+
+def _encode(value):
+    return value.isoformat()
+
+def export_lines(user):
+    """
+    Write a user's library as JSON lines, streaming the rows from the database.
+
+    Each kind of row is read with a server-side cursor 'LIBRARY_BATCH' rows at a time, as plain
+    rows rather than model objects, so the memory an export takes doesn't grow with the library.
+    The first line describes the export; every other line is one row, with its 'kind'.
+
+    Args:
+        user (User): The user.
+
+    Yields:
+        str: A line of JSON, ending with a newline.
+    """
+
+    yield json.dumps({'kind': 'library', 'version': FORMAT_VERSION, 'username': user.username,
+                      'exported_at': datetime.utcnow().isoformat()}) + '\n'
+
+    for kind, query in library_queries(user.id):
+        skip = KINDS[kind][1]
+        for row in db.session.execute(query.execution_options(yield_per=batch_size())):
+            data = {key: value for key, value in row._mapping.items() if key not in skip}
+            data['kind'] = kind
+            yield json.dumps(data, default=_encode) + '\n'
+
+def gzip_chunks(lines, level=6):
+    """
+    Compress lines of text into a gzip stream as they are produced.
+
+    Args:
+        lines (iterable): The lines.
+        level (int, optional): The compression level.
+
+    Yields:
+        bytes: Pieces of the gzip file, whenever the compressor has some ready.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for line in lines:
+        chunk = compressor.compress(line.encode('UTF-8'))
+        if chunk:
+            yield chunk
+
+    yield compressor.flush()
+
+def _decode(kind, data):
+    model = KINDS[kind][0]
+    row = {}
+
+    for column in model.__table__.columns:
+        if column.key not in data or column.key in KINDS[kind][1]:
+            continue
+
+        value = data[column.key]
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        row[column.key] = value
+
+    return row
+
+def insert_batch(kind, batch, ids, user_id):
+    """
+    Insert a batch of exported rows of one kind with a single bulk INSERT, under new IDs.
+
+    References to rows imported earlier are rewritten to their new IDs, and the new ID of each
+    row is recorded in `ids` for the rows imported after it.
+
+    Args:
+        kind (str): The kind of the rows.
+        batch (list): The rows, as decoded from the export.
+        ids (dict): Maps each kind to a dict of {exported ID: new ID}; updated in place.
+        user_id (int): The ID of the user importing the rows.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+
+    model = KINDS[kind][0]
+    old_ids, rows = [], []
+
+    for row in batch:
+        for column, target in REFERENCES.get(kind, {}).items():
+            row[column] = ids[target].get(row.get(column))
+
+        if kind in REQUIRED and row[REQUIRED[kind]] is None:
+            continue
+
+        if kind == 'character':
+            row['user_id'] = user_id
+        elif kind == 'story':
+            row['author_id'] = user_id
+            row['excerpt'], row['word_count'] = excerpt_of(row['start_content']), word_count(row['start_content'])
+
+        old_ids.append(row.pop('id'))
+        rows.append(row)
+
+    if not rows:
+        return 0
+
+    new_ids = db.session.scalars(db.insert(model).returning(model.id, sort_by_parameter_order=True), rows).all()
+    ids[kind].update(zip(old_ids, new_ids))
+
+    return len(rows)
+
+def import_lines(lines, user):
+    """
+    Add the rows of an exported library to a user's account, in one transaction.
+
+    Rows are inserted 'LIBRARY_BATCH' at a time with bulk INSERTs, so only one batch and the map
+    from exported to new IDs are held in memory. Nothing is committed.
+
+    Args:
+        lines (iterable): The lines of the export, as written by `export_lines`.
+        user (User): The user to import into.
+
+    Returns:
+        dict: The number of rows inserted per kind.
+
+    Raises:
+        ValueError: If the lines aren't a library export this version can read.
+    """
+
+    lines = iter(lines)
+    header = json.loads(next(lines, 'null'))
+    if not isinstance(header, dict) or header.get('kind') != 'library' or header.get('version') != FORMAT_VERSION:
+        raise ValueError("Not a library export, or from an unsupported version.")
+
+    ids = {kind: {} for kind in KINDS}
+    counts = {kind: 0 for kind in KINDS}
+    kind, batch = None, []
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        data = json.loads(line)
+        if data.get('kind') not in KINDS:
+            raise ValueError(f"Unknown kind of row: {data.get('kind')!r}.")
+
+        if batch and (data['kind'] != kind or len(batch) >= batch_size()):
+            counts[kind] += insert_batch(kind, batch, ids, user.id)
+            batch = []
+
+        kind = data['kind']
+        batch.append(_decode(kind, data))
+
+    if batch:
+        counts[kind] += insert_batch(kind, batch, ids, user.id)
+
+    return counts
+
+library_cli = AppGroup('library', help="Export and import users' stories and characters.")
+
+def _find_user(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}.")
+
+    return user
+
+@library_cli.command('export')
+@click.argument('username')
+@click.argument('path', default='-')
+def export_command(username, path):
+    """
+    Write USERNAME's stories and characters as gzip-compressed JSON lines, to PATH or standard output.
+    """
+
+    user = _find_user(username)
+
+    with click.open_file(path, 'wb') as f:
+        for chunk in gzip_chunks(export_lines(user)):
+            f.write(chunk)
+
+@library_cli.command('import')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_command(username, path):
+    """
+    Add the stories and characters in the export at PATH to USERNAME's account.
+
+    Run 'flask analytics refresh --backfill' afterwards to count the imported stories.
+    """
+
+    user = _find_user(username)
+
+    try:
+        with gzip.open(path, 'rt', encoding='UTF-8') as f:
+            counts = import_lines(f, user)
+        db.session.commit()
+    except (ValueError, OSError) as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+
+    click.echo(', '.join(f"{count} {kind.replace('_', ' ')} rows" for kind, count in counts.items()) + " imported.")
@@ -0,0 +1,372 @@
+from flask import current_app, has_request_context
+from flask.cli import AppGroup
+from flask_login import current_user
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
+from collections import deque
+from metrics import LLM_HEDGES, LLM_TOKENS, LLM_COST
+from scheduler import slot, acquire, acquire_async, try_acquire, release, charge, enabled as scheduling
+from prometheus_client import REGISTRY
+from time import perf_counter, sleep
+import statistics
+import asyncio
+import click
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Dollars per 1,000 prompt and completion tokens; 'LLM_PRICES' adds to or overrides these.
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+}
+
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+latencies = {}
+
+_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm-hedge')
+
+def llm():
+    """
+    Return the OpenAI client module, importing and configuring it on first use.
+
+    The openai package is slow to import and only the generation routes need it, so it is
+    imported here rather than at module level. With 'LLM_BACKEND' set to 'fake', the simulated
+    backend in 'fakellm.py' is returned instead.
+
+    Returns:
+        module: The configured `openai` module, or `fakellm`.
+    """
+
+    if current_app.config.get('LLM_BACKEND') == 'fake':
+        import fakellm
+
+        fakellm.configure(current_app.config)
+        return fakellm
+
+    import openai
+
+    if openai.api_key is None:
+        openai.api_key = current_app.config.get('OPENAI_API_KEY')
+
+    return openai
+
+def user_tier():
+    """
+    Return the tier of the user being served.
+
+    Returns:
+        str: The tier 'LLM_USER_TIERS' gives the user's username, or 'standard'.
+    """
+
+    if has_request_context() and current_user.is_authenticated:
+        return current_app.config.get('LLM_USER_TIERS', {}).get(current_user.username, 'standard')
+    return 'standard'
+
+def current_user_id():
+    """
+    Return the ID of the user being served, for quotas and fair queueing.
+
+    Returns:
+        int or None: The user's ID, or None outside a request or for anonymous users.
+    """
+
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+def weight():
+    """
+    Return the current user's share of upstream capacity.
+
+    Returns:
+        float: The weight 'LLM_TIER_WEIGHTS' gives the user's tier, or 1.
+    """
+
+    return current_app.config.get('LLM_TIER_WEIGHTS', {}).get(user_tier(), 1)
+
+def used_tokens(response):
+    usage = response.get('usage') or {}
+    return usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+
+def route(call, tier=None):
+    """
+    Pick the model for a call.
+
+    'LLM_ROUTES' maps '<call>:<tier>' or '<call>' to a model name, e.g.
+    {"opening": "gpt-3.5-turbo", "opening:premium": "gpt-4", "repair": "gpt-3.5-turbo"}.
+    The most specific entry wins.
+
+    Args:
+        call (str): The kind of call: 'opening', 'continuation' or 'repair'.
+        tier (str, optional): The user's tier. Defaults to the current user's.
+
+    Returns:
+        str: The model name.
+    """
+
+    routes = current_app.config.get('LLM_ROUTES', {})
+    tier = tier or user_tier()
+
+    return routes.get(f"{call}:{tier}") or routes.get(call) or DEFAULT_MODEL
+
+def p95(model):
+    """
+    Return the 95th percentile latency of a model's recent calls in this process.
+
+    Args:
+        model (str): The model name.
+
+    Returns:
+        float or None: Seconds, or None with fewer than MIN_SAMPLES recorded calls.
+    """
+
+    samples = latencies.get(model)
+    if not samples or len(samples) < MIN_SAMPLES:
+        return None
+
+    return statistics.quantiles(samples, n=20)[-1]
+
+def hedge_plan(model):
+    """
+    Decide whether and when to hedge a call.
+
+    With 'LLM_HEDGE' on, a backup request is sent once the primary has taken longer than the
+    model's tracked p95. The backup goes to the model 'LLM_HEDGE_MODELS' names for the primary,
+    or to the same model.
+
+    Args:
+        model (str): The primary model.
+
+    Returns:
+        tuple or None: (delay in seconds, backup model), or None to not hedge.
+    """
+
+    if not current_app.config.get('LLM_HEDGE'):
+        return None
+
+    delay = p95(model)
+    if delay is None:
+        return None
+
+    return delay, current_app.config.get('LLM_HEDGE_MODELS', {}).get(model, model)
+
+def prices():
+    """
+    Return the token prices in effect.
+
+    Returns:
+        dict: (prompt, completion) dollars per 1,000 tokens, by model.
+    """
+
+    return {**PRICES, **{model: tuple(price) for model, price in current_app.config.get('LLM_PRICES', {}).items()}}
+
+def record(model, seconds, response, price):
+    """
+    Record a finished call's latency, token usage and cost.
+
+    Args:
+        model (str): The model called.
+        seconds (float): How long the call took.
+        response (dict): The completion response.
+        price (tuple): (prompt, completion) dollars per 1,000 tokens, or None if unknown.
+    """
+
+    latencies.setdefault(model, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    usage = response.get('usage') or {}
+    prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    LLM_TOKENS.labels(model, 'prompt').inc(prompt_tokens)
+    LLM_TOKENS.labels(model, 'completion').inc(completion_tokens)
+
+    if price:
+        LLM_COST.labels(model).inc((prompt_tokens * price[0] + completion_tokens * price[1]) / 1000)
+
+def _call(client, model, request, price):
+    start = perf_counter()
+    response = client.ChatCompletion.create(model=model, **request)
+    record(model, perf_counter() - start, response, price)
+    return response
+
+async def _call_async(client, model, request, price):
+    start = perf_counter()
+    response = await client.ChatCompletion.acreate(model=model, **request)
+    record(model, perf_counter() - start, response, price)
+    return response
+
+def chat(call, request):
+    """
+    Send a chat completion request to the routed model, hedging it if it runs slow.
+
+    The call first waits for an upstream slot in the fair queue (see 'scheduler.py'). When
+    hedged, the backup takes a slot of its own, and is only sent if one is free without
+    queueing; the primary and backup then race and the first successful response wins. A
+    losing sync request can't be interrupted, so it finishes in the background, keeping its
+    slot until it does. The tokens of every call that completes, won or lost, are charged to
+    the user's quota.
+
+    Args:
+        call (str): The kind of call, see `route`.
+        request (dict): Keyword arguments for `ChatCompletion.create`, without the model.
+
+    Returns:
+        dict: The completion response.
+    """
+
+    user_id = current_user_id()
+    client, model, price_list = llm(), route(call), prices()
+    plan = hedge_plan(model)
+
+    if plan is None:
+        with slot(user_id, weight()):
+            response = _call(client, model, request, price_list.get(model))
+        charge(user_id, used_tokens(response))
+        return response
+
+    app = current_app._get_current_object()
+    delay, backup_model = plan
+    primary = _pool.submit(_slotted_call, app, user_id, acquire(user_id, weight()),
+                           client, model, request, price_list.get(model))
+
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeout:
+        pass
+
+    backup_ticket = try_acquire(user_id) if scheduling() else None
+    if scheduling() and backup_ticket is None:
+        LLM_HEDGES.labels(call, 'skipped').inc()
+        return primary.result()
+
+    backup = _pool.submit(_slotted_call, app, user_id, backup_ticket,
+                          client, backup_model, request, price_list.get(backup_model))
+    pending = {primary, backup}
+
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=lambda future: future is backup):
+            if future.exception() is None or not pending:
+                LLM_HEDGES.labels(call, 'backup' if future is backup else 'primary').inc()
+                return future.result()
+
+def _slotted_call(app, user_id, ticket_id, client, model, request, price):
+    with app.app_context():
+        try:
+            response = _call(client, model, request, price)
+        finally:
+            release(ticket_id)
+        charge(user_id, used_tokens(response))
+
+    return response
+
+async def chat_async(call, request):
+    """
+    Async counterpart of `chat`. The losing request of a hedged pair is cancelled, and its slot
+    freed before the winner's response is returned; a cancelled request returns no usage, so
+    only the winner is charged.
+
+    Args:
+        call (str): The kind of call, see `route`.
+        request (dict): Keyword arguments for `ChatCompletion.acreate`, without the model.
+
+    Returns:
+        dict: The completion response.
+    """
+
+    user_id = current_user_id()
+    client, model, price_list = llm(), route(call), prices()
+    plan = hedge_plan(model)
+
+    primary = asyncio.ensure_future(_slotted_call_async(user_id, await acquire_async(user_id, weight()),
+                                                        client, model, request, price_list.get(model)))
+
+    if plan is None:
+        return await primary
+
+    delay, backup_model = plan
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    backup_ticket = await asyncio.to_thread(try_acquire, user_id) if scheduling() else None
+    if scheduling() and backup_ticket is None:
+        LLM_HEDGES.labels(call, 'skipped').inc()
+        return await primary
+
+    backup = asyncio.ensure_future(_slotted_call_async(user_id, backup_ticket, client, backup_model,
+                                                       request, price_list.get(backup_model)))
+    pending = {primary, backup}
+
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda task: task is backup):
+                if task.exception() is None or not pending:
+                    LLM_HEDGES.labels(call, 'backup' if task is backup else 'primary').inc()
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def _slotted_call_async(user_id, ticket_id, client, model, request, price):
+    try:
+        response = await _call_async(client, model, request, price)
+    finally:
+        await asyncio.to_thread(release, ticket_id)
+    await asyncio.to_thread(charge, user_id, used_tokens(response))
+
+    return response
+
+def hedge_count(call, outcome):
+    return REGISTRY.get_sample_value('llm_hedged_requests_total', {'call': call, 'outcome': outcome}) or 0
+
+llm_cli = AppGroup('llm', help="Inspect model routing.")
+
+@llm_cli.command('report')
+@click.option('--requests', 'count', default=400, help="Number of simulated requests per run.")
+@click.option('--concurrency', default=20, help="Requests in flight at once.")
+@click.option('--call', default='opening', type=click.Choice(['opening', 'continuation']), help="Kind of call to simulate.")
+@click.option('--tier', default='standard', help="User tier to route for.")
+@click.option('--time-scale', default=0.01, help="Factor applied to simulated latencies so the report runs quickly.")
+def report(count, concurrency, call, tier, time_scale):
+    """
+    Report latency and cost with and without hedging, against the fake backend.
+    """
+
+    from apicalls import complete, story_messages, continuation_messages
+    import fakellm
+
+    app = current_app._get_current_object()
+    model = route(call, tier)
+    app.config.update(LLM_BACKEND='fake', FAKE_LLM_TIME_SCALE=time_scale, LLM_SCHEDULER=False,
+                      LLM_ROUTES={**app.config.get('LLM_ROUTES', {}), call: model})
+    messages = story_messages(['Fantasy'], []) if call == 'opening' else continuation_messages('Once upon a time.', 'Go left.')
+
+    click.echo(f"{call} requests for tier '{tier}' route to {model}; backup model {app.config.get('LLM_HEDGE_MODELS', {}).get(model, model)}.")
+    click.echo(f"{'hedging':<8} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7} {'hedged':>7} {'backup won':>10} {'$/1k req':>9}")
+
+    for hedge in (False, True):
+        app.config['LLM_HEDGE'] = hedge
+        fakellm.calls.clear()
+        hedges_before = {outcome: hedge_count(call, outcome) for outcome in ('primary', 'backup')}
+
+        def one(_):
+            with app.app_context():
+                start = perf_counter()
+                complete(call, messages)
+                return (perf_counter() - start) / time_scale
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            times = sorted(executor.map(one, range(count)))
+
+        while fakellm.in_flight:
+            sleep(0.01)
+
+        hedged = {outcome: hedge_count(call, outcome) - hedges_before[outcome] for outcome in ('primary', 'backup')}
+        cost = sum(fakellm.cost(entry, prices()) for entry in fakellm.calls) / count * 1000
+        quantiles = statistics.quantiles(times, n=100)
+
+        click.echo(f"{'on' if hedge else 'off':<8} {quantiles[49]:>6.2f}s {quantiles[94]:>6.2f}s {quantiles[98]:>6.2f}s "
+                   f"{times[-1]:>6.2f}s {sum(hedged.values()) / count:>7.1%} {hedged['backup'] / count:>10.1%} {cost:>9.2f}")
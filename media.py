@@ -0,0 +1,443 @@
+from flask import current_app, send_from_directory, abort
+from flask.cli import AppGroup
+from models import db, User, Character, Story, ImageSource
+from images import encode, formats, FORMATS, CACHE_SECONDS
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
+from datetime import datetime
+from hashlib import sha256
+from io import BytesIO
+from time import sleep
+import ipaddress
+import requests
+import socket
+import click
+import json
+import os
+
+MEDIA_PREFIX = '/media/'
+
+# Thumbnails are built at these widths only, whatever width a template displays the image at.
+THUMBNAIL_WIDTHS = (64, 160, 320, 640)
+
+# Pillow format names, and the extension originals of each are stored with.
+EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'WEBP': 'webp'}
+
+# Columns holding image URLs that users enter; fetched URLs are replaced by local ones.
+IMAGE_COLUMNS = ((User, User.image_url), (Character, Character.img_url), (Story, Story.img_url))
+
+MAX_ATTEMPTS = 3
+MAX_REDIRECTS = 3
+
+_entries = {}
+
+class ImageRejected(ValueError):
+    """
+    Raised when a fetched or uploaded file can't be stored as an image.
+    """
+
+def store_dir():
+    """
+    Return the directory of the content-addressed image store.
+
+    Returns:
+        str: The 'IMAGE_STORE_DIR' config value, or 'media' in the app's instance folder.
+    """
+
+    return current_app.config.get('IMAGE_STORE_DIR') or os.path.join(current_app.instance_path, 'media')
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def store(data):
+    """
+    Save an image's bytes in the store under a name derived from its content.
+
+    Storing the same image twice, from any source, keeps one copy.
+
+    Args:
+        data (bytes): The image file.
+
+    Returns:
+        str: The file name, its SHA-256 plus an extension for its format.
+
+    Raises:
+        ImageRejected: If the data is too large or isn't a PNG, JPEG, GIF or WebP image.
+    """
+
+    if len(data) > current_app.config.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024):
+        raise ImageRejected("The image is too large.")
+
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImageRejected("Storing images requires Pillow.")
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+            extension = EXTENSIONS.get(image.format)
+    except Exception:
+        raise ImageRejected("The file isn't an image.")
+
+    if extension is None:
+        raise ImageRejected("Only PNG, JPEG, GIF and WebP images are accepted.")
+
+    name = f"{sha256(data).hexdigest()}.{extension}"
+    path = os.path.join(store_dir(), name)
+
+    if not os.path.exists(path):
+        os.makedirs(store_dir(), exist_ok=True)
+        _write_atomic(path, data)
+
+    return name
+
+def ingest_image(url, upload=None):
+    """
+    Return the URL to save in an image field, bringing the image into the store.
+
+    An upload is stored right away and its thumbnails are queued. An external URL is queued to
+    be fetched once; until then the field keeps the external URL. Nothing is committed.
+
+    Args:
+        url (str): The URL the user entered, if any.
+        upload (FileStorage, optional): The file the user uploaded, which takes precedence.
+
+    Returns:
+        str: The local URL of the upload, or `url`.
+
+    Raises:
+        ImageRejected: If the upload can't be stored.
+    """
+
+    if upload:
+        url = MEDIA_PREFIX + store(upload.read(current_app.config.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024) + 1))
+        queue(url, 'stored')
+    elif url and url.startswith(('http://', 'https://')):
+        queue(url, 'pending')
+
+    return url
+
+def queue(url, status):
+    if db.session.scalar(db.select(ImageSource.id).where(ImageSource.url == url)) is None:
+        db.session.add(ImageSource(url=url, status=status,
+                                   name=url[len(MEDIA_PREFIX):] if status == 'stored' else None))
+
+def check_host(url):
+    """
+    Refuse to fetch from hosts on private networks, so users can't make the server probe them.
+
+    The host is resolved once here, and the address returned is the one to connect to: a name
+    resolved again at connection time could by then point somewhere private (DNS rebinding).
+    'IMAGE_FETCH_ALLOW_PRIVATE' lifts the check, for fetching from a local stub server in
+    development.
+
+    Args:
+        url (str): The URL about to be fetched.
+
+    Returns:
+        str: The address the host resolved to.
+
+    Raises:
+        ImageRejected: If the URL isn't http(s) or its host resolves to a non-public address.
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageRejected("Only http and https URLs can be fetched.")
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or 443,
+                                                               type=socket.SOCK_STREAM)]
+    except socket.gaierror:
+        raise ImageRejected(f"Can't resolve {parts.hostname}.")
+
+    if not current_app.config.get('IMAGE_FETCH_ALLOW_PRIVATE'):
+        for address in addresses:
+            if not ipaddress.ip_address(address.split('%')[0]).is_global:
+                raise ImageRejected(f"{parts.hostname} isn't a public host.")
+
+    return addresses[0]
+
+class _PinnedAdapter(HTTPAdapter):
+    """
+    Transport adapter for URLs whose host was replaced by a checked address, which still sends
+    and verifies TLS certificates against the original host name.
+    """
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, server_hostname=self.hostname, **kwargs)
+
+def _get_pinned(session, url, address, timeout):
+    parts = urlsplit(url)
+    host = f"[{address}]" if ':' in address else address
+    netloc = host if parts.port is None else f"{host}:{parts.port}"
+
+    session.mount(f"{parts.scheme}://", _PinnedAdapter(parts.hostname))
+
+    return session.get(parts._replace(netloc=netloc).geturl(), headers={'Host': parts.netloc.rpartition('@')[2]},
+                       stream=True, allow_redirects=False, timeout=timeout)
+
+def fetch(url):
+    """
+    Download an image, following a few redirects and stopping at 'IMAGE_MAX_BYTES'.
+
+    Every hop connects to the address `check_host` approved for it, and never through a proxy.
+
+    Args:
+        url (str): The image URL.
+
+    Returns:
+        bytes: The body.
+
+    Raises:
+        ImageRejected: If the URL is refused or the response isn't a successful, small enough body.
+        requests.RequestException: If the request fails.
+    """
+
+    limit = current_app.config.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        address = check_host(url)
+        with requests.Session() as session:
+            session.trust_env = False
+            with _get_pinned(session, url, address, current_app.config.get('IMAGE_FETCH_TIMEOUT', 10)) as response:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers['Location'])
+                    continue
+
+                if response.status_code != 200:
+                    raise ImageRejected(f"The server answered {response.status_code}.")
+
+                data = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > limit:
+                        raise ImageRejected("The image is too large.")
+
+                return bytes(data)
+
+    raise ImageRejected("Too many redirects.")
+
+def build_thumbnails(name):
+    """
+    Build a stored image's thumbnails and record them in a sidecar file next to it.
+
+    The sidecar has the same form as the entries of the 'images.py' manifest, so
+    `responsive_image` offers the thumbnails for the image's local URL.
+
+    Args:
+        name (str): The image's file name in the store.
+
+    Returns:
+        dict: The sidecar entry.
+    """
+
+    from PIL import Image
+
+    stem = name.rsplit('.', 1)[0]
+    path = os.path.join(store_dir(), name)
+    entry = {'hash': stem, 'bytes': os.path.getsize(path), 'variants': []}
+
+    with Image.open(path) as image:
+        image.seek(0)
+        image = image.convert('RGBA') if image.mode not in ('RGB', 'RGBA') else image.copy()
+        entry['width'], entry['height'] = image.size
+
+        widths = [width for width in THUMBNAIL_WIDTHS if width < image.width]
+        if image.width <= THUMBNAIL_WIDTHS[-1]:
+            widths.append(image.width)
+
+        for width in widths:
+            resized = image if width == image.width else image.resize(
+                (width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+            for format in formats():
+                file = f"{stem}-{width}.{format}"
+                if not os.path.exists(os.path.join(store_dir(), file)):
+                    _write_atomic(os.path.join(store_dir(), file), encode(resized, format))
+
+                entry['variants'].append({'format': format, 'width': width, 'file': file,
+                                          'bytes': os.path.getsize(os.path.join(store_dir(), file))})
+
+    entry['variants'].sort(key=lambda variant: (FORMATS.index(variant['format']), variant['width']))
+    _write_atomic(os.path.join(store_dir(), f"{stem}.json"), json.dumps(entry).encode('UTF-8'))
+
+    return entry
+
+def stored_entry(src):
+    """
+    Return the thumbnails built for an image in the store.
+
+    Entries never change once built, so they are cached in the process.
+
+    Args:
+        src (str): The image's local URL, such as '/media/<sha256>.png'.
+
+    Returns:
+        dict or None: The sidecar entry with a 'url' for each variant, or None if the thumbnails
+        aren't built yet.
+    """
+
+    stem = src[len(MEDIA_PREFIX):].rsplit('.', 1)[0]
+
+    if stem not in _entries:
+        try:
+            with open(os.path.join(store_dir(), f"{os.path.basename(stem)}.json")) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        for variant in entry['variants']:
+            variant['url'] = MEDIA_PREFIX + variant['file']
+        _entries[stem] = entry
+
+    return _entries[stem]
+
+def ingest_source(app, source_id):
+    """
+    Fetch an image source if it's external, build its thumbnails and point the users,
+    characters and stories that use its URL at the local copy.
+
+    Runs in a worker thread, so it pushes its own application context. A failure is recorded on
+    the source, which is tried again on later passes up to MAX_ATTEMPTS times.
+
+    Args:
+        app (Flask application): The application.
+        source_id (int): The ID of the ImageSource.
+
+    Returns:
+        str: The source's new status.
+    """
+
+    with app.app_context():
+        source = db.session.get(ImageSource, source_id)
+
+        try:
+            if source.status == 'pending':
+                source.name = store(fetch(source.url))
+            build_thumbnails(source.name)
+        except (ImageRejected, requests.RequestException, OSError) as e:
+            source.attempts += 1
+            source.error = str(e)[:500]
+            if source.attempts >= MAX_ATTEMPTS:
+                source.status = 'failed'
+            db.session.commit()
+            return source.status
+
+        local_url = MEDIA_PREFIX + source.name
+        if source.url != local_url:
+            for model, column in IMAGE_COLUMNS:
+                db.session.execute(
+                    db.update(model).where(column == source.url).values({column.key: local_url})
+                    .execution_options(synchronize_session=False)
+                )
+
+        source.status = 'done'
+        source.error = None
+        source.finished_at = datetime.utcnow()
+        db.session.commit()
+
+        return source.status
+
+def ingest(workers=4, limit=100):
+    """
+    Bring queued images into the store on a bounded thread pool.
+
+    Args:
+        workers (int, optional): The most images processed at once.
+        limit (int, optional): The most images processed in this pass.
+
+    Returns:
+        dict: The number of sources per resulting status.
+    """
+
+    ids = db.session.scalars(
+        db.select(ImageSource.id).where(ImageSource.status.in_(('pending', 'stored')))
+        .order_by(ImageSource.id).limit(limit)
+    ).all()
+    db.session.remove()
+
+    app = current_app._get_current_object()
+    counts = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for status in pool.map(lambda id: ingest_source(app, id), ids):
+            counts[status] = counts.get(status, 0) + 1
+
+    return counts
+
+def media_file(filename):
+    """
+    Serve an image or thumbnail from the store with far-future, immutable caching.
+
+    Args:
+        filename (str): The file name.
+
+    Returns:
+        Response: The image.
+    """
+
+    if filename.endswith(('.json', '.tmp')):
+        abort(404)
+
+    response = send_from_directory(store_dir(), filename, max_age=CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+def init_media(app):
+    """
+    Add the '/media/<filename>' route for the image store.
+
+    Args:
+        app (Flask application): The application.
+    """
+
+    app.add_url_rule(MEDIA_PREFIX + '<path:filename>', view_func=media_file)
+
+media_cli = AppGroup('media', help="Manage the local image store.")
+
+@media_cli.command('ingest')
+@click.option('--workers', default=4, help="Maximum number of images processed concurrently.")
+@click.option('--limit', default=100, help="Maximum number of images per pass.")
+@click.option('--watch', is_flag=True, help="Keep running, ingesting every interval.")
+@click.option('--interval', default=10, help="Seconds between passes with --watch.")
+def ingest_command(workers, limit, watch, interval):
+    """
+    Fetch queued image URLs, build thumbnails and switch their users to the local copies.
+    """
+
+    while True:
+        counts = ingest(workers, limit)
+        click.echo(', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or "Nothing queued.")
+
+        if not watch:
+            break
+        sleep(interval)
+
+@media_cli.command('report')
+def report():
+    """
+    Show how many image sources are in each state, and the most recent failures.
+    """
+
+    for status, count in db.session.execute(
+        db.select(ImageSource.status, db.func.count()).group_by(ImageSource.status).order_by(ImageSource.status)
+    ):
+        click.echo(f"{status:<8} {count:>6}")
+
+    for url, error in db.session.execute(
+        db.select(ImageSource.url, ImageSource.error).where(ImageSource.error.is_not(None))
+        .order_by(ImageSource.id.desc()).limit(10)
+    ):
+        click.echo(f"{url}: {error}")
@@ -0,0 +1,161 @@
+from flask import g, request, has_request_context, before_render_template, template_rendered, current_app, abort
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+from time import perf_counter
+import os
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', "Request latency by endpoint.",
+    ['endpoint', 'method', 'status'])
+REQUEST_SQL_STATEMENTS = Histogram(
+    'http_request_sql_statements', "SQL statements executed per request.",
+    ['endpoint'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+SQL_STATEMENTS = Counter(
+    'sql_statements_total', "SQL statements executed.",
+    ['endpoint'])
+SQL_DURATION = Histogram(
+    'sql_statement_duration_seconds', "SQL statement execution time.",
+    ['endpoint'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+LLM_DURATION = Histogram(
+    'llm_request_duration_seconds', "OpenAI completion call time.",
+    ['call', 'endpoint'], buckets=(.25, .5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90))
+LLM_PARSE_FAILURES = Counter(
+    'llm_parse_failures_total', "Completions with a missing or invalid part, by part.",
+    ['call', 'field'])
+LLM_REPAIRS = Counter(
+    'llm_repairs_total', "Follow-up requests for malformed completions, by outcome.",
+    ['call', 'outcome'])
+LLM_HEDGES = Counter(
+    'llm_hedged_requests_total', "Completion calls that ran past their hedging delay, by which request won, or 'skipped' if no slot was free for a backup.",
+    ['call', 'outcome'])
+LLM_TOKENS = Counter(
+    'llm_tokens_total', "Tokens used by completion calls, including hedged losers.",
+    ['model', 'kind'])
+LLM_COST = Counter(
+    'llm_cost_dollars_total', "Estimated cost of completion calls.",
+    ['model'])
+OPENING_CLAIMS = Counter(
+    'story_opening_claims_total', "Story generations that looked in the warm pool, by outcome.",
+    ['outcome'])
+OPENINGS_GENERATED = Counter(
+    'story_openings_generated_total', "Openings written ahead of time for the warm pool.")
+RESPONSE_BYTES = Counter(
+    'http_response_bytes', "Bytes of compressible response bodies before content encoding.",
+    ['endpoint'])
+RESPONSE_BYTES_SENT = Counter(
+    'http_response_bytes_sent', "Bytes of compressible response bodies sent, by content encoding.",
+    ['endpoint', 'encoding'])
+COMPRESSION_CPU = Counter(
+    'response_compression_cpu_seconds', "CPU time spent compressing responses.",
+    ['endpoint', 'encoding'])
+TEMPLATE_DURATION = Histogram(
+    'template_render_duration_seconds', "Template render time.",
+    ['template', 'endpoint'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5))
+
+def current_endpoint():
+    """
+    Return the label for the endpoint serving the current request.
+
+    Returns:
+        str: The Flask endpoint name, or 'none' outside a request or for unmatched URLs.
+    """
+
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'none'
+
+@contextmanager
+def llm_timer(call):
+    """
+    Time an OpenAI completion call.
+
+    Args:
+        call (str): The kind of call, such as 'opening', 'continuation' or 'repair'.
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        LLM_DURATION.labels(call, current_endpoint()).observe(perf_counter() - start)
+
+# The start time is kept on the statement's execution context rather than the connection, so a
+# statement that fails, and so never reaches 'after_cursor_execute', leaves nothing behind.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_query_start = perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = perf_counter() - context.metrics_query_start
+    endpoint = current_endpoint()
+
+    SQL_STATEMENTS.labels(endpoint).inc()
+    SQL_DURATION.labels(endpoint).observe(duration)
+
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0) + duration
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(perf_counter())
+
+def _rendered(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        TEMPLATE_DURATION.labels(template.name or 'string', current_endpoint()).observe(perf_counter() - starts.pop())
+
+def _start_timer():
+    g.request_start = perf_counter()
+
+def _record_request(response):
+    if 'request_start' in g:
+        endpoint = current_endpoint()
+        REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(perf_counter() - g.request_start)
+        REQUEST_SQL_STATEMENTS.labels(endpoint).observe(g.get('sql_statements', 0))
+
+    return response
+
+def metrics():
+    """
+    Expose the collected metrics in Prometheus text format.
+
+    Under gunicorn, with 'PROMETHEUS_MULTIPROC_DIR' set, every worker writes its samples to that
+    directory and this view aggregates all of them, so any worker can answer the scrape. If
+    'METRICS_TOKEN' is configured, the scraper must send it as a bearer token.
+
+    Returns:
+        Response: The metrics.
+    """
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(403)
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+def init_metrics(app):
+    """
+    Instrument an application and add its '/metrics' endpoint.
+
+    SQL statements are counted by SQLAlchemy engine events, templates by Flask's render signals,
+    and OpenAI calls by `llm_timer`; everything is labelled with the Flask endpoint being served.
+
+    Args:
+        app (Flask application): The application to instrument.
+    """
+
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    app.add_url_rule('/metrics', view_func=metrics)
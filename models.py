@@ -1,9 +1,38 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import with_loader_criteria
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from compression import CompressedText
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Longest excerpt shown on story cards, in characters.
+EXCERPT_CHARS = 200
+
+def word_count(text):
+    return len((text or '').split())
+
+def excerpt_of(text, length=EXCERPT_CHARS):
+    """
+    Shorten a story's text for a card, cutting at a word boundary.
+
+    Args:
+        text (str): The text.
+        length (int, optional): The most characters to keep, before the ellipsis.
+
+    Returns:
+        str: The text with its whitespace collapsed, ending in '...' if it was cut.
+    """
+
+    text = ' '.join((text or '').split())
+    if len(text) <= length:
+        return text
+
+    return text[:length].rsplit(' ', 1)[0] + '...'
 
 class User(UserMixin, db.Model):
     """
@@ -14,6 +43,9 @@ class User(UserMixin, db.Model):
     and relationships to other tables, including Story, Character, UserGenre, 
     and ChatGPTSession.
 
+    A user with deleted_at set has been deleted and is hidden from queries until the reaper in
+    'deletion.py' removes the rows.
+
     The User class includes methods for user signup and authentication.
     """
     
@@ -31,11 +63,15 @@ class User(UserMixin, db.Model):
     image_url = db.Column(db.Text, default="/static/images/default-pic.png")
     created_at = db.Column(db.DateTime, default = datetime.utcnow)
     email_confirmed = db.Column(db.Boolean, default = False)
+    deleted_at = db.Column(db.DateTime, index=True)
 
-    stories = db.relationship('Story', backref='author', cascade="all, delete-orphan")
-    characters = db.relationship('Character', backref='user', cascade="all, delete-orphan")
-    user_genres = db.relationship('UserGenre', backref='user', cascade="all, delete-orphan")
-    chatgpt_sessions = db.relationship('ChatGPTSession', backref='user', cascade="all, delete-orphan")
+    stories = db.relationship('Story', backref='author', cascade="all, delete-orphan", passive_deletes=True)
+    characters = db.relationship('Character', backref='user', cascade="all, delete-orphan", passive_deletes=True)
+    user_genres = db.relationship('UserGenre', backref='user', cascade="all, delete-orphan", passive_deletes=True)
+    chatgpt_sessions = db.relationship('ChatGPTSession', backref='user', cascade="all, delete-orphan", passive_deletes=True)
+    generation_requests = db.relationship('GenerationRequest', cascade="all, delete-orphan", passive_deletes=True)
+    llm_quota = db.relationship('LLMQuota', cascade="all, delete-orphan", passive_deletes=True)
+    llm_tickets = db.relationship('LLMTicket', cascade="all, delete-orphan", passive_deletes=True)
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}"
@@ -100,6 +136,12 @@ class Story(db.Model):
 
     A story has an id, title, starting content, timestamps of creation, update, and access,
     an optional cover image URL, and relationships to other tables, including StoryStep.
+    A story with deleted_at set is hidden in the same way as a deleted user.
+
+    The excerpt and word count are kept up to date whenever start_content is set (see
+    `_set_preview`), and chain_length, the number of stories from the root to this one, is set
+    when the story is saved, so list views can show cards and reading times without loading
+    start_content.
 
     The Story class includes a classmethod for creating a story.
     """
@@ -108,24 +150,43 @@ class Story(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.Text, nullable=False)
-    start_content = db.Column(db.Text, nullable=False)
+    start_content = db.Column(CompressedText, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, onupdate=datetime.utcnow)
     accessed_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     img_url = db.Column(db.Text, default='/static/images/library3.png')
     end = db.Column(db.Boolean, default=False)
+    deleted_at = db.Column(db.DateTime, index=True)
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer)
+    chain_length = db.Column(db.Integer, default=1)
 
     author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
 
-    story_steps = db.relationship('StoryStep', backref='story', cascade="all, delete-orphan")
+    story_steps = db.relationship('StoryStep', backref='story', cascade="all, delete-orphan", passive_deletes=True)
     characters = db.relationship('StoryCharacters', backref='story', cascade="all, delete-orphan", passive_deletes=True)
-    choices = db.relationship("Choice", back_populates="story")
+    alternates = db.relationship('StoryOpening', cascade="all, delete-orphan", passive_deletes=True,
+                                 order_by='StoryOpening.id')
+    choices = db.relationship("Choice", back_populates="story", passive_deletes=True)
 
     def __repr__(self):
         return f"Story #{self.id}, {self.title}, {self.author_id}"
 
+    def is_owned_by(self, user):
+        """
+        Check whether a user is the author of this story.
+
+        Parameters:
+            user (User): The user to check, typically `current_user`.
+
+        Returns:
+            bool: True if the user wrote the story.
+        """
+
+        return self.author_id == user.id
+
     @classmethod
-    def create_story(cls, title, start_content, author_id, end=False):
+    def create_story(cls, title, start_content, author_id, end=False, chain_length=1):
         """
         Create a new story.
 
@@ -135,6 +196,8 @@ class Story(db.Model):
             title (str): The story's title.
             start_content (str): The starting content for the story.
             author_id (int): The ID of the author of the story.
+            chain_length (int or SQL expression, optional): The number of stories in its chain,
+                including itself. Defaults to a new root story.
 
         Returns:
             Story: The newly created Story object.
@@ -144,20 +207,83 @@ class Story(db.Model):
             title = title,
             start_content = start_content,
             author_id = author_id,
-            end = end
+            end = end,
+            chain_length = chain_length
         )
         
         db.session.add(story)
         db.session.commit()
         return story
 
+    @classmethod
+    def chain_cte(cls, id, below=None):
+        """
+        Build the recursive query that walks from a story back to the root of its chain.
+
+        The walk stops below a deleted story, so its continuations read as chains of their own,
+        just as they did when deleting a story removed the choices leading out of it. A deleted
+        story has no chain at all.
+
+        Args:
+            id (int): The ID of the last story of the chain.
+            below (int, optional): Stop the walk before this depth. Defaults to walking to the root.
+
+        Returns:
+            CTE: Rows of (story_id, depth), where depth counts the steps back from the given
+            story, which has depth 0; the root has the greatest depth.
+        """
+
+        chain = (
+            db.select(cls.id.label('story_id'), db.literal(0).label('depth'))
+            .where(cls.id == id, cls.deleted_at.is_(None))
+            .cte('chain', recursive=True)
+        )
+        parents = (
+            db.select(StoryStep.story_id, chain.c.depth + 1)
+            .join(Choice, Choice.to_story_id == chain.c.story_id)
+            .join(StoryStep, StoryStep.id == Choice.from_step_id)
+            .join(cls, cls.id == StoryStep.story_id)
+            .where(cls.deleted_at.is_(None))
+        )
+
+        if below is not None:
+            parents = parents.where(chain.c.depth + 1 < below)
+
+        return chain.union_all(parents)
+
+    @classmethod
+    def get_story_chain_page(cls, id, before=None, limit=10):
+        """
+        Retrieves one page of the chain ending at the specified story, root first.
+
+        Pages are keyed on depth rather than offset: only `limit` stories are loaded at a time,
+        and the walk for a later page stops at the last story already read instead of going on
+        to the root.
+
+        Args:
+            id (int): The ID of the last story of the chain.
+            before (int, optional): The depth of the last story already read; the page starts with
+                the story after it. Defaults to starting at the root.
+            limit (int, optional): The most stories to return.
+
+        Returns:
+            list: (Story, depth) tuples in reading order. The chain has no more stories once a
+            page ends with depth 0.
+        """
+
+        chain = cls.chain_cte(id, below=before)
+        query = db.select(cls, chain.c.depth).join(chain, cls.id == chain.c.story_id)
+
+        return db.session.execute(query.order_by(chain.c.depth.desc()).limit(limit)).all()
+
     @classmethod
     def get_story_chain(cls, id):
         """
         Retrieves the chain of stories starting from the specified story.
 
-        This method starts at the given story and then iteratively follows the choices to gather 
-        a chain of stories. The chain ends when a story has no further choices that lead to it.
+        This method starts at the given story and then follows the choices back to the root to gather 
+        a chain of stories. The chain ends when a story has no further choices that lead to it. The 
+        whole walk is a single recursive query, however deep the chain is.
 
         Args:
             cls (Class): The class that this method is a part of.
@@ -166,26 +292,17 @@ class Story(db.Model):
         Returns:
             list: A list of Story objects representing the chain of stories.
         """
-        story = cls.query.get(id)
-        if not story:
-            raise ValueError(f"Story with id {id} not found")
 
-        chain = [story]
+        chain = cls.chain_cte(id)
 
-        while True:
-            choice = Choice.query.filter_by(to_story_id=story.id).first()
-            if not choice:
-                return chain
+        stories = db.session.scalars(
+            db.select(cls).join(chain, cls.id == chain.c.story_id).order_by(chain.c.depth.desc())
+        ).all()
 
-            step = choice.from_step
-            if not step:
-                raise ValueError(f"Step for choice with id {choice.id} not found")
-
-            story = step.story
-            if not story:
-                raise ValueError(f"Story for step with id {step.id} not found")
+        if not stories or stories[-1].id != id:
+            raise ValueError(f"Story with id {id} not found")
 
-            chain.insert(0, story)
+        return stories
 
 class Choice(db.Model):
     """
@@ -216,15 +333,15 @@ class StoryStep(db.Model):
     __tablename__ = 'story_steps'
 
     id = db.Column(db.Integer, primary_key=True)
-    content = db.Column(db.Text, nullable=False)
+    content = db.Column(CompressedText, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'))
     choices_from = db.relationship('Choice', backref='from_step',
-                                   cascade="all, delete-orphan",
+                                   cascade="all, delete-orphan", passive_deletes=True,
                                    primaryjoin='Choice.from_step_id==StoryStep.id')
     choices_to = db.relationship('Choice', backref='to_story',
-                                 cascade='all, delete-orphan',
+                                 cascade='all, delete-orphan', passive_deletes=True,
                                  primaryjoin='Choice.to_story_id==StoryStep.id')
     
     def __repr__(self):
@@ -242,7 +359,7 @@ class Genre(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, nullable=False)
 
-    user_genres = db.relationship('UserGenre', backref='genre', cascade="all, delete-orphan")
+    user_genres = db.relationship('UserGenre', backref='genre', cascade="all, delete-orphan", passive_deletes=True)
 
 class StoryCharacters(db.Model):
     """
@@ -351,6 +468,318 @@ class UserGenre(db.Model):
         db.session.commit()
         return user_genre
 
+    @classmethod
+    def increment_counts(cls, user_id, genre_ids):
+        """
+        Increment the counts of several genres for a user.
+
+        Like `increment_count`, but in one UPDATE and at most one INSERT, committed once. The
+        counts are incremented in the database, so concurrent generations by the same user don't
+        lose updates, and a record another request created at the same moment is retried as
+        an update.
+
+        Parameters:
+            user_id (int): The ID of the user.
+            genre_ids (list): The IDs of the genres.
+        """
+
+        for attempt in (1, 2):
+            updated = set(db.session.scalars(
+                db.update(cls)
+                .where(cls.user_id == user_id, cls.genre_id.in_(genre_ids))
+                .values(count=cls.count + 1)
+                .returning(cls.genre_id)
+            ))
+            db.session.add_all([cls(user_id=user_id, genre_id=genre_id, count=1)
+                                for genre_id in genre_ids if genre_id not in updated])
+
+            try:
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == 2:
+                    raise
+
+class GenerationRequest(db.Model):
+    """
+    Database model for story generation requests.
+
+    A GenerationRequest records one story generation or continuation started by a user under an
+    idempotency key, its status ('pending', 'done' or 'failed') and, once done, the story it produced.
+    The unique (user_id, key) constraint makes the database decide which of several duplicate
+    requests runs the generation, across every worker; the others wait for its result.
+    """
+
+    __tablename__ = 'generation_requests'
+    __table_args__ = (db.UniqueConstraint('user_id', 'key'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Text, nullable=False, default='pending')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='SET NULL'))
+
+    @classmethod
+    def claim(cls, user_id, key, stale_after):
+        """
+        Try to become the request that runs a generation.
+
+        Inserts a pending record for the key. If one exists already, the claim only succeeds when
+        that record failed or has been pending longer than `stale_after` seconds, meaning the
+        request that owned it died.
+
+        Parameters:
+            user_id (int): The ID of the user.
+            key (str): The idempotency key.
+            stale_after (float): Seconds after which a pending record may be taken over.
+
+        Returns:
+            bool: True if this request should run the generation.
+        """
+
+        db.session.add(cls(user_id=user_id, key=key))
+
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        taken = db.session.execute(
+            db.update(cls)
+            .where(cls.user_id == user_id, cls.key == key,
+                   db.or_(cls.status == 'failed', db.and_(cls.status == 'pending', cls.created_at < cutoff)))
+            .values(status='pending', created_at=datetime.utcnow(), finished_at=None)
+        ).rowcount
+        db.session.commit()
+
+        return taken == 1
+
+    @classmethod
+    def finish(cls, user_id, key, story_id=None):
+        """
+        Record the outcome of a claimed generation.
+
+        Parameters:
+            user_id (int): The ID of the user.
+            key (str): The idempotency key.
+            story_id (int, optional): The story produced, or None if the generation failed.
+        """
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.user_id == user_id, cls.key == key)
+            .values(status='done' if story_id else 'failed', story_id=story_id, finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, user_id, key):
+        """
+        Give up a claimed generation that never ran, so the next request for the key claims it afresh.
+
+        Parameters:
+            user_id (int): The ID of the user.
+            key (str): The idempotency key.
+        """
+
+        db.session.execute(db.delete(cls).where(cls.user_id == user_id, cls.key == key))
+        db.session.commit()
+
+    @classmethod
+    def status_of(cls, user_id, key):
+        """
+        Look up the status of a generation.
+
+        Reads on a connection of its own, returned to the pool at once, so a request polling for
+        another's result neither holds a connection between polls nor ends its session's transaction.
+
+        Parameters:
+            user_id (int): The ID of the user.
+            key (str): The idempotency key.
+
+        Returns:
+            tuple: (status, story_id); (None, None) if the generation was released.
+        """
+
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select(cls.status, cls.story_id).where(cls.user_id == user_id, cls.key == key)
+            ).first()
+
+        return tuple(row) if row else (None, None)
+
+class LLMQuota(db.Model):
+    """
+    Database model for a user's generation quota and fair-queueing position.
+
+    An LLMQuota holds the user's two token buckets, completion requests and completion tokens,
+    as of updated_at, and the virtual finish tag of the user's latest queued completion call.
+    It is shared by every worker, so limits hold across the whole deployment.
+    """
+
+    __tablename__ = 'llm_quotas'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    requests = db.Column(db.Float, nullable=False)
+    tokens = db.Column(db.Float, nullable=False)
+    last_finish = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class LLMTicket(db.Model):
+    """
+    Database model for a completion call waiting for, or holding, one of the upstream slots.
+
+    Waiting tickets are granted in order of their virtual finish tag, which is how weighted fair
+    queueing shares the slots between users. The user is null for calls made outside a request.
+    """
+
+    __tablename__ = 'llm_tickets'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    finish_tag = db.Column(db.Float, nullable=False)
+    running = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_llm_tickets_waiting', 'running', 'finish_tag'),)
+
+class LLMSchedulerState(db.Model):
+    """
+    Database model for the scheduler's single row: the fair-queueing virtual time.
+
+    Granting slots locks this row, so grants from different workers never overshoot the ceiling.
+    """
+
+    __tablename__ = 'llm_scheduler_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    virtual_time = db.Column(db.Float, nullable=False, default=0)
+
+class StoryOpening(db.Model):
+    """
+    Database model for pre-generated story openings.
+
+    A StoryOpening is a title, start content and choices written ahead of time for one combination
+    of genres, identified by genre_key. It waits in the warm pool until a user generating a story
+    with exactly those genres, and no characters, claims it and it becomes their Story.
+
+    An opening with a story_id is instead one of the other candidates generated along with that
+    story, which its author can swap in until they continue the story.
+    """
+
+    __tablename__ = 'story_openings'
+
+    id = db.Column(db.Integer, primary_key=True)
+    genre_key = db.Column(db.Text, nullable=False)
+    title = db.Column(db.Text, nullable=False)
+    start_content = db.Column(CompressedText, nullable=False)
+    choices = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'))
+
+    __table_args__ = (db.Index('ix_story_openings_genre_key', 'genre_key', 'id'),
+                      db.Index('ix_story_openings_story_id', 'story_id'))
+
+    @classmethod
+    def key_for(cls, genre_ids):
+        """
+        Return the key of a combination of genres, the same whatever order they were picked in.
+
+        Parameters:
+            genre_ids (list): The IDs of the genres.
+
+        Returns:
+            str: The sorted IDs, comma-separated.
+        """
+
+        return ','.join(str(id) for id in sorted({int(id) for id in genre_ids}))
+
+class StoryNode(db.Model):
+    """
+    Database model for a story's place in its story tree, kept for analytics.
+
+    A story tree is a root story and every story continued from it through choices. Each node
+    records its tree's root, its depth below the root, its word count, the LLM tokens spent
+    writing it and how many stories were continued from it. See 'analytics.py'.
+
+    root_id is not a foreign key, so that the nodes of a tree whose root was deleted still point
+    at it until the tree is rebuilt.
+    """
+
+    __tablename__ = 'story_nodes'
+
+    story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'), primary_key=True)
+    root_id = db.Column(db.Integer, nullable=False, index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+    words = db.Column(db.Integer, nullable=False, default=0)
+    tokens = db.Column(db.Integer, nullable=False, default=0)
+    children = db.Column(db.Integer, nullable=False, default=0)
+
+class StoryTreeStats(db.Model):
+    """
+    Database model for the aggregates of one story tree.
+
+    Kept up to date as stories are added to the tree; a tree with an edited or deleted story is
+    marked dirty and rebuilt by 'flask analytics refresh'. branching counts the nodes with at
+    least one continuation, so (nodes - 1) / branching is the tree's average branching factor.
+    """
+
+    __tablename__ = 'story_tree_stats'
+
+    root_id = db.Column(db.Integer, primary_key=True)
+    nodes = db.Column(db.Integer, nullable=False, default=1)
+    max_depth = db.Column(db.Integer, nullable=False, default=0)
+    ended = db.Column(db.Integer, nullable=False, default=0)
+    branching = db.Column(db.Integer, nullable=False, default=0)
+    words = db.Column(db.Integer, nullable=False, default=0)
+    tokens = db.Column(db.Integer, nullable=False, default=0)
+    dirty = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_story_tree_stats_dirty', 'dirty'),)
+
+class StepPicks(db.Model):
+    """
+    Database model counting how many times a story step was picked to continue its story.
+    """
+
+    __tablename__ = 'step_picks'
+
+    step_id = db.Column(db.Integer, db.ForeignKey('story_steps.id', ondelete='CASCADE'), primary_key=True)
+    root_id = db.Column(db.Integer, nullable=False, index=True)
+    picks = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+class ImageSource(db.Model):
+    """
+    Database model for an image being brought into the local image store.
+
+    url is either an external image URL that users entered, fetched once, or the local URL of
+    an uploaded image. status is 'pending' until the image is fetched, 'stored' until its
+    thumbnails are built, then 'done', or 'failed' after too many attempts. name is the image's
+    file name in the store, which is derived from its content. See 'media.py'.
+    """
+
+    __tablename__ = 'image_sources'
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.Text, nullable=False, unique=True)
+    status = db.Column(db.Text, nullable=False, default='pending')
+    name = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_image_sources_status', 'status', 'id'),)
+
 class ChatGPTSession(db.Model):
     """
     Database model for ChatGPT sessions.
@@ -367,6 +796,32 @@ class ChatGPTSession(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'))
 
+@event.listens_for(Story.start_content, 'set')
+def _set_preview(story, value, oldvalue, initiator):
+    """
+    Keep a story's excerpt and word count in step with its content, whichever way it is set.
+
+    Bulk inserts and updates bypass this and must set them too.
+    """
+
+    story.excerpt = excerpt_of(value)
+    story.word_count = word_count(value)
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _hide_deleted(state):
+    """
+    Leave users and stories marked as deleted out of every ORM query, including relationship loads.
+
+    They stay in the database until 'flask deletion reap' removes them. A query can see them with
+    the 'include_deleted' execution option.
+    """
+
+    if state.is_select and not state.execution_options.get('include_deleted', False):
+        state.statement = state.statement.options(
+            with_loader_criteria(User, User.deleted_at.is_(None), include_aliases=True),
+            with_loader_criteria(Story, Story.deleted_at.is_(None), include_aliases=True),
+        )
+
 def connect_db(app):
     """
     Connects the application to the database.
@@ -0,0 +1,311 @@
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, Genre, UserGenre, StoryOpening, StoryStep, StoryCharacters
+from apicalls import complete, story_messages, save_story, MalformedCompletion
+from metrics import OPENING_CLAIMS, OPENINGS_GENERATED
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
+from sqlalchemy.orm.exc import StaleDataError
+from collections import Counter
+from itertools import groupby
+from time import sleep
+import click
+import os
+
+# Users pick up to this many genres per story (see forms.GenreLimit).
+MAX_GENRES = 3
+
+def pool_enabled():
+    """
+    Check whether generations are served from the warm pool, per 'OPENING_POOL_SIZE'.
+
+    Returns:
+        bool: True if the pool may hold any openings.
+    """
+
+    return current_app.config.get('OPENING_POOL_SIZE', 50) > 0
+
+def claim_opening(genre_ids, author_id):
+    """
+    Take a ready-made opening for exactly these genres from the warm pool and make it a story.
+
+    The opening row is locked with FOR UPDATE SKIP LOCKED, so concurrent generations for the same
+    genres each take a different opening instead of queueing behind one another. On databases
+    without row locks, a generation that loses the race to the same opening counts as a miss.
+
+    Args:
+        genre_ids (list): The IDs of the selected genres.
+        author_id (int): The ID of the user the story is for.
+
+    Returns:
+        Story or None: The new story, or None if the pool had nothing for these genres.
+    """
+
+    if not pool_enabled():
+        return None
+
+    opening = db.session.execute(
+        db.select(StoryOpening)
+        .where(StoryOpening.genre_key == StoryOpening.key_for(genre_ids), StoryOpening.story_id.is_(None))
+        .order_by(StoryOpening.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).scalar()
+
+    if opening is None:
+        OPENING_CLAIMS.labels('miss').inc()
+        return None
+
+    db.session.delete(opening)
+    try:
+        story = save_story(opening.title, opening.start_content, opening.choices, author_id)
+    except StaleDataError:
+        db.session.rollback()
+        OPENING_CLAIMS.labels('miss').inc()
+        return None
+
+    OPENING_CLAIMS.labels('hit').inc()
+    return story
+
+def release_alternates(story_id):
+    """
+    Stop offering a story's alternate openings, once the story has been continued.
+
+    Alternates of a story without characters fit anyone who picks the same genres, so they join
+    the warm pool instead of being thrown away; the others are deleted. Nothing is committed.
+
+    Args:
+        story_id (int): The ID of the story.
+    """
+
+    db.session.execute(
+        db.update(StoryOpening)
+        .where(StoryOpening.story_id == story_id,
+               ~db.exists().where(StoryCharacters.story_id == story_id))
+        .values(story_id=None)
+    )
+    db.session.execute(db.delete(StoryOpening).where(StoryOpening.story_id == story_id))
+
+def swap_alternate(story, opening):
+    """
+    Replace a story's opening with one of its alternates, keeping the replaced one as an alternate.
+
+    The story must not have been continued yet. Changes are committed.
+
+    Args:
+        story (Story): The story.
+        opening (StoryOpening): One of the story's alternates.
+    """
+
+    steps = sorted(story.story_steps, key=lambda step: step.id)
+    choices = list(opening.choices)
+
+    (story.title, story.start_content), (opening.title, opening.start_content, opening.choices) = (
+        (opening.title, opening.start_content),
+        (story.title, story.start_content, [step.content for step in steps]),
+    )
+
+    for step, choice in zip(steps, choices):
+        step.content = choice
+    for step in steps[len(choices):]:
+        db.session.delete(step)
+    for choice in choices[len(steps):]:
+        story.story_steps.append(StoryStep(content=choice))
+
+    db.session.commit()
+
+def popular_combinations(limit):
+    """
+    Rank genre combinations by how much demand the users' genre counts suggest for them.
+
+    UserGenre counts how often each user picked each genre, not which genres were picked together.
+    A user's usual combination is taken to be their most-picked genre plus any other genres they
+    picked at least half as often, up to MAX_GENRES, and it scores that user's top count.
+
+    Args:
+        limit (int): The number of combinations to return.
+
+    Returns:
+        list: (genre_key, score) tuples, most popular first.
+    """
+
+    rows = db.session.execute(
+        db.select(UserGenre.user_id, UserGenre.genre_id, UserGenre.count)
+        .where(UserGenre.count > 0)
+        .order_by(UserGenre.user_id, UserGenre.count.desc(), UserGenre.genre_id)
+    )
+
+    scores = Counter()
+    for user_id, picks in groupby(rows, key=lambda row: row.user_id):
+        picks = list(picks)[:MAX_GENRES]
+        top = picks[0].count
+        scores[StoryOpening.key_for([pick.genre_id for pick in picks if pick.count * 2 >= top])] += top
+
+    return scores.most_common(limit)
+
+def pool_targets():
+    """
+    Decide how many openings the pool should hold for each popular combination.
+
+    The 'OPENING_POOL_SIZE' openings are shared among the 'OPENING_POOL_COMBINATIONS' most popular
+    combinations in proportion to their scores, with at least one each.
+
+    Returns:
+        dict: Target counts by genre_key.
+    """
+
+    size = current_app.config.get('OPENING_POOL_SIZE', 50)
+    combinations = popular_combinations(current_app.config.get('OPENING_POOL_COMBINATIONS', 10))
+    total = sum(score for key, score in combinations)
+
+    return {key: max(1, size * score // total) for key, score in combinations}
+
+def pool_counts():
+    """
+    Count the openings waiting in the pool.
+
+    Returns:
+        dict: Counts by genre_key.
+    """
+
+    return dict(db.session.execute(
+        db.select(StoryOpening.genre_key, db.func.count())
+        .where(StoryOpening.story_id.is_(None))
+        .group_by(StoryOpening.genre_key)
+    ).all())
+
+def generate_opening(genre_key):
+    """
+    Write one opening for the pool.
+
+    The completion call is made outside any request, so it queues for an upstream slot like
+    any other call but isn't charged to a user's quota.
+
+    Args:
+        genre_key (str): The combination to write it for.
+
+    Returns:
+        StoryOpening: The new opening.
+    """
+
+    ids = [int(id) for id in genre_key.split(',')]
+    genres = [genre.name for genre in Genre.query.filter(Genre.id.in_(ids)).order_by(Genre.id)]
+    db.session.close()
+
+    parts, = complete('opening', story_messages(genres, []))
+
+    opening = StoryOpening(genre_key=genre_key, title=parts['title'], start_content=parts['start_content'],
+                           choices=parts['choices'])
+    db.session.add(opening)
+    db.session.commit()
+    OPENINGS_GENERATED.inc()
+
+    return opening
+
+def refill_pool():
+    """
+    Top up the warm pool once, writing at most 'OPENING_REFILL_BATCH' openings.
+
+    The combinations furthest below their target are filled first. If the pool holds more than
+    'OPENING_POOL_SIZE' openings, the oldest ones for combinations that are no longer popular
+    are removed.
+
+    Returns:
+        tuple: The number of openings (written, removed, failed).
+    """
+
+    targets = pool_targets()
+    counts = pool_counts()
+    batch = current_app.config.get('OPENING_REFILL_BATCH', 5)
+
+    excess = sum(counts.values()) - current_app.config.get('OPENING_POOL_SIZE', 50)
+    removed = 0
+    if excess > 0:
+        stale = db.session.scalars(
+            db.select(StoryOpening.id)
+            .where(StoryOpening.genre_key.not_in(targets or ['']), StoryOpening.story_id.is_(None))
+            .order_by(StoryOpening.id)
+            .limit(excess)
+        ).all()
+        if stale:
+            removed = db.session.execute(db.delete(StoryOpening).where(StoryOpening.id.in_(stale))).rowcount
+            db.session.commit()
+
+    wanted = Counter({key: target - counts.get(key, 0) for key, target in targets.items()})
+    written = failed = 0
+
+    while wanted and written + failed < batch:
+        key, missing = wanted.most_common(1)[0]
+        if missing <= 0:
+            break
+
+        wanted[key] -= 1
+        try:
+            generate_opening(key)
+            written += 1
+        except MalformedCompletion:
+            db.session.rollback()
+            failed += 1
+
+    return written, removed, failed
+
+def claim_counts():
+    """
+    Return the warm pool's claim outcomes recorded by Prometheus.
+
+    With 'PROMETHEUS_MULTIPROC_DIR' set, every worker's counts are included.
+
+    Returns:
+        dict: Counts by outcome, 'hit' and 'miss'.
+    """
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return {outcome: registry.get_sample_value('story_opening_claims_total', {'outcome': outcome}) or 0
+            for outcome in ('hit', 'miss')}
+
+openings_cli = AppGroup('openings', help="Manage the warm pool of pre-generated story openings.")
+
+@openings_cli.command('refill')
+@click.option('--watch', is_flag=True, help="Keep running, topping the pool up every interval.")
+@click.option('--interval', default=60, help="Seconds between passes with --watch.")
+def refill(watch, interval):
+    """
+    Write openings for the most popular genre combinations until the pool is full.
+
+    Each pass writes at most 'OPENING_REFILL_BATCH' openings, so together with --interval it
+    sets how fast the pool refills and how much upstream capacity it takes from live requests.
+    """
+
+    while True:
+        written, removed, failed = refill_pool()
+        click.echo(f"{written} written, {removed} removed, {failed} failed.")
+
+        if not watch:
+            break
+        sleep(interval)
+
+@openings_cli.command('report')
+def report():
+    """
+    Show the pool's contents against its targets, and how often generations were served from it.
+    """
+
+    targets, counts = pool_targets(), pool_counts()
+    names = dict(db.session.execute(db.select(Genre.id, Genre.name)).all())
+
+    click.echo(f"{'genres':<50} {'target':>6} {'ready':>6}")
+    for key in list(targets) + [key for key in counts if key not in targets]:
+        label = ', '.join(names.get(int(id), id) for id in key.split(','))
+        click.echo(f"{label[:50]:<50} {targets.get(key, 0):>6} {counts.get(key, 0):>6}")
+
+    claims = claim_counts()
+    total = claims['hit'] + claims['miss']
+    click.echo(f"{sum(counts.values())} ready of {current_app.config.get('OPENING_POOL_SIZE', 50)}.")
+    if total:
+        click.echo(f"Hit rate {claims['hit'] / total:.1%} of {total:.0f} claims.")
+    else:
+        click.echo("No claims recorded.")
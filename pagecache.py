@@ -0,0 +1,133 @@
+from flask import current_app
+from hashlib import sha256
+from datetime import datetime
+import json
+import os
+
+def cache_dir():
+    """
+    Return the directory holding rendered story chains.
+
+    The cache lives on the filesystem so every worker process on a host shares it, and an
+    invalidation in one worker is seen by all of them.
+
+    Returns:
+        str: The 'READ_CACHE_DIR' config value, or 'read-cache' in the app's instance folder.
+    """
+
+    return current_app.config.get('READ_CACHE_DIR') or os.path.join(current_app.instance_path, 'read-cache')
+
+def _chain_path(story_id):
+    return os.path.join(cache_dir(), 'chains', f"{story_id}.json")
+
+def _node_dir(story_id):
+    return os.path.join(cache_dir(), 'nodes', str(story_id))
+
+def get_cached_chain(story_id):
+    """
+    Look up the rendered chain ending at a story.
+
+    Args:
+        story_id (int): The ID of the last story in the chain.
+
+    Returns:
+        dict or None: The cache entry with 'etag', 'last_modified' (datetime) and 'html' keys,
+        or None if the chain is not cached or caching is disabled.
+    """
+
+    if not current_app.config.get('READ_CACHE', True):
+        return None
+
+    try:
+        with open(_chain_path(story_id)) as f:
+            entry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    entry['last_modified'] = datetime.fromisoformat(entry['last_modified'])
+    return entry
+
+def store_chain(story_id, chain, html):
+    """
+    Cache the rendered HTML for a finished chain.
+
+    The entry's ETag is a hash of the rendered fragment, so it only changes when the content does.
+    Every story in the chain gets a marker pointing back at the entry, so editing or deleting any
+    node in the chain can find and drop it.
+
+    Args:
+        story_id (int): The ID of the last story in the chain.
+        chain (list): The Story objects in the chain, root first.
+        html (str): The rendered chain fragment.
+
+    Returns:
+        dict: The cache entry, as returned by `get_cached_chain`.
+    """
+
+    entry = {
+        'etag': sha256(html.encode('UTF-8')).hexdigest(),
+        'last_modified': max(story.updated_at or story.created_at for story in chain).replace(microsecond=0),
+        'html': html
+    }
+
+    if not current_app.config.get('READ_CACHE', True):
+        return entry
+
+    for story in chain:
+        os.makedirs(_node_dir(story.id), exist_ok=True)
+        open(os.path.join(_node_dir(story.id), str(story_id)), 'w').close()
+
+    path = _chain_path(story_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(entry, last_modified=entry['last_modified'].isoformat()), f)
+    os.replace(tmp_path, path)
+
+    return entry
+
+def invalidate_story(story_id):
+    """
+    Drop every cached chain that includes a story.
+
+    Called whenever a story is edited or deleted.
+
+    Args:
+        story_id (int): The ID of the story that changed.
+    """
+
+    node_dir = _node_dir(story_id)
+
+    try:
+        dependents = os.listdir(node_dir)
+    except FileNotFoundError:
+        dependents = []
+
+    for dependent in dependents + [str(story_id)]:
+        try:
+            os.remove(_chain_path(dependent))
+        except FileNotFoundError:
+            pass
+
+    for dependent in dependents:
+        try:
+            os.remove(os.path.join(node_dir, dependent))
+        except FileNotFoundError:
+            pass
+
+def user_etag(entry, user):
+    """
+    Build the strong ETag for a cached chain as seen by a particular user.
+
+    The page around the chain shows the user's name and avatar, so those are part of the tag.
+
+    Args:
+        entry (dict): The cache entry.
+        user (User): The user viewing the page.
+
+    Returns:
+        str: The ETag value, without quotes.
+    """
+
+    return sha256(f"{entry['etag']}:{user.id}:{user.username}:{user.image_url}".encode('UTF-8')).hexdigest()
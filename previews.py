@@ -0,0 +1,64 @@
+from flask.cli import AppGroup
+from models import db, Story, StoryNode, excerpt_of, word_count
+import click
+
+def backfill_batch(batch_size=500):
+    """
+    Fill in the excerpt, word count and chain length of a batch of stories written before they existed.
+
+    Chain lengths come from the story-tree analytics, so run 'flask analytics refresh --backfill'
+    first; stories no tree accounts for count as roots. Changes are committed.
+
+    Args:
+        batch_size (int, optional): The most stories updated.
+
+    Returns:
+        int: The number of stories updated; 0 once none are left.
+    """
+
+    rows = db.session.execute(
+        db.select(Story.id, Story.start_content)
+        .where(Story.excerpt.is_(None))
+        .order_by(Story.id)
+        .limit(batch_size)
+        .execution_options(include_deleted=True)
+    ).all()
+
+    if not rows:
+        return 0
+
+    db.session.execute(db.update(Story), [
+        {'id': row.id, 'excerpt': excerpt_of(row.start_content), 'word_count': word_count(row.start_content)}
+        for row in rows
+    ])
+    db.session.execute(
+        db.update(Story)
+        .where(Story.id.in_([row.id for row in rows]))
+        .values(chain_length=db.func.coalesce(
+            db.select(StoryNode.depth + 1).where(StoryNode.story_id == Story.id).scalar_subquery(), 1))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    return len(rows)
+
+previews_cli = AppGroup('previews', help="Maintain story excerpts, word counts and chain lengths.")
+
+@previews_cli.command('backfill')
+@click.option('--batch-size', default=500, help="Number of stories updated per transaction.")
+def backfill(batch_size):
+    """
+    Fill in the excerpt, word count and chain length of stories written before they existed.
+
+    New and edited stories keep them up to date on their own; run this once after adding the columns.
+    """
+
+    count = 0
+
+    while True:
+        updated = backfill_batch(batch_size)
+        if not updated:
+            break
+        count += updated
+
+    click.echo(f"{count} stories updated.")
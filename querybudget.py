@@ -0,0 +1,91 @@
+from flask import current_app, g, request
+from werkzeug.exceptions import InternalServerError
+from contextlib import contextmanager
+from functools import wraps
+
+budgets = {}
+
+class QueryBudgetExceeded(InternalServerError):
+    """
+    Raised in 'raise' mode when a view runs more SQL statements than its declared budget.
+
+    It is an HTTPException, so the general error handler lets it through as a 500 instead of
+    redirecting to '/oops', and tests see it as a failed response.
+    """
+
+def budget_mode():
+    """
+    Return how budget overruns are handled for the current app.
+
+    The 'QUERY_BUDGET_MODE' config value wins if set; otherwise overruns raise under testing,
+    warn in debug mode, and are ignored in production.
+
+    Returns:
+        str: 'raise', 'warn' or 'off'.
+    """
+
+    mode = current_app.config.get('QUERY_BUDGET_MODE')
+    if mode:
+        return mode
+
+    if current_app.testing:
+        return 'raise'
+    if current_app.debug:
+        return 'warn'
+    return 'off'
+
+@contextmanager
+def unbudgeted():
+    """
+    Leave the statements run inside the block out of the current view's budget.
+
+    For work whose statement count depends on timing rather than data, such as polling for
+    another request's result.
+    """
+
+    start = g.get('sql_statements', 0)
+    try:
+        yield
+    finally:
+        g.unbudgeted_statements = g.get('unbudgeted_statements', 0) + g.get('sql_statements', 0) - start
+
+def query_budget(limit):
+    """
+    Declare the maximum number of SQL statements a view may run per request.
+
+    Statements are counted by the engine listener in 'metrics.py', including those issued by
+    decorators inside this one and by lazy loads while rendering templates. Place it directly
+    under the route decorator so it covers the whole view. A budget is a constant: a view whose
+    statement count grows with the data it shows has an N+1 problem.
+
+    Args:
+        limit (int): The maximum number of statements.
+
+    Returns:
+        function: The decorator.
+    """
+
+    def decorator(f):
+        budgets[f.__name__] = limit
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            mode = budget_mode()
+            if mode == 'off':
+                return f(*args, **kwargs)
+
+            start = g.get('sql_statements', 0) - g.get('unbudgeted_statements', 0)
+            rv = f(*args, **kwargs)
+            used = g.get('sql_statements', 0) - g.get('unbudgeted_statements', 0) - start
+
+            if used > limit:
+                message = f"{request.endpoint} ran {used} SQL statements, over its budget of {limit}."
+                if mode == 'raise':
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+
+            return rv
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,154 @@
+from flask import current_app, g, session, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.sql.dml import UpdateBase
+from functools import wraps
+from time import time
+import random
+
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+lag_checks = {}
+
+def replica_binds(urls):
+    """
+    Build the 'SQLALCHEMY_BINDS' entries for a list of replica URLs.
+
+    Args:
+        urls (list): Database URLs of the read replicas.
+
+    Returns:
+        dict: One 'replica_<n>' bind per URL.
+    """
+
+    return {f"replica_{n}": url for n, url in enumerate(urls)}
+
+def replica_lag(key, engine):
+    """
+    Return how far a replica is behind the primary, in seconds.
+
+    The lag is measured at most once every 'DB_REPLICA_LAG_CHECK_SECONDS' per replica and
+    process. A replica that can't be reached counts as infinitely behind. Only Postgres reports
+    replication lag; any other database is treated as up to date, which is what a local setup
+    with two independent databases needs.
+
+    Args:
+        key (str): The replica's bind key.
+        engine (Engine): The replica's engine.
+
+    Returns:
+        float: The lag in seconds.
+    """
+
+    checked_at, lag = lag_checks.get(key, (0, 0))
+    if time() - checked_at < current_app.config.get('DB_REPLICA_LAG_CHECK_SECONDS', 1):
+        return lag
+
+    if engine.dialect.name != 'postgresql':
+        lag = 0
+    else:
+        try:
+            with engine.connect() as conn:
+                lag = float(conn.execute(REPLICA_LAG_SQL).scalar())
+        except Exception:
+            current_app.logger.warning(f"Could not check replication lag on {key}.", exc_info=True)
+            lag = float('inf')
+
+    lag_checks[key] = (time(), lag)
+    return lag
+
+def choose_replica(engines):
+    """
+    Pick a replica to serve the current request's reads.
+
+    Replicas further behind than 'DB_REPLICA_MAX_LAG' seconds are skipped; among the rest, one is
+    picked at random. The choice is remembered for the rest of the request so its reads are consistent.
+
+    Args:
+        engines (dict): The app's engines by bind key.
+
+    Returns:
+        Engine or None: The replica's engine, or None if no replica is configured or up to date.
+    """
+
+    if 'db_replica' not in g:
+        max_lag = current_app.config.get('DB_REPLICA_MAX_LAG', 2)
+        keys = [key for key in engines if key and key.startswith('replica_')]
+        fresh = [key for key in keys if replica_lag(key, engines[key]) <= max_lag]
+        g.db_replica = random.choice(fresh) if fresh else None
+
+    return engines[g.db_replica] if g.db_replica else None
+
+def wrote_recently():
+    """
+    Check whether the current user wrote to the database within the read-your-writes window.
+
+    Returns:
+        bool: True if the user's last write was less than 'DB_STICKY_SECONDS' ago.
+    """
+
+    last_write = session.get('db_last_write')
+    return last_write is not None and time() - last_write < current_app.config.get('DB_STICKY_SECONDS', 5)
+
+class RoutingSession(Session):
+    """
+    Session that sends the reads of read-only views to a replica.
+
+    Inside a view marked with `read_only`, SELECTs go to one of the 'replica_<n>' binds. Flushes
+    and explicit INSERT, UPDATE and DELETE statements always go to the primary, as does
+    everything outside read-only views.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and not isinstance(clause, UpdateBase)
+                and has_request_context() and g.get('db_read_only')):
+            engine = choose_replica(self._db.engines)
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def record_write():
+    """
+    Note that the current user just wrote to the database, or saw a write that may not have
+    reached the replicas yet, so their reads stay on the primary for 'DB_STICKY_SECONDS'.
+    """
+
+    if has_request_context():
+        session['db_last_write'] = time()
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_flush(db_session, flush_context):
+    record_write()
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _record_statement(orm_execute_state):
+    # INSERT, UPDATE and DELETE statements run with session.execute() bypass the flush.
+    if isinstance(orm_execute_state.statement, UpdateBase):
+        record_write()
+
+def read_only(f):
+    """
+    Decorator to serve a view's reads from a read replica.
+
+    A user who wrote to the database in the last 'DB_STICKY_SECONDS' stays on the primary, so
+    they always see their own changes, such as a new story on the profile page right after
+    continuing it. Reads also stay on the primary when every replica is lagging, or when none
+    is configured.
+
+    Args:
+        f (function): The function to be decorated.
+
+    Returns:
+        function: The decorated function.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_read_only = not wrote_recently()
+        return f(*args, **kwargs)
+
+    return decorated_function
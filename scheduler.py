@@ -0,0 +1,450 @@
+from flask import current_app, render_template, request, make_response
+from models import db, LLMQuota, LLMTicket, LLMSchedulerState
+from querybudget import unbudgeted
+from sqlalchemy.exc import IntegrityError
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import time, sleep
+import asyncio
+
+# Tokens a completion call is assumed to use when queueing it, before its real usage is known.
+TOKENS_ESTIMATE = 1500
+
+POLL_SECONDS = 0.25
+
+# Postgres advisory lock key held by the request granting slots; any constant not used elsewhere.
+GRANT_LOCK = 7461923
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a user's generation has to wait: they are over quota, or the queue for upstream
+    capacity didn't reach them in time.
+
+    Args:
+        retry_after (float): Seconds until the user can expect to be served.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Generation quota exceeded; retry in {retry_after:.0f} seconds.")
+        self.retry_after = retry_after
+
+def enabled():
+    """
+    Check whether completion calls are scheduled, per the 'LLM_SCHEDULER' config value.
+
+    Returns:
+        bool: True unless the scheduler is turned off.
+    """
+
+    return current_app.config.get('LLM_SCHEDULER', True)
+
+def _locked_quota(user_id, now):
+    """
+    Lock a user's quota row and refill its buckets up to now, creating it full if it's missing.
+
+    Args:
+        user_id (int): The ID of the user.
+        now (datetime): The current time.
+
+    Returns:
+        LLMQuota: The quota, added to the session but not committed.
+    """
+
+    rpm = current_app.config.get('LLM_USER_RPM', 6)
+    tpm = current_app.config.get('LLM_USER_TPM', 20000)
+
+    quota = db.session.execute(
+        db.select(LLMQuota).where(LLMQuota.user_id == user_id).with_for_update()
+    ).scalar()
+
+    if quota is None:
+        quota = LLMQuota(user_id=user_id, requests=rpm, tokens=tpm, last_finish=0, updated_at=now)
+        db.session.add(quota)
+        return quota
+
+    elapsed = (now - quota.updated_at).total_seconds()
+    quota.requests = min(rpm, quota.requests + elapsed * rpm / 60)
+    quota.tokens = min(tpm, quota.tokens + elapsed * tpm / 60)
+    quota.updated_at = now
+
+    return quota
+
+def _with_quota(user_id, change):
+    """
+    Apply a change to a user's refilled quota and commit it, retrying once if another worker
+    created the row at the same moment.
+
+    Args:
+        user_id (int): The ID of the user.
+        change (function): Called with the locked LLMQuota and the current time; its return
+            value is passed through.
+
+    Returns:
+        The return value of `change`.
+    """
+
+    for attempt in (1, 2):
+        now = datetime.utcnow()
+        result = change(_locked_quota(user_id, now), now)
+        try:
+            db.session.commit()
+            return result
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == 2:
+                raise
+
+def admit(user_id):
+    """
+    Take one request from a user's quota before starting a generation.
+
+    A generation is admitted while the user has a whole request left in their bucket and their
+    token bucket isn't overdrawn. Buckets refill continuously at 'LLM_USER_RPM' requests and
+    'LLM_USER_TPM' tokens per minute, up to one minute's worth.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Raises:
+        QuotaExceeded: If the user is over quota, with the time until they won't be.
+    """
+
+    if not enabled() or user_id is None:
+        return
+
+    rpm = current_app.config.get('LLM_USER_RPM', 6)
+    tpm = current_app.config.get('LLM_USER_TPM', 20000)
+
+    def take(quota, now):
+        wait = 0
+        if quota.requests < 1:
+            wait = (1 - quota.requests) * 60 / rpm
+        if quota.tokens < 0:
+            wait = max(wait, -quota.tokens * 60 / tpm)
+        if not wait:
+            quota.requests -= 1
+        return wait
+
+    wait = _with_quota(user_id, take)
+    if wait:
+        raise QuotaExceeded(wait)
+
+def charge(user_id, tokens):
+    """
+    Take the tokens a completion call actually used from the user's token bucket.
+
+    The bucket may go negative; the user then waits until it refills above zero.
+
+    Args:
+        user_id (int): The ID of the user.
+        tokens (int): The tokens used.
+    """
+
+    if not enabled() or user_id is None or not tokens:
+        return
+
+    def take(quota, now):
+        quota.tokens -= tokens
+
+    _with_quota(user_id, take)
+
+def _state():
+    state = db.session.execute(db.select(LLMSchedulerState).with_for_update()).scalar()
+    if state is None:
+        state = LLMSchedulerState(id=1, virtual_time=0)
+        db.session.add(state)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return _state()
+    return state
+
+def enqueue(user_id, weight):
+    """
+    Queue a completion call for an upstream slot.
+
+    Its finish tag is the later of the scheduler's virtual time and the user's previous finish
+    tag, plus the call's estimated cost divided by the user's weight. Users who queue a lot of
+    calls push their own later calls back, while a user with nothing queued goes near the front.
+
+    Args:
+        user_id (int): The ID of the user, or None.
+        weight (float): The user's share of capacity relative to others.
+
+    Returns:
+        int: The ticket's ID.
+    """
+
+    def add_ticket(quota, now):
+        tag = max(virtual_time, quota.last_finish if quota else 0) + TOKENS_ESTIMATE / weight
+        if quota:
+            quota.last_finish = tag
+        ticket = LLMTicket(user_id=user_id, finish_tag=tag, created_at=now)
+        db.session.add(ticket)
+        db.session.flush()
+        return ticket.id
+
+    virtual_time = db.session.execute(db.select(LLMSchedulerState.virtual_time)).scalar() or 0
+
+    if user_id is None:
+        ticket_id = add_ticket(None, datetime.utcnow())
+        db.session.commit()
+        return ticket_id
+
+    return _with_quota(user_id, add_ticket)
+
+def _grant_lock():
+    """
+    Try to become the one request granting slots, until the end of the transaction.
+
+    On Postgres this is a transaction-level advisory lock, which isn't waited for. Other
+    databases serialize writers anyway, so there it always succeeds.
+
+    Returns:
+        bool: True if the caller may grant slots.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return True
+
+    return db.session.execute(db.select(db.func.pg_try_advisory_xact_lock(GRANT_LOCK))).scalar()
+
+def grant():
+    """
+    Hand free upstream slots to the waiting tickets with the lowest finish tags.
+
+    At most 'LLM_MAX_CONCURRENCY' tickets run at once. Tickets of calls that ran longer than
+    'LLM_CALL_TIMEOUT' seconds, or waited far longer than anyone waits, are assumed to belong to
+    dead workers and are removed. Any waiting request may grant slots, including to others, but
+    only one at a time: the others return at once and just check their own ticket, instead of
+    queueing on the scheduler's state row every poll.
+    """
+
+    if not _grant_lock():
+        db.session.rollback()
+        return
+
+    state = _state()
+    now = datetime.utcnow()
+
+    db.session.execute(db.delete(LLMTicket).where(db.or_(
+        db.and_(LLMTicket.running, LLMTicket.started_at < now - timedelta(seconds=current_app.config.get('LLM_CALL_TIMEOUT', 120))),
+        db.and_(db.not_(LLMTicket.running), LLMTicket.created_at < now - timedelta(seconds=current_app.config.get('LLM_QUEUE_MAX_WAIT', 30) * 2))
+    )))
+
+    running = db.session.execute(db.select(db.func.count()).where(LLMTicket.running)).scalar()
+    free = current_app.config.get('LLM_MAX_CONCURRENCY', 20) - running
+
+    if free > 0:
+        heads = db.session.execute(
+            db.select(LLMTicket.id, LLMTicket.finish_tag)
+            .where(db.not_(LLMTicket.running))
+            .order_by(LLMTicket.finish_tag, LLMTicket.id)
+            .limit(free)
+        ).all()
+
+        if heads:
+            db.session.execute(
+                db.update(LLMTicket).where(LLMTicket.id.in_([id for id, tag in heads])).values(running=True, started_at=now)
+            )
+            state.virtual_time = max(state.virtual_time, heads[-1].finish_tag)
+
+    db.session.commit()
+
+def is_running(ticket_id):
+    """
+    Check a ticket's state.
+
+    Args:
+        ticket_id (int): The ticket's ID.
+
+    Returns:
+        bool or None: Whether it holds a slot, or None if it was removed.
+    """
+
+    running = db.session.execute(db.select(LLMTicket.running).where(LLMTicket.id == ticket_id)).scalar()
+    db.session.rollback()
+    return running
+
+def release(ticket_id):
+    """
+    Give up a ticket, freeing its slot if it held one.
+
+    Runs on a connection of its own and leaves the session alone, so it is safe to call while
+    the caller's session is mid-transaction, or in use on another thread of the same request.
+
+    Args:
+        ticket_id (int): The ticket's ID, or None for a call the scheduler didn't queue.
+    """
+
+    if ticket_id is None:
+        return
+
+    with db.engine.begin() as connection:
+        connection.execute(db.delete(LLMTicket).where(LLMTicket.id == ticket_id))
+
+def acquire(user_id, weight=1):
+    """
+    Wait for one of the upstream slots in the fair queue, and take it.
+
+    When a slot is free and nobody is queued, it is taken at once (see `try_acquire`), without
+    queueing a ticket or polling for it; queueing only starts once calls contend for slots.
+    The slot is held until it is given back with `release`, which the caller must do once the
+    call it was taken for has finished, even if that is after the caller stopped waiting for
+    it. Whether a call queues, and for how long, depends on timing rather than data, so none of
+    this counts against the view's query budget.
+
+    Args:
+        user_id (int): The ID of the user, or None.
+        weight (float, optional): The user's share of capacity. Defaults to 1.
+
+    Returns:
+        int or None: The ID of the ticket holding the slot, or None if the scheduler is off.
+
+    Raises:
+        QuotaExceeded: If no slot was granted within 'LLM_QUEUE_MAX_WAIT' seconds.
+    """
+
+    if not enabled():
+        return None
+
+    with unbudgeted():
+        ticket_id = try_acquire(user_id)
+        if ticket_id is not None:
+            return ticket_id
+
+        ticket_id = enqueue(user_id, weight)
+        deadline = time() + current_app.config.get('LLM_QUEUE_MAX_WAIT', 30)
+
+        try:
+            while True:
+                grant()
+                running = is_running(ticket_id)
+                if running:
+                    return ticket_id
+                if running is None or time() > deadline:
+                    raise QuotaExceeded(POLL_SECONDS * 20)
+                sleep(POLL_SECONDS)
+        except BaseException:
+            release(ticket_id)
+            raise
+
+async def acquire_async(user_id, weight=1):
+    """
+    Async counterpart of `acquire`, polling on a worker thread and sleeping on the event loop.
+
+    Args:
+        user_id (int): The ID of the user, or None.
+        weight (float, optional): The user's share of capacity. Defaults to 1.
+
+    Returns:
+        int or None: The ID of the ticket holding the slot, or None if the scheduler is off.
+
+    Raises:
+        QuotaExceeded: If no slot was granted within 'LLM_QUEUE_MAX_WAIT' seconds.
+    """
+
+    if not enabled():
+        return None
+
+    ticket_id = await asyncio.to_thread(try_acquire, user_id)
+    if ticket_id is not None:
+        return ticket_id
+
+    ticket_id = await asyncio.to_thread(enqueue, user_id, weight)
+    deadline = time() + current_app.config.get('LLM_QUEUE_MAX_WAIT', 30)
+
+    def poll():
+        grant()
+        return is_running(ticket_id)
+
+    try:
+        while True:
+            running = await asyncio.to_thread(poll)
+            if running:
+                return ticket_id
+            if running is None or time() > deadline:
+                raise QuotaExceeded(POLL_SECONDS * 20)
+            await asyncio.sleep(POLL_SECONDS)
+    except BaseException:
+        await asyncio.to_thread(release, ticket_id)
+        raise
+
+def try_acquire(user_id):
+    """
+    Take an upstream slot without queueing, but only if one is free and no call is waiting for it.
+
+    For calls worth making only with spare capacity, such as hedged backup requests, so they
+    never hold up anyone's primary call; `acquire` also tries it before queueing. Give the slot
+    back with `release`.
+
+    Args:
+        user_id (int): The ID of the user, or None.
+
+    Returns:
+        int or None: The ID of the ticket holding the slot, or None if none was free, or another
+        request was granting slots at that moment.
+    """
+
+    if not _grant_lock():
+        db.session.rollback()
+        return None
+
+    state = _state()
+    now = datetime.utcnow()
+
+    running = db.session.execute(db.select(db.func.count()).where(LLMTicket.running)).scalar()
+    queued = db.session.execute(db.select(LLMTicket.id).where(db.not_(LLMTicket.running)).limit(1)).first()
+
+    if running >= current_app.config.get('LLM_MAX_CONCURRENCY', 20) or queued:
+        db.session.commit()
+        return None
+
+    ticket = LLMTicket(user_id=user_id, finish_tag=state.virtual_time, running=True, created_at=now, started_at=now)
+    db.session.add(ticket)
+    db.session.flush()
+    ticket_id = ticket.id
+    db.session.commit()
+
+    return ticket_id
+
+@contextmanager
+def slot(user_id, weight=1):
+    """
+    Hold one of the upstream slots for the duration of the block, waiting for it in the fair queue.
+
+    Args:
+        user_id (int): The ID of the user, or None.
+        weight (float, optional): The user's share of capacity. Defaults to 1.
+
+    Raises:
+        QuotaExceeded: If no slot was granted within 'LLM_QUEUE_MAX_WAIT' seconds.
+    """
+
+    ticket_id = acquire(user_id, weight)
+    try:
+        yield
+    finally:
+        release(ticket_id)
+
+def queued_response(error):
+    """
+    Tell a user their generation is waiting, and resubmit it when the wait is over.
+
+    The page carries the submitted form, including its idempotency key, and posts it again
+    after the wait, so the user keeps their place instead of seeing an error.
+
+    Args:
+        error (QuotaExceeded): The exception raised.
+
+    Returns:
+        Response: The 'stories/queued.html' page with status 429 and a Retry-After header.
+    """
+
+    retry_after = max(1, round(error.retry_after))
+    response = make_response(render_template('/stories/queued.html', retry_after=retry_after,
+                                              action=request.path, fields=request.form.items(multi=True)), 429)
+    response.headers['Retry-After'] = str(retry_after)
+
+    return response
@@ -1,6 +1,8 @@
-from app import app
+from app import create_app
 from models import db, Genre, User
 
+app = create_app()
+
 with app.app_context():
     db.drop_all()
     db.create_all()
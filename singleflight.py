@@ -0,0 +1,230 @@
+from flask import current_app, request
+from flask_login import current_user
+from models import db, GenerationRequest
+from querybudget import unbudgeted
+from scheduler import QuotaExceeded
+from replicas import record_write
+from time import time, sleep
+from uuid import uuid4
+import asyncio
+
+POLL_SECONDS = 0.5
+
+class GenerationFailed(Exception):
+    """
+    Raised to a request that waited for a duplicate's generation when that generation failed.
+
+    Args:
+        key (str): The generation key.
+    """
+
+    def __init__(self, key):
+        super().__init__(f"Generation {key} failed.")
+        self.key = key
+
+class GenerationAbandoned(Exception):
+    """
+    Raised to a request that waited for a duplicate's generation when that generation was given
+    up without running, such as for being over quota. The waiter may claim the key itself.
+
+    Args:
+        key (str): The generation key.
+    """
+
+    def __init__(self, key):
+        super().__init__(f"Generation {key} was abandoned.")
+        self.key = key
+
+def new_idempotency_key():
+    """
+    Generate an idempotency key for a form.
+
+    Available in templates as `idempotency_key()`. Every rendered generation form carries its own
+    key, so a double-click or a browser retry of the same form repeats the key, while choosing
+    again later from a fresh page gets a new one.
+
+    Returns:
+        str: The key.
+    """
+
+    return uuid4().hex
+
+def generation_key(kind):
+    """
+    Return the key identifying the generation the current request asks for.
+
+    Args:
+        kind (str): The kind of generation, such as 'generate' or 'continue'.
+
+    Returns:
+        str: The kind plus the form's idempotency key. A request without one gets a fresh key,
+        so it is never mistaken for a duplicate.
+    """
+
+    key = request.form.get('idempotency_key', '')[:64] or new_idempotency_key()
+    return f"{kind}:{key}"
+
+def claim(user_id, key):
+    """
+    Try to become the request that runs the generation for a key.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+
+    Returns:
+        bool: True if the caller should run the generation and then call `finish`.
+    """
+
+    return GenerationRequest.claim(user_id, key, current_app.config.get('GENERATION_STALE_SECONDS', 300))
+
+def finish(user_id, key, story_id=None):
+    """
+    Publish the outcome of a claimed generation to the requests waiting for it.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+        story_id (int, optional): The story produced, or None if the generation failed.
+    """
+
+    GenerationRequest.finish(user_id, key, story_id)
+
+def fail(user_id, key):
+    """
+    Record that a claimed generation failed, discarding any half-written changes first.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+    """
+
+    db.session.rollback()
+    finish(user_id, key)
+
+def abandon(user_id, key):
+    """
+    Give up a claimed generation that didn't run, discarding any half-written changes first.
+
+    Unlike `fail`, duplicates waiting for it aren't told it failed: they claim the key in turn,
+    and a resubmission of the form starts over as if it were the first.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+    """
+
+    db.session.rollback()
+    GenerationRequest.release(user_id, key)
+
+def wait(user_id, key):
+    """
+    Wait for another request's generation to finish.
+
+    Each poll reads on a connection of its own (see `GenerationRequest.status_of`), so no
+    connection is held between polls and the caller's session is left alone. The polls don't
+    count against the view's query budget. Once the story is written, the user's reads stick to
+    the primary as if they had written it themselves, since a replica may not have it yet.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+
+    Returns:
+        int or None: The ID of the story produced, or None if the generation did not finish
+        within 'GENERATION_WAIT_SECONDS'.
+
+    Raises:
+        GenerationFailed: If the generation failed.
+        GenerationAbandoned: If the generation was abandoned.
+    """
+
+    deadline = time() + current_app.config.get('GENERATION_WAIT_SECONDS', 90)
+
+    with unbudgeted():
+        while True:
+            status, story_id = GenerationRequest.status_of(user_id, key)
+            if status is None:
+                raise GenerationAbandoned(key)
+            if status == 'failed':
+                raise GenerationFailed(key)
+            if status == 'done':
+                record_write()
+                return story_id
+            if time() > deadline:
+                return None
+            sleep(POLL_SECONDS)
+
+async def wait_async(user_id, key):
+    """
+    Async counterpart of `wait`, polling on a worker thread and sleeping on the event loop.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The generation key.
+
+    Returns:
+        int or None: The ID of the story produced, or None if the wait timed out.
+
+    Raises:
+        GenerationFailed: If the generation failed.
+        GenerationAbandoned: If the generation was abandoned.
+    """
+
+    deadline = time() + current_app.config.get('GENERATION_WAIT_SECONDS', 90)
+
+    while True:
+        status, story_id = await asyncio.to_thread(GenerationRequest.status_of, user_id, key)
+        if status is None:
+            raise GenerationAbandoned(key)
+        if status == 'failed':
+            raise GenerationFailed(key)
+        if status == 'done':
+            record_write()
+            return story_id
+        if time() > deadline:
+            return None
+        await asyncio.sleep(POLL_SECONDS)
+
+def single_flight(key, generate):
+    """
+    Run a generation once per key, however many duplicate requests arrive.
+
+    The first request to claim the key runs `generate`; concurrent duplicates, in this process or
+    any other worker, wait for it and share its story instead of paying for their own completion.
+    A generation held back by the scheduler is abandoned rather than failed, so a waiting
+    duplicate takes it over, and is held back in turn if the user is still over quota.
+
+    Args:
+        key (str): The generation key, from `generation_key`.
+        generate (function): Called with no arguments by the request that runs the generation;
+            returns the new Story.
+
+    Returns:
+        int or None: The ID of the story produced, or None if the wait for a duplicate timed out.
+
+    Raises:
+        GenerationFailed: If this request waited for a duplicate whose generation failed. The
+            request that ran a failed generation gets its exception instead.
+        QuotaExceeded: If `generate` raised it.
+    """
+
+    user_id = current_user.id
+
+    while not claim(user_id, key):
+        try:
+            return wait(user_id, key)
+        except GenerationAbandoned:
+            pass
+
+    try:
+        story = generate()
+    except QuotaExceeded:
+        abandon(user_id, key)
+        raise
+    except Exception:
+        fail(user_id, key)
+        raise
+
+    finish(user_id, key, story.id)
+    return story.id
@@ -0,0 +1,267 @@
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from logging.handlers import RotatingFileHandler
+from collections import deque
+from datetime import datetime
+from time import perf_counter
+import traceback
+import glob
+import logging
+import random
+import json
+import os
+import re
+
+recent = deque(maxlen=500)
+
+logger = logging.getLogger('slowquery')
+logger.propagate = False
+
+settings = {'threshold': None, 'explain_rate': 0.0}
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class ProcessFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that gives every process a file of its own, '<name>.<pid>.jsonl'.
+
+    Gunicorn workers can't share one rotating file: each rotates by renaming it, from under the
+    others, which lose or interleave lines. The file is picked on the first record after a fork,
+    so a handler set up in a preloading master still writes one file per worker.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.pid = os.getpid()
+        super().__init__(process_log_path(path, self.pid), delay=True, **kwargs)
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(process_log_path(self.path, self.pid))
+
+        super().emit(record)
+
+def process_log_path(path, pid):
+    """
+    Return the file a process writes its slow statements to.
+
+    Args:
+        path (str): The configured log path, such as 'slow-queries.jsonl'.
+        pid (int): The process ID.
+
+    Returns:
+        str: The path with the process ID before the extension, such as 'slow-queries.123.jsonl'.
+    """
+
+    stem, extension = os.path.splitext(path)
+
+    return f"{stem}.{pid}{extension}"
+
+def fingerprint(statement):
+    """
+    Normalize a SQL statement so executions of the same query group together.
+
+    Literals and bind parameters become '?', IN lists collapse to a single element, and
+    whitespace and case are normalized.
+
+    Args:
+        statement (str): The SQL statement.
+
+    Returns:
+        str: The normalized statement.
+    """
+
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r"%\(\w+\)s|%s|:\w+|\$\d+|\b\d+(?:\.\d+)?\b", '?', statement)
+    statement = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", '(?)', statement)
+    statement = re.sub(r"\s+", ' ', statement)
+
+    return statement.strip().lower()
+
+def call_site():
+    """
+    Find the line of our own code that issued the current statement.
+
+    Returns:
+        str: 'file:line in function' for the innermost frame in this project outside
+        site-packages, or None if there is none.
+    """
+
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        if frame.filename.startswith(PROJECT_DIR) and 'site-packages' not in frame.filename \
+                and os.path.basename(frame.filename) != 'slowquery.py':
+            return f"{os.path.relpath(frame.filename, PROJECT_DIR)}:{frame.lineno} in {frame.name}"
+
+    return None
+
+def explain(conn, statement, parameters):
+    """
+    Run EXPLAIN (ANALYZE, BUFFERS) for a read-only statement on the same connection.
+
+    The plan is captured inside a savepoint, so a failure can't abort the surrounding transaction.
+
+    Args:
+        conn (Connection): The SQLAlchemy connection the statement ran on.
+        statement (str): The SQL statement.
+        parameters (dict or tuple): Its bind parameters.
+
+    Returns:
+        str or None: The plan text, or None if it could not be captured.
+    """
+
+    cursor = conn.connection.cursor()
+
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return None
+    finally:
+        cursor.close()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.slow_query_start = perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (perf_counter() - context.slow_query_start) * 1000
+
+    if settings['threshold'] is None or duration_ms < settings['threshold']:
+        return
+
+    user = g.get('_login_user') if has_request_context() else None
+
+    entry = {
+        'at': datetime.utcnow().isoformat(),
+        'duration_ms': round(duration_ms, 2),
+        'statement': statement,
+        'parameters': repr(parameters)[:2000],
+        'fingerprint': fingerprint(statement),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'user_id': getattr(user, 'id', None),
+        'call_site': call_site(),
+        'plan': None,
+    }
+
+    if (conn.dialect.name == 'postgresql'
+            and statement.lstrip()[:6].upper() in ('SELECT', 'WITH R', 'WITH C')
+            and random.random() < settings['explain_rate']):
+        entry['plan'] = explain(conn, statement, parameters)
+
+    recent.append(entry)
+    logger.info(json.dumps(entry))
+
+def init_slow_query_log(app):
+    """
+    Start recording statements slower than 'SLOW_QUERY_MS' for an application.
+
+    Each slow statement is kept in an in-process ring buffer of 'SLOW_QUERY_BUFFER' entries and
+    appended as a JSON line to this process's own file next to 'SLOW_QUERY_LOG' (see
+    `ProcessFileHandler`), which rotates at 10 MB. On Postgres, a fraction
+    'SLOW_QUERY_EXPLAIN_RATE' of slow SELECTs also get their EXPLAIN (ANALYZE, BUFFERS) output.
+
+    Args:
+        app (Flask application): The application to record for.
+    """
+
+    threshold = app.config.get('SLOW_QUERY_MS')
+    if threshold is None:
+        return
+
+    settings['threshold'] = float(threshold)
+    settings['explain_rate'] = float(app.config.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+
+    global recent
+    recent = deque(recent, maxlen=int(app.config.get('SLOW_QUERY_BUFFER', 500)))
+
+    path = slow_query_log_path(app)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if not logger.handlers:
+        handler = ProcessFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+def slow_query_log_path(app):
+    """
+    Return the path the slow-query JSONL files are named after.
+
+    Args:
+        app (Flask application): The application.
+
+    Returns:
+        str: The 'SLOW_QUERY_LOG' config value, or 'slow-queries.jsonl' in the app's instance folder.
+    """
+
+    return app.config.get('SLOW_QUERY_LOG') or os.path.join(app.instance_path, 'slow-queries.jsonl')
+
+def recent_entries():
+    """
+    Return the slow statements held in this process's ring buffer, newest first.
+
+    Returns:
+        list: The entries.
+    """
+
+    return list(reversed(recent))
+
+def summarize(app, limit=50):
+    """
+    Group logged slow statements by fingerprint, slowest total first.
+
+    Reads every process's JSONL file rather than the ring buffer, so the summary covers every
+    worker, including the ones that have since exited, and the single file written before the
+    log was split per process.
+
+    Args:
+        app (Flask application): The application.
+        limit (int, optional): The maximum number of groups. Defaults to 50.
+
+    Returns:
+        list: One dict per fingerprint with 'fingerprint', 'count', 'total_ms', 'max_ms',
+        'call_sites', 'endpoints' and the most recent 'example' entry (preferring one with a plan).
+    """
+
+    groups = {}
+    path = slow_query_log_path(app)
+    stem, extension = os.path.splitext(path)
+
+    lines = []
+    for name in [path] + sorted(glob.glob(f"{glob.escape(stem)}.[0-9]*{extension}")):
+        try:
+            with open(name) as f:
+                lines += f.readlines()
+        except FileNotFoundError:
+            pass
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+
+        group = groups.setdefault(entry['fingerprint'], {
+            'fingerprint': entry['fingerprint'], 'count': 0, 'total_ms': 0, 'max_ms': 0,
+            'call_sites': set(), 'endpoints': set(), 'example': entry
+        })
+        group['count'] += 1
+        group['total_ms'] += entry['duration_ms']
+        group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+        group['call_sites'].add(entry['call_site'] or 'unknown')
+        group['endpoints'].add(entry['endpoint'] or 'none')
+        if entry['plan'] or not group['example']['plan']:
+            group['example'] = entry
+
+    return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)[:limit]
@@ -0,0 +1,144 @@
+from app import create_app
+from models import db, User, Story, StoryStep, StoryCharacters, Choice, Genre, Character, UserGenre, StoryOpening
+from sqlalchemy import event
+from functools import lru_cache
+import pytest
+import shutil
+import os
+
+PASSWORD = 'Secret123!'
+
+def _greatest(*values):
+    return max(value for value in values if value is not None)
+
+@lru_cache
+def _password_hash():
+    # Hashing is deliberately slow, so every seeded user shares one hash.
+    return User.bcrypt.generate_password_hash(PASSWORD).decode('UTF-8')
+
+def _add_user(username, confirmed=True):
+    user = User(username=username, first_name=username.title(), last_name='Tester',
+                email=f'{username}@example.com', password=_password_hash(), email_confirmed=confirmed)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+@pytest.fixture
+def app(tmp_path, request):
+    """
+    An app on a fresh database, seeded by `seed`.
+
+    Runs against SQLite in a temporary directory, or against the database 'TEST_DATABASE_URL'
+    names, whose tables are dropped afterwards. TESTING is on, so views that run more SQL
+    statements than their '@query_budget' fail with a 500.
+
+    A test marked 'replica' also gets a read replica: a second SQLite file, copied from the
+    primary once it is seeded and never updated, so it lags behind every later write. A test
+    marked 'compressed' starts with 'STORY_COMPRESSION' on, so story text is seeded compressed.
+    """
+
+    replica = request.node.get_closest_marker('replica') is not None
+    if replica and os.getenv('TEST_DATABASE_URL'):
+        pytest.skip("The replica is a copy of an SQLite file.")
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': os.getenv('TEST_DATABASE_URL', f"sqlite:///{tmp_path / 'test.sqlite'}"),
+        'SQLALCHEMY_BINDS': {'replica_0': f"sqlite:///{tmp_path / 'replica.sqlite'}"} if replica else {},
+        'STORY_COMPRESSION': request.node.get_closest_marker('compressed') is not None,
+        'STORY_ZSTD_DICT_DIR': str(tmp_path / 'zstd-dicts'),
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SECRET_KEY': 'test',
+        'SECURITY_PASSWORD_SALT': 'test',
+        'MAIL_DEFAULT_SENDER': 'tester@example.com',
+        'LLM_BACKEND': 'fake',
+        'FAKE_LLM_TIME_SCALE': 0,
+        'LLM_USER_RPM': 1000,
+        'LLM_USER_TPM': 10 ** 9,
+        'OPENING_POOL_SIZE': 0,
+        'ADMIN_USERNAMES': ['tester'],
+        'READ_CACHE_DIR': str(tmp_path / 'read-cache'),
+        'IMAGE_STORE_DIR': str(tmp_path / 'images'),
+        'EXPORT_DIR': str(tmp_path / 'exports'),
+    })
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', lambda connection, record: connection.create_function('greatest', -1, _greatest))
+
+        db.create_all(bind_key=None)
+        app.seed = seed()
+
+        if replica:
+            db.session.remove()
+            shutil.copy(tmp_path / 'test.sqlite', tmp_path / 'replica.sqlite')
+
+        yield app
+
+        db.session.remove()
+        if db.engine.dialect.name != 'sqlite':
+            db.drop_all()
+
+def seed():
+    """
+    Add the rows the tests use, several of each so a query per item shows up in a view's
+    statement count: a confirmed admin 'tester' with three characters, counts for two of three
+    genres, and three stories of two steps each, the first with two characters and an alternate
+    opening. The first story's first step is continued by a second story, whose first step is
+    continued by a third, ending story. An unconfirmed user 'newbie' has nothing.
+
+    Returns:
+        dict: The IDs of the seeded rows: 'story', 'step', 'genre' and 'character' are the first of
+        each, 'middle' and 'end' the stories continuing the chain, and 'genres' and 'characters'
+        lists of all of them.
+    """
+
+    user = _add_user('tester')
+    newbie = _add_user('newbie', confirmed=False)
+
+    genres = [Genre(name=name) for name in ('Fantasy', 'Mystery', 'Horror')]
+    characters = [Character(name=name, description=description, user_id=user.id) for name, description in (
+        ('Ada', 'A curious inventor.'), ('Grace', 'A careful admiral.'), ('Alan', 'A patient codebreaker.'))]
+    db.session.add_all(genres + characters)
+    db.session.commit()
+    db.session.add_all([UserGenre(user_id=user.id, genre_id=genre.id, count=count)
+                        for genre, count in zip(genres, (3, 1))])
+
+    stories = [Story.create_story(title, f"Once upon a time, there was {thing}. " * 20, user.id)
+               for title, thing in (('The Door', 'a door'), ('The Lighthouse', 'a lighthouse'), ('The Letter', 'a letter'))]
+    steps = []
+    for story in stories:
+        steps += [StoryStep(content='Open the door.', story_id=story.id), StoryStep(content='Walk away.', story_id=story.id)]
+    db.session.add_all(steps + [StoryCharacters(story_id=stories[0].id, character_id=character.id)
+                                for character in characters[:2]])
+    db.session.commit()
+
+    middle = Story.create_story('The Door', 'Behind the door was a hall. ' * 20, user.id, chain_length=2)
+    middle_step = StoryStep(content='Cross the hall.', story_id=middle.id)
+    db.session.add_all([middle_step, StoryStep(content='Go back.', story_id=middle.id)])
+    db.session.commit()
+
+    end = Story.create_story('The Door', 'Across the hall was the end. ' * 20, user.id, end=True, chain_length=3)
+    opening = StoryOpening(genre_key=StoryOpening.key_for([genres[0].id]), title='Another Door',
+                           start_content='Once upon a time, there were two doors. ' * 20,
+                           choices=['Take the left one.', 'Take the right one.'], story_id=stories[0].id)
+    db.session.add_all([Choice(choice_text=steps[0].content, from_step_id=steps[0].id, to_story_id=middle.id),
+                        Choice(choice_text=middle_step.content, from_step_id=middle_step.id, to_story_id=end.id),
+                        opening])
+    db.session.commit()
+
+    return {'user': user.id, 'newbie': newbie.id, 'genre': genres[0].id, 'character': characters[0].id,
+            'story': stories[0].id, 'step': steps[0].id, 'middle': middle.id, 'end': end.id, 'opening': opening.id,
+            'genres': [genre.id for genre in genres], 'characters': [character.id for character in characters]}
+
+def log_in(client, username='tester'):
+    client.post('/user/login', data={'username': username, 'password': PASSWORD})
+    return client
+
+@pytest.fixture
+def client(app):
+    """
+    A test client logged in as 'tester'.
+    """
+
+    return log_in(app.test_client())
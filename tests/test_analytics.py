@@ -0,0 +1,48 @@
+from analytics import rebuild_tree
+from apicalls import save_story
+from models import db, Story, StoryStep, Choice, StoryNode, StoryTreeStats, StepPicks
+
+def continue_from(step, end=False, tokens=100):
+    choice = Choice(choice_text=step.content, from_step_id=step.id)
+    db.session.add(choice)
+    db.session.flush()
+
+    story = save_story('The Fork', 'The path went on. ' * (30 + step.id), [] if end else ['Left.', 'Right.'],
+                       step.story.author_id, end=end, choice_id=choice.id, tokens=tokens)
+    return story, db.session.scalars(db.select(StoryStep).filter_by(story_id=story.id).order_by(StoryStep.id)).all()
+
+def snapshot(root_id):
+    nodes = db.session.execute(
+        db.select(StoryNode.story_id, StoryNode.root_id, StoryNode.depth, StoryNode.words, StoryNode.tokens, StoryNode.children)
+        .where(StoryNode.root_id == root_id).order_by(StoryNode.story_id)
+    ).all()
+    stats = db.session.execute(
+        db.select(StoryTreeStats.nodes, StoryTreeStats.max_depth, StoryTreeStats.ended, StoryTreeStats.branching,
+                  StoryTreeStats.words, StoryTreeStats.tokens)
+        .where(StoryTreeStats.root_id == root_id)
+    ).one()
+    picks = db.session.execute(
+        db.select(StepPicks.step_id, StepPicks.root_id, StepPicks.picks).where(StepPicks.root_id == root_id).order_by(StepPicks.step_id)
+    ).all()
+
+    return nodes, stats, picks
+
+def test_recorded_increments_match_a_rebuild(app):
+    root = save_story('The Fork', 'The path split in two. ' * 30, ['Left.', 'Right.'], app.seed['user'], tokens=300)
+    left, right = db.session.scalars(db.select(StoryStep).filter_by(story_id=root.id).order_by(StoryStep.id)).all()
+
+    first, (first_left, first_right) = continue_from(left)
+    continue_from(left, end=True)
+    continue_from(right, tokens=50)
+    continue_from(first_left)
+    continue_from(first_left, end=True)
+    continue_from(first_right)
+
+    recorded = snapshot(root.id)
+    nodes, stats, picks = recorded
+    assert stats == (7, 2, 2, 2, sum(node.words for node in nodes), 850)
+    assert [(step_id, count) for step_id, _, count in picks] == [(left.id, 2), (right.id, 1), (first_left.id, 2), (first_right.id, 1)]
+
+    db.session.expire_all()
+    assert rebuild_tree(root.id) == 1
+    assert snapshot(root.id) == recorded
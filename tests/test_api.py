@@ -0,0 +1,92 @@
+from conftest import log_in
+from models import db, Story, GenerationRequest
+from flask import g
+
+def test_story_pages_follow_the_cursor_across_page_boundaries(app, client):
+    stories = db.session.scalars(db.select(Story.id).filter_by(author_id=app.seed['user']).order_by(Story.id.desc())).all()
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        page = client.get('/api/v1/stories', query_string={'limit': 2, **({'cursor': cursor} if cursor else {})}).json
+        seen += [story['id'] for story in page['data']]
+        pages += 1
+        cursor = page['next']
+        if cursor is None:
+            break
+
+    assert len(stories) == 5
+    assert (seen, pages) == (stories, 3)
+
+def test_a_story_added_between_pages_does_not_shift_the_next_page(app, client):
+    first = client.get('/api/v1/stories', query_string={'limit': 2}).json
+    newer = Story.create_story('The Postscript', 'There was one more thing. ' * 20, app.seed['user'])
+
+    second = client.get('/api/v1/stories', query_string={'limit': 2, 'cursor': first['next']}).json
+
+    assert newer.id not in [story['id'] for story in second['data']]
+    assert second['data'][0]['id'] < first['data'][-1]['id']
+
+def test_invalid_cursor_is_a_json_400(client):
+    response = client.get('/api/v1/stories', query_string={'cursor': 'not-a-cursor'})
+
+    assert (response.status_code, response.json) == (400, {'error': "Invalid cursor."})
+
+def test_fields_selects_the_columns_returned(app, client):
+    page = client.get('/api/v1/stories', query_string={'fields': 'title,word_count'}).json
+    assert all(set(story) == {'id', 'title', 'word_count'} for story in page['data'])
+
+    default = client.get('/api/v1/stories').json
+    assert 'start_content' not in default['data'][0]
+
+    story = client.get(f"/api/v1/stories/{app.seed['story']}", query_string={'fields': 'start_content'}).json
+    assert set(story['data']) == {'id', 'start_content'}
+
+    response = client.get('/api/v1/stories', query_string={'fields': 'title,password'})
+    assert response.status_code == 400
+    assert response.json['error'].startswith("Unknown fields: password.")
+
+def test_unchanged_resources_are_not_modified(app, client):
+    url = f"/api/v1/stories/{app.seed['story']}"
+    response = client.get(url)
+    etag = response.headers['ETag']
+
+    assert not etag.startswith('W/')
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    db.session.get(Story, app.seed['story']).title = 'The Open Door'
+    db.session.commit()
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['data']['title'] == 'The Open Door'
+
+def test_errors_are_json(app, client):
+    g.pop('_login_user', None)
+    response = app.test_client().get('/api/v1/stories')
+    assert (response.status_code, response.json) == (401, {'error': "Please log in."})
+
+    newbie = log_in(app.test_client(), 'newbie')
+    response = newbie.get('/api/v1/stories')
+    assert (response.status_code, response.json) == (403, {'error': "Please confirm your email address."})
+
+    client = log_in(client)
+    assert client.get('/api/v1/stories/0').json == {'error': "Not found."}
+
+def test_generations_are_listed_by_key_and_private_to_their_user(app, client):
+    mine = GenerationRequest(user_id=app.seed['user'], key='generate:abc', status='done', story_id=app.seed['story'])
+    pending = GenerationRequest(user_id=app.seed['user'], key='continue:def', status='pending')
+    theirs = GenerationRequest(user_id=app.seed['newbie'], key='generate:abc', status='pending')
+    db.session.add_all([mine, pending, theirs])
+    db.session.commit()
+
+    page = client.get('/api/v1/generations').json
+    assert [generation['id'] for generation in page['data']] == [pending.id, mine.id]
+
+    page = client.get('/api/v1/generations', query_string={'key': 'generate:abc'}).json
+    assert [(generation['status'], generation['story_id']) for generation in page['data']] == [('done', app.seed['story'])]
+
+    assert client.get(f"/api/v1/generations/{pending.id}").json['data']['status'] == 'pending'
+
+    response = client.get(f"/api/v1/generations/{theirs.id}")
+    assert response.status_code == 403
+    assert response.json == {'error': "You do not have permission to view this generation."}
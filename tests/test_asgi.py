@@ -0,0 +1,65 @@
+from models import db, StoryStep, GenerationRequest
+from urllib.parse import urlencode
+import asyncio
+import pytest
+import asgi
+
+@pytest.fixture
+def post(app, client, monkeypatch):
+    """
+    Post a form to the ASGI app's async views, logged in as 'tester', and return the response status.
+    """
+
+    monkeypatch.setattr(asgi, 'app', app)
+    cookie = client.get_cookie('session').value
+
+    def post(path, data):
+        body = urlencode(data, doseq=True).encode('ascii')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode('ascii'), 'query_string': b'',
+            'root_path': '', 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+            'headers': [(b'host', b'localhost'), (b'cookie', f'session={cookie}'.encode('latin1')),
+                        (b'content-type', b'application/x-www-form-urlencoded'),
+                        (b'content-length', str(len(body)).encode('ascii'))],
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        started = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                started.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+        return started[0]['status'], dict(started[0]['headers']).get(b'location', b'').decode('latin1')
+
+    return post
+
+def statuses():
+    return db.session.scalars(db.select(GenerationRequest.status)).all()
+
+def test_continuing_from_a_step_of_another_story_is_not_found(app, client, post):
+    other = StoryStep(content='Somewhere else.', story_id=app.seed['end'])
+    db.session.add(other)
+    db.session.commit()
+
+    for step_id in (other.id, 0):
+        status, location = post(f"/story/continue/{app.seed['story']}", {'step_id': step_id, 'idempotency_key': 'stray'})
+        assert status == 404
+        assert client.post(f"/story/continue/{app.seed['story']}", data={'step_id': step_id}).status_code == 404
+
+    assert statuses() == []
+
+def test_failure_before_the_completion_fails_the_key(app, post, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("The database is down.")
+
+    monkeypatch.setattr('models.UserGenre.increment_counts', fail)
+
+    status, location = post('/story/generate', {'genres': [app.seed['genre']], 'idempotency_key': 'broken'})
+
+    assert (status, location.endswith('/oops')) == (302, True)
+    assert statuses() == ['failed']
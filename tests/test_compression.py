@@ -0,0 +1,63 @@
+from compression import ZSTD_MAGIC
+from models import db, Story
+import pytest
+
+pytest.importorskip('zstandard')
+
+TEXT = 'Once upon a time, the text was stored. ' * 40
+
+def stored(story_id):
+    return db.session.execute(db.text("SELECT start_content FROM stories WHERE id = :id"), {'id': story_id}).scalar()
+
+def add_story(app, content=TEXT):
+    story = Story.create_story('The Archive', content, app.seed['user'])
+    db.session.expire(story)
+    return story.id
+
+def switch(app, enabled):
+    app.config['STORY_COMPRESSION'] = enabled
+    db.session.expire_all()
+
+@pytest.mark.compressed
+def test_round_trip_with_compression_turned_off(app):
+    compressed, short = add_story(app), add_story(app, 'Short.')
+
+    assert stored(compressed).startswith(ZSTD_MAGIC)
+    assert stored(short) == b'Short.'
+    assert db.session.get(Story, compressed).start_content == TEXT
+    assert db.session.get(Story, short).start_content == 'Short.'
+
+    switch(app, False)
+    plain = add_story(app)
+
+    assert stored(plain) == TEXT
+    assert db.session.get(Story, plain).start_content == TEXT
+    assert db.session.get(Story, compressed).start_content == TEXT
+
+def test_round_trip_with_compression_turned_on(app):
+    plain = add_story(app)
+    assert stored(plain) == TEXT
+
+    switch(app, True)
+    compressed = add_story(app)
+
+    assert stored(compressed).startswith(ZSTD_MAGIC)
+    assert db.session.get(Story, compressed).start_content == TEXT
+    assert db.session.get(Story, plain).start_content == TEXT
+
+def test_recompress_rewrites_rows_with_the_current_setting(app):
+    story_id = app.seed['story']
+    original = db.session.get(Story, story_id).start_content
+    assert stored(story_id) == original
+
+    switch(app, True)
+    result = app.test_cli_runner().invoke(args=['compression', 'recompress', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'stories.start_content' in result.output
+
+    assert stored(story_id).startswith(ZSTD_MAGIC)
+    assert db.session.get(Story, story_id).start_content == original
+
+    switch(app, False)
+    assert app.test_cli_runner().invoke(args=['compression', 'recompress']).exit_code == 0
+    assert stored(story_id) == original
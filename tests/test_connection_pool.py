@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Lock
+from models import db
+from scheduler import admit, acquire, release
+from sqlalchemy import event
+from test_singleflight import clients
+import fakellm
+import uuid
+
+def test_generations_hold_no_connections_while_waiting_on_the_model(app, client, monkeypatch):
+    count = 8
+    held, seen, lock = [0], [], Lock()
+
+    # Create the user's quota row and the scheduler's state up front, so the requests don't race
+    # to insert them and retry, which would cost statements the views' budgets don't allow for.
+    admit(app.seed['user'])
+    release(acquire(app.seed['user']))
+    db.session.remove()
+
+    def checkout(connection, record, proxy):
+        with lock:
+            held[0] += 1
+
+    def checkin(connection, record):
+        with lock:
+            held[0] -= 1
+
+    event.listen(db.engine, 'checkout', checkout)
+    event.listen(db.engine, 'checkin', checkin)
+
+    # Each fake completion waits until all of them are in flight, notes how many connections
+    # are checked out, and waits again so none finishes while the others are still looking.
+    barrier = Barrier(count, timeout=10)
+
+    def delay(model):
+        barrier.wait()
+        seen.append(held[0])
+        barrier.wait()
+        return 0
+
+    monkeypatch.setattr(fakellm, 'delay', delay)
+    ids = app.seed
+
+    def generate(other):
+        return other.post('/story/generate', data={'genres': [ids['genre']], 'characters': [ids['character']],
+                                                   'idempotency_key': uuid.uuid4().hex})
+
+    def continue_story(other):
+        return other.post(f"/story/continue/{ids['story']}",
+                          data={'step_id': ids['step'], 'idempotency_key': uuid.uuid4().hex})
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(send, other) for send, other in
+                   zip([generate, continue_story] * (count // 2), clients(app, client, count))]
+        responses = [future.result() for future in futures]
+
+    assert [response.status_code for response in responses] == [302] * count
+    assert not any(response.location.endswith('/oops') for response in responses)
+    assert seen == [0] * count
@@ -0,0 +1,33 @@
+import gzip
+
+def test_streamed_chains_are_compressed(app, client):
+    app.config['READ_CHAPTERS_PER_PAGE'] = 1
+    url = f"/story/read/{app.seed['end']}"
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.is_streamed
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert 'Once upon a time, there was a door.' in gzip.decompress(response.get_data()).decode('UTF-8')
+
+    response = client.get(url)
+    assert 'Content-Encoding' not in response.headers
+    assert 'Once upon a time, there was a door.' in response.get_data(as_text=True)
+
+def test_not_modified_keeps_the_etag_of_the_compressed_page(app, client):
+    url = f"/story/read/{app.seed['end']}"
+    # The first page after logging in shows the flashed welcome, and isn't cached.
+    client.get(url)
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag[2:]
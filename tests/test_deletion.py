@@ -0,0 +1,40 @@
+from conftest import PASSWORD, _add_user, log_in
+from pagecache import get_cached_chain
+from models import db, Story, StoryNode, StoryTreeStats
+from analytics import refresh
+
+def test_deleted_account_stories_leave_the_read_cache(app):
+    _add_user('reader')
+    end = app.seed['end']
+
+    # The app context outlives requests, so Flask-Login's cached user is whoever logged in last.
+    reader = log_in(app.test_client(), 'reader')
+    assert reader.get(f"/story/read/{end}").status_code == 200
+    assert get_cached_chain(end) is not None
+
+    log_in(app.test_client()).post('/user/edit', data={
+        'first_name': 'Tess', 'last_name': 'Tester', 'email': 'tester@example.com', 'image_url': '',
+        'password': PASSWORD, 'submit-btn': 'delete'})
+    assert get_cached_chain(end) is None
+
+    reader = log_in(app.test_client(), 'reader')
+    assert reader.get(f"/story/read/{end}").status_code == 404
+
+def test_deleting_a_story_cuts_its_continuations_off_the_chain(app, client):
+    story, middle, end = app.seed['story'], app.seed['middle'], app.seed['end']
+    refresh(backfill=True)
+
+    assert client.post(f"/story/delete/{middle}").status_code == 302
+    assert [s.id for s in Story.get_story_chain(end)] == [end]
+
+    response = log_in(client).get(f"/story/read/{end}")
+    assert response.status_code == 200
+    assert 'Across the hall' in response.get_data(as_text=True)
+    assert 'Behind the door' not in response.get_data(as_text=True)
+
+    refresh()
+    node = db.session.get(StoryNode, end)
+    assert (node.root_id, node.depth) == (end, 0)
+    assert db.session.get(Story, end).chain_length == 1
+    assert db.session.get(StoryTreeStats, story).nodes == 1
+    assert db.session.get(StoryTreeStats, end).nodes == 1
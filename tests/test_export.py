@@ -0,0 +1,77 @@
+from export import export_finished_stories, finished_chain_fingerprints, chain_fingerprint, build_epub, export_dir
+from models import db, Story
+from io import BytesIO
+import zipfile
+import json
+import os
+
+def export(monkeypatch, epub=False):
+    """
+    Run an export pass, and return its counts along with the IDs of the chains it loaded.
+    """
+
+    loaded = []
+    get_story_chain = Story.get_story_chain.__func__
+
+    def record(cls, id):
+        loaded.append(id)
+        return get_story_chain(cls, id)
+
+    monkeypatch.setattr(Story, 'get_story_chain', classmethod(record))
+    counts = export_finished_stories(epub=epub, workers=2)
+    monkeypatch.undo()
+
+    return counts, sorted(loaded)
+
+def test_only_changed_chains_are_loaded(app, monkeypatch):
+    end = app.seed['end']
+    single = Story.create_story('The Note', 'The note said goodbye. ' * 20, app.seed['user'], end=True).id
+
+    assert export(monkeypatch) == ((2, 0, 0), sorted([end, single]))
+    assert export(monkeypatch) == ((0, 2, 0), [])
+
+    db.session.get(Story, app.seed['middle']).title = 'The Hall'
+    db.session.commit()
+    assert export(monkeypatch) == ((1, 1, 0), [end])
+
+    with open(os.path.join(export_dir(), 'manifest.json')) as f:
+        assert list(json.load(f)) == [str(end), str(single)]
+
+def test_asking_for_epub_rebuilds_chains_exported_without(app, monkeypatch):
+    end = app.seed['end']
+    export(monkeypatch)
+
+    assert export(monkeypatch, epub=True) == ((1, 0, 0), [end])
+    assert os.listdir(os.path.join(export_dir(), 'stories', str(end))).count('index.html') == 1
+    assert any(name.endswith('.epub') for name in os.listdir(os.path.join(export_dir(), 'stories', str(end))))
+
+def test_deleted_chains_are_removed(app, monkeypatch):
+    end = app.seed['end']
+    export(monkeypatch)
+
+    db.session.get(Story, end).deleted_at = db.func.now()
+    db.session.commit()
+
+    assert export(monkeypatch) == ((0, 0, 1), [])
+    assert not os.path.exists(os.path.join(export_dir(), 'stories', str(end)))
+
+def test_fingerprints_match_the_loaded_chains(app):
+    end = app.seed['end']
+
+    assert finished_chain_fingerprints() == {end: chain_fingerprint(Story.get_story_chain(end))}
+
+def test_epub_has_a_chapter_per_story(app):
+    chain = Story.get_story_chain(app.seed['end'])
+    chain[0].title = 'Doors & <Halls>'
+
+    with zipfile.ZipFile(BytesIO(build_epub(chain))) as epub:
+        first = epub.infolist()[0]
+        assert (first.filename, first.compress_type) == ('mimetype', zipfile.ZIP_STORED)
+        assert epub.read('mimetype') == b'application/epub+zip'
+
+        chapters = sorted(name for name in epub.namelist() if name.startswith('OEBPS/chapter-'))
+        assert chapters == [f'OEBPS/chapter-{i}.xhtml' for i in (1, 2, 3)]
+        assert 'Across the hall' in epub.read('OEBPS/chapter-3.xhtml').decode('UTF-8')
+        assert 'Doors &amp; &lt;Halls&gt;' in epub.read('OEBPS/content.opf').decode('UTF-8')
+
+    db.session.rollback()
@@ -0,0 +1,78 @@
+from apicalls import complete, complete_async, continuation_messages
+from models import db, User, LLMTicket
+from flask_login import login_user
+from collections import deque
+from time import sleep
+import asyncio
+import llmrouter
+import fakellm
+import pytest
+
+@pytest.fixture
+def hedging(app, monkeypatch):
+    """
+    Hedge continuations after 50 ms: the primary model takes half a second and the backup model
+    answers at once, so the backup always wins and the primary keeps running after it lost.
+    """
+
+    app.config.update(LLM_HEDGE=True, LLM_HEDGE_MODELS={'gpt-3.5-turbo': 'gpt-4'})
+    monkeypatch.setattr(llmrouter, 'latencies', {'gpt-3.5-turbo': deque([0.05] * llmrouter.MIN_SAMPLES)})
+    monkeypatch.setattr(fakellm, 'delay', lambda model: 0.5 if model == 'gpt-3.5-turbo' else 0)
+    fakellm.calls.clear()
+    app.charged = []
+    charge = llmrouter.charge
+
+    def recording_charge(user_id, tokens):
+        app.charged.append(tokens)
+        charge(user_id, tokens)
+
+    monkeypatch.setattr(llmrouter, 'charge', recording_charge)
+
+    with app.test_request_context():
+        login_user(db.session.get(User, app.seed['user']))
+        yield app
+
+def run_continuation():
+    complete('continuation', continuation_messages('Once upon a time.', 'Open the door.'))
+
+def eventually(check, timeout=5):
+    # The losing sync call finishes, frees its slot and is charged on the hedging pool.
+    for _ in range(int(timeout / 0.05)):
+        db.session.rollback()
+        if check():
+            return True
+        sleep(0.05)
+
+    return check()
+
+def test_both_hedged_calls_hold_a_slot_and_are_charged(hedging):
+    run_continuation()
+
+    assert eventually(lambda: len(fakellm.calls) == 2)
+    assert [call['model'] for call in fakellm.calls] == ['gpt-4', 'gpt-3.5-turbo']
+
+    used = [call['prompt_tokens'] + call['completion_tokens'] for call in fakellm.calls]
+    assert eventually(lambda: sorted(hedging.charged) == sorted(used))
+    assert db.session.scalar(db.select(db.func.count(LLMTicket.id))) == 0
+
+def test_no_backup_without_a_free_slot(hedging):
+    hedging.config['LLM_MAX_CONCURRENCY'] = 1
+    skipped = llmrouter.hedge_count('continuation', 'skipped')
+
+    run_continuation()
+
+    assert eventually(lambda: db.session.scalar(db.select(db.func.count(LLMTicket.id))) == 0)
+    assert [call['model'] for call in fakellm.calls] == ['gpt-3.5-turbo']
+    assert llmrouter.hedge_count('continuation', 'skipped') == skipped + 1
+
+def test_cancelled_backup_frees_its_slot_before_the_winner_returns(hedging, monkeypatch):
+    hedging.config['LLM_HEDGE_MODELS'] = {'gpt-3.5-turbo': 'gpt-3.5-turbo-16k'}
+    monkeypatch.setattr(fakellm, 'delay', lambda model: 0.5 if model == 'gpt-3.5-turbo-16k' else 0.1)
+    won = llmrouter.hedge_count('continuation', 'primary')
+
+    async def run():
+        await complete_async('continuation', continuation_messages('Once upon a time.', 'Open the door.'))
+        return db.session.scalar(db.select(db.func.count(LLMTicket.id)))
+
+    assert asyncio.run(run()) == 0
+    assert llmrouter.hedge_count('continuation', 'primary') == won + 1
@@ -0,0 +1,98 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from media import ingest, fetch, store_dir, ImageRejected, MEDIA_PREFIX
+from models import db, Story
+from PIL import Image
+from io import BytesIO
+import threading
+import requests
+import socket
+import pytest
+import os
+
+def png(width=800, height=600):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def image_server(app):
+    """
+    A local HTTP server answering every GET with the same PNG, standing in for an image host.
+    """
+
+    data = png()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.config['IMAGE_FETCH_ALLOW_PRIVATE'] = True
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+    server.server_close()
+
+def test_edited_story_cover_is_brought_into_the_store(app, client, image_server):
+    url = f"{image_server}/cover.png"
+
+    response = client.post(f"/story/edit/{app.seed['story']}", data={'title': 'The Door', 'img_url': url})
+    assert response.status_code == 302
+    assert db.session.get(Story, app.seed['story']).img_url == url
+
+    assert ingest(workers=1) == {'done': 1}
+
+    img_url = db.session.get(Story, app.seed['story']).img_url
+    assert img_url.startswith(MEDIA_PREFIX) and img_url.endswith('.png')
+
+    stem = img_url[len(MEDIA_PREFIX):].rsplit('.', 1)[0]
+    assert os.path.exists(os.path.join(store_dir(), f"{stem}.json"))
+    assert any(name.startswith(f"{stem}-") for name in os.listdir(store_dir()))
+
+@pytest.fixture
+def resolver(monkeypatch):
+    """
+    Resolve 'images.test' to each address in turn, as a rebinding DNS server would.
+    """
+
+    resolve = socket.getaddrinfo
+    answers = []
+
+    def getaddrinfo(host, *args, **kwargs):
+        if host == 'images.test':
+            host = answers.pop(0) if len(answers) > 1 else answers[0]
+        return resolve(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    return answers
+
+def test_private_hosts_are_refused(app, resolver):
+    resolver.append('127.0.0.1')
+
+    with pytest.raises(ImageRejected):
+        fetch('http://images.test/cover.png')
+
+def test_fetch_connects_to_the_address_it_checked(app, image_server, resolver):
+    # The name passes the check as a public address, then rebinds to the local image server.
+    resolver.extend(['93.184.216.34', '127.0.0.1'])
+    app.config.update(IMAGE_FETCH_ALLOW_PRIVATE=False, IMAGE_FETCH_TIMEOUT=0.5)
+    port = image_server.rsplit(':', 1)[1]
+
+    with pytest.raises(requests.RequestException):
+        fetch(f"http://images.test:{port}/cover.png")
+
+def test_fetch_from_a_named_host(app, image_server, resolver):
+    # Nothing listens on 127.0.0.2, so resolving the name again would fail the fetch.
+    resolver.extend(['127.0.0.1', '127.0.0.2'])
+    port = image_server.rsplit(':', 1)[1]
+
+    assert fetch(f"http://images.test:{port}/cover.png") == png()
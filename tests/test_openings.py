@@ -0,0 +1,38 @@
+from openings import claim_opening
+from models import db, Story, StoryStep, StoryOpening
+import pytest
+
+@pytest.fixture
+def opening(app):
+    app.config['OPENING_POOL_SIZE'] = 10
+    opening = StoryOpening(genre_key=StoryOpening.key_for([app.seed['genre']]), title='A Pooled Door',
+                           start_content='Once upon a time, a door waited. ' * 20,
+                           choices=['Knock.', 'Wait.'])
+    db.session.add(opening)
+    db.session.commit()
+
+    return opening.id
+
+def count(model):
+    return db.session.scalar(db.select(db.func.count(model.id)))
+
+def test_claimed_opening_becomes_a_story_with_its_steps(app, opening):
+    story = claim_opening([app.seed['genre']], app.seed['user'])
+
+    assert story.title == 'A Pooled Door'
+    assert [step.content for step in story.story_steps] == ['Knock.', 'Wait.']
+    assert db.session.get(StoryOpening, opening) is None
+
+def test_failed_claim_leaves_no_story_behind(app, opening, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("The analytics are down.")
+
+    monkeypatch.setattr('apicalls.record_story', fail)
+    stories, steps = count(Story), count(StoryStep)
+
+    with pytest.raises(RuntimeError):
+        claim_opening([app.seed['genre']], app.seed['user'])
+    db.session.rollback()
+
+    assert (count(Story), count(StoryStep)) == (stories, steps)
+    assert db.session.get(StoryOpening, opening) is not None
@@ -0,0 +1,83 @@
+from querybudget import budgets
+from utils import generate_confirmation_token
+from conftest import PASSWORD, log_in
+import pytest
+
+def token(app, email):
+    return generate_confirmation_token(app, email)
+
+# One request per budgeted view, taking its costliest path. Each returns (response, expected status).
+CASES = {
+    'unhandled_exception': lambda app, client, ids: (client.get('/oops'), 200),
+    'homepage': lambda app, client, ids: (client.get('/'), 200),
+    'signup': lambda app, client, ids: (app.test_client().post('/user/signup', data={
+        'username': 'someone', 'first_name': 'Some', 'last_name': 'One', 'email': 'someone@example.com',
+        'password': PASSWORD, 'confirm': PASSWORD, 'image_url': ''}), 302),
+    'login': lambda app, client, ids: (app.test_client().post('/user/login', data={
+        'username': 'tester', 'password': PASSWORD}), 302),
+    'unconfirmed': lambda app, client, ids: (log_in(app.test_client(), 'newbie').post('/user/confirm'), 302),
+    'confirm_email': lambda app, client, ids: (app.test_client().get(f"/user/confirm/{token(app, 'newbie@example.com')}"), 302),
+    'thanks': lambda app, client, ids: (client.get('/user/info'), 200),
+    'logout': lambda app, client, ids: (client.get('/user/logout'), 302),
+    'password_email': lambda app, client, ids: (app.test_client().post('/user/password', data={
+        'email': 'tester@example.com'}), 302),
+    'password_reset': lambda app, client, ids: (app.test_client().post(
+        f"/user/password/{token(app, 'tester@example.com')}", data={'password': 'Another123!', 'confirm': 'Another123!'}), 302),
+    'show_user': lambda app, client, ids: (client.get(f"/user/{ids['user']}"), 200),
+    'edit_user': lambda app, client, ids: (client.post('/user/edit', data={
+        'first_name': 'Tess', 'last_name': 'Tester', 'email': 'tester@example.com', 'image_url': '',
+        'password': PASSWORD, 'submit-btn': 'update'}), 302),
+    'export_library': lambda app, client, ids: (client.get('/user/library.jsonl.gz'), 200),
+    'add_character': lambda app, client, ids: (client.post('/character/add', data={
+        'name': 'Grace', 'description': 'A careful admiral.', 'img_url': ''}), 302),
+    'show_characters': lambda app, client, ids: (client.get('/character/index'), 200),
+    'edit_character': lambda app, client, ids: (client.post(f"/character/edit/{ids['character']}", data={
+        'name': 'Ada', 'description': 'A very curious inventor.', 'img_url': ''}), 302),
+    'delete_character': lambda app, client, ids: (client.post(f"/character/delete/{ids['character']}"), 302),
+    'show_stories': lambda app, client, ids: (client.get('/story/index'), 200),
+    'edit_story': lambda app, client, ids: (client.post(f"/story/edit/{ids['story']}", data={
+        'title': 'The Other Door', 'img_url': ''}), 302),
+    'delete_story': lambda app, client, ids: (client.post(f"/story/delete/{ids['story']}"), 302),
+    'generate_story': lambda app, client, ids: (client.post('/story/generate', data={
+        'genres': ids['genres'], 'characters': ids['characters']}), 302),
+    'show_story': lambda app, client, ids: (client.get(f"/story/view/{ids['story']}"), 302),
+    'continue_story': lambda app, client, ids: (client.post(f"/story/continue/{ids['story']}", data={
+        'step_id': ids['step']}), 302),
+    'use_alternate': lambda app, client, ids: (client.post(f"/story/{ids['story']}/alternate/{ids['opening']}"), 302),
+    'read_story': lambda app, client, ids: (client.get(f"/story/read/{ids['end']}"), 200),
+    'read_chapters': lambda app, client, ids: (client.get(f"/story/read/{ids['end']}/chapters?before=1"), 200),
+    'show_analytics': lambda app, client, ids: (client.get('/admin/analytics'), 200),
+    'show_slow_queries': lambda app, client, ids: (client.get('/admin/slow-queries'), 200),
+}
+
+def check(response, status):
+    assert response.status_code == status, response.get_data(as_text=True)[:500]
+    assert not (response.location or '').endswith('/oops')
+
+def test_every_budget_is_exercised():
+    assert set(CASES) == set(budgets)
+
+@pytest.mark.parametrize('endpoint', sorted(CASES))
+def test_view_stays_within_budget(app, client, endpoint):
+    response, status = CASES[endpoint](app, client, app.seed)
+    response.get_data()
+
+    check(response, status)
+
+def test_deleting_account_stays_within_budget(app, client):
+    response = client.post('/user/edit', data={
+        'first_name': 'Tess', 'last_name': 'Tester', 'email': 'tester@example.com', 'image_url': '',
+        'password': PASSWORD, 'submit-btn': 'delete'})
+
+    check(response, 302)
+
+def test_cached_read_stays_within_budget(app, client):
+    client.get(f"/story/read/{app.seed['end']}")
+    response = client.get(f"/story/read/{app.seed['end']}")
+
+    check(response, 200)
+
+def test_generating_from_the_pool_stays_within_budget(app, client):
+    response = client.post('/story/generate', data={'genres': [app.seed['genre']]})
+
+    check(response, 302)
@@ -0,0 +1,39 @@
+from models import db, Story, GenerationRequest
+from replicas import wrote_recently
+import pytest
+
+pytestmark = pytest.mark.replica
+
+def add_story(app, title):
+    # Written outside any request, so no user's reads are pinned to the primary by it.
+    story = Story.create_story(title, f"Once upon a time, {title.lower()} appeared. " * 20, app.seed['user'])
+    return story.id
+
+def forget_writes(client):
+    with client.session_transaction() as client_session:
+        client_session.pop('db_last_write', None)
+
+def test_read_only_views_read_from_the_replica(app, client):
+    add_story(app, 'The Newcomer')
+    forget_writes(client)
+
+    assert 'The Newcomer' not in client.get('/story/index').get_data(as_text=True)
+
+def test_core_statements_pin_reads_to_the_primary(app):
+    with app.test_request_context():
+        db.session.execute(db.update(Story).where(Story.id == app.seed['story']).values(title='The Renamed Door'))
+        db.session.commit()
+
+        assert wrote_recently()
+
+def test_waiting_for_a_duplicate_pins_reads_to_the_primary(app, client):
+    story_id = add_story(app, 'The Newcomer')
+    db.session.add(GenerationRequest(user_id=app.seed['user'], key='continue:seen', status='done', story_id=story_id))
+    db.session.commit()
+    forget_writes(client)
+
+    response = client.post(f"/story/continue/{app.seed['story']}",
+                           data={'step_id': app.seed['step'], 'idempotency_key': 'seen'})
+
+    assert response.location.endswith(f"/user/{app.seed['user']}")
+    assert 'The Newcomer' in client.get('/story/index').get_data(as_text=True)
@@ -0,0 +1,105 @@
+from scheduler import admit, charge, enqueue, grant, try_acquire, acquire, release, QuotaExceeded
+from models import db, LLMQuota, LLMTicket
+from datetime import timedelta
+import scheduler
+import pytest
+
+def age_quota(user_id, seconds):
+    quota = db.session.get(LLMQuota, user_id)
+    quota.updated_at -= timedelta(seconds=seconds)
+    db.session.commit()
+
+def test_admit_stops_at_the_request_quota(app):
+    app.config['LLM_USER_RPM'] = 2
+    user = app.seed['user']
+
+    admit(user)
+    admit(user)
+    with pytest.raises(QuotaExceeded) as exceeded:
+        admit(user)
+
+    assert 29 < exceeded.value.retry_after <= 30
+
+def test_request_quota_refills_over_time(app):
+    app.config['LLM_USER_RPM'] = 2
+    user = app.seed['user']
+
+    admit(user)
+    admit(user)
+    age_quota(user, 30)
+
+    admit(user)
+    with pytest.raises(QuotaExceeded):
+        admit(user)
+
+def test_overdrawn_tokens_hold_generations_back_until_refilled(app):
+    app.config['LLM_USER_TPM'] = 6000
+    user = app.seed['user']
+
+    admit(user)
+    charge(user, 9000)
+    with pytest.raises(QuotaExceeded) as exceeded:
+        admit(user)
+    assert 29 < exceeded.value.retry_after <= 30
+
+    age_quota(user, 31)
+    admit(user)
+
+def granted_order(tickets):
+    # Free the one slot again and again, noting whose ticket each grant goes to.
+    order = []
+    for _ in tickets:
+        grant()
+        running = db.session.scalar(db.select(LLMTicket.id).where(LLMTicket.running))
+        order.append(tickets[running])
+        release(running)
+
+    return order
+
+def test_queue_alternates_between_users(app):
+    app.config['LLM_MAX_CONCURRENCY'] = 1
+    busy, other = app.seed['user'], app.seed['newbie']
+    holder = try_acquire(None)
+
+    tickets = {enqueue(busy, 1): 'busy' for _ in range(3)}
+    tickets[enqueue(other, 1)] = 'other'
+    release(holder)
+
+    assert granted_order(tickets) == ['busy', 'other', 'busy', 'busy']
+
+def test_weight_buys_a_larger_share(app):
+    app.config['LLM_MAX_CONCURRENCY'] = 1
+    light, heavy = app.seed['user'], app.seed['newbie']
+    holder = try_acquire(None)
+
+    tickets = {}
+    for _ in range(2):
+        tickets[enqueue(light, 1)] = 'light'
+        tickets[enqueue(heavy, 2)] = 'heavy'
+    release(holder)
+
+    assert granted_order(tickets) == ['heavy', 'light', 'heavy', 'light']
+
+def test_only_the_lock_holder_grants_slots(app, monkeypatch):
+    ticket = enqueue(app.seed['user'], 1)
+    monkeypatch.setattr(scheduler, '_grant_lock', lambda: False)
+
+    grant()
+    assert try_acquire(app.seed['user']) is None
+    assert db.session.get(LLMTicket, ticket).running is False
+
+    monkeypatch.undo()
+    grant()
+    db.session.expire_all()
+    assert db.session.get(LLMTicket, ticket).running is True
+
+def test_acquire_takes_a_free_slot_without_queueing(app, monkeypatch):
+    def enqueue(user_id, weight):
+        raise AssertionError("Queued with a slot free.")
+
+    monkeypatch.setattr(scheduler, 'enqueue', enqueue)
+    ticket = acquire(app.seed['user'])
+
+    assert db.session.get(LLMTicket, ticket).running is True
+    release(ticket)
+    assert db.session.scalar(db.select(db.func.count(LLMTicket.id))) == 0
@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from models import db, Genre, Story, GenerationRequest
+from scheduler import QuotaExceeded
+from time import sleep
+import fakellm
+
+def clients(app, client, count):
+    # Share the logged-in session instead of logging in (and hashing a password) per client.
+    cookie = client.get_cookie('session').value
+    others = [app.test_client() for _ in range(count)]
+    for other in others:
+        other.set_cookie('session', cookie)
+
+    return others
+
+def post_at_once(clients, url, data):
+    barrier = Barrier(len(clients))
+
+    def post(client):
+        barrier.wait()
+        return client.post(url, data=data)
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        return list(executor.map(post, clients))
+
+def flashes(client):
+    with client.session_transaction() as session:
+        return [message for category, message in session.get('_flashes', [])]
+
+def test_duplicate_posts_make_one_upstream_call(app, client):
+    app.config['FAKE_LLM_TIME_SCALE'] = 0.05
+    fakellm.calls.clear()
+    stories = db.session.scalar(db.select(db.func.count(Story.id)))
+
+    responses = post_at_once(clients(app, client, 20), f"/story/continue/{app.seed['story']}",
+                             {'step_id': app.seed['step'], 'idempotency_key': 'double-click'})
+
+    assert [response.status_code for response in responses] == [302] * 20
+    assert all(response.location.endswith(f"/user/{app.seed['user']}") for response in responses)
+    assert len(fakellm.calls) == 1
+    assert db.session.scalar(db.select(db.func.count(Story.id))) == stories + 1
+
+def test_waiters_are_told_when_the_generation_failed(app, client, monkeypatch):
+    def failing_next_step(id, choice):
+        sleep(0.5)
+        raise RuntimeError("The model is down.")
+
+    monkeypatch.setattr('app.next_step', failing_next_step)
+    leader, waiter = clients(app, client, 2)
+    url, data = f"/story/continue/{app.seed['story']}", {'step_id': app.seed['step'], 'idempotency_key': 'retry'}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = executor.submit(leader.post, url, data=data)
+        sleep(0.1)
+        second = waiter.post(url, data=data)
+
+    assert first.result().location.endswith('/oops')
+    assert second.location.endswith(f"/user/{app.seed['user']}")
+    assert "Your story could not be written. Please try again." in flashes(waiter)
+
+def test_polling_leaves_the_session_alone(app):
+    genre = Genre(name='Mystery')
+    db.session.add(genre)
+
+    assert GenerationRequest.status_of(app.seed['user'], 'continue:missing') == (None, None)
+    assert genre in db.session.new
+
+def test_a_generation_held_back_by_its_quota_is_taken_over(app, client, monkeypatch):
+    from scheduler import admit
+    admitted = []
+
+    def admit_second(user_id):
+        admitted.append(user_id)
+        if len(admitted) == 1:
+            sleep(0.5)
+            raise QuotaExceeded(5)
+        admit(user_id)
+
+    monkeypatch.setattr('app.admit', admit_second)
+    stories = db.session.scalar(db.select(db.func.count(Story.id)))
+    leader, waiter = clients(app, client, 2)
+    url, data = f"/story/continue/{app.seed['story']}", {'step_id': app.seed['step'], 'idempotency_key': 'queued'}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = executor.submit(leader.post, url, data=data)
+        sleep(0.1)
+        second = waiter.post(url, data=data)
+
+    assert first.result().status_code == 429
+    assert second.location.endswith(f"/user/{app.seed['user']}")
+    assert "Your story could not be written. Please try again." not in flashes(waiter)
+    assert db.session.scalar(db.select(db.func.count(Story.id))) == stories + 1
+    assert db.session.scalars(db.select(GenerationRequest.status)).all() == ['done']
+
+def test_a_resubmitted_queued_form_is_queued_again(app, client):
+    app.config['LLM_USER_RPM'] = 1
+    url, data = f"/story/continue/{app.seed['story']}", {'step_id': app.seed['step'], 'idempotency_key': 'resubmitted'}
+
+    assert client.post(url, data=data).status_code == 302
+    data['idempotency_key'] = 'over-quota'
+    assert [client.post(url, data=data).status_code for _ in range(2)] == [429, 429]
+    assert db.session.scalars(db.select(GenerationRequest.status)).all() == ['done']
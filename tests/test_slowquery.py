@@ -0,0 +1,34 @@
+from slowquery import ProcessFileHandler, process_log_path, summarize
+import logging
+import json
+import os
+
+def entry(fingerprint, duration_ms):
+    return json.dumps({'fingerprint': fingerprint, 'duration_ms': duration_ms, 'call_site': None,
+                       'endpoint': 'read_story', 'plan': None})
+
+def log(handler, message):
+    handler.handle(logging.LogRecord('slowquery', logging.INFO, __file__, 0, message, None, None))
+
+def test_each_worker_writes_its_own_file(app, tmp_path, monkeypatch):
+    path = str(tmp_path / 'slow-queries.jsonl')
+    app.config['SLOW_QUERY_LOG'] = path
+    handler = ProcessFileHandler(path, maxBytes=200, backupCount=1)
+
+    # The handler is created before forking, as in a preloading gunicorn master.
+    for pid in (101, 102):
+        monkeypatch.setattr(os, 'getpid', lambda: pid)
+        for _ in range(3):
+            log(handler, entry('select ?', 10))
+    handler.close()
+
+    assert os.path.exists(process_log_path(path, 101)) and os.path.exists(process_log_path(path, 102))
+    assert not os.path.exists(path)
+    # Each worker rotated its own file at 200 bytes, leaving the other's alone.
+    assert os.path.exists(process_log_path(path, 101) + '.1') and os.path.exists(process_log_path(path, 102) + '.1')
+
+    with open(path, 'w') as f:
+        f.write(entry('select ?', 5) + '\n')
+
+    [group] = summarize(app)
+    assert (group['fingerprint'], group['count'], group['total_ms']) == ('select ?', 3, 25)
@@ -0,0 +1,104 @@
+from apicalls import complete, parse_tagged, story_messages, continuation_messages, MalformedCompletion
+from models import db, User
+from flask_login import login_user
+import fakellm
+import pytest
+import json
+
+STORY = 'Once upon a time, the model answered. ' * 20
+
+def called(arguments):
+    return {'role': 'assistant', 'content': None,
+            'function_call': {'name': 'write_story', 'arguments': arguments if isinstance(arguments, str) else json.dumps(arguments)}}
+
+def said(content):
+    return {'role': 'assistant', 'content': content}
+
+@pytest.fixture
+def model(app, monkeypatch):
+    """
+    Answer completions with the scripted messages in `model.replies`, one reply per request,
+    and record each request's keyword arguments in `model.requests`.
+    """
+
+    monkeypatch.setattr(fakellm, 'delay', lambda model: 0)
+
+    class Model:
+        replies = []
+        requests = []
+
+    def answer(model, messages, **kwargs):
+        Model.requests.append({'messages': messages, **kwargs})
+        message = Model.replies.pop(0)
+        return {'model': model, 'choices': [{'index': 0, 'message': message}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 10}}
+
+    monkeypatch.setattr(fakellm, 'answer', answer)
+
+    with app.test_request_context():
+        login_user(db.session.get(User, app.seed['user']))
+        yield Model
+
+def test_valid_answer_needs_one_request(model):
+    model.replies.append(called({'title': 'The Door', 'start_content': STORY, 'choices': ['Open it.', 'Knock.', 'Leave.']}))
+
+    [part] = complete('opening', story_messages(['Fantasy'], []))
+
+    assert (part['title'], part['choices'], part['end']) == ('The Door', ['Open it.', 'Knock.'], False)
+    assert len(model.requests) == 1
+
+def test_missing_title_is_asked_for_alone(model):
+    model.replies += [called({'start_content': STORY, 'choices': ['Open it.', 'Knock.']}),
+                      called({'title': 'The Door'})]
+
+    [part] = complete('opening', story_messages(['Fantasy'], []))
+
+    assert (part['title'], part['start_content'], part['choices']) == ('The Door', STORY.strip(), ['Open it.', 'Knock.'])
+    repair = model.requests[1]
+    assert repair['function_call'] == {'name': 'complete_story'}
+    assert repair['functions'][0]['parameters']['required'] == ['title']
+
+def test_too_few_choices_are_topped_up(model):
+    model.replies += [called({'start_content': STORY, 'end': False, 'choices': ['Open it.']}),
+                      called({'choices': ['Knock.']})]
+
+    [part] = complete('continuation', continuation_messages('Once upon a time.', 'Walk on.'))
+
+    assert part['choices'] == ['Open it.', 'Knock.']
+    assert model.requests[1]['functions'][0]['parameters']['required'] == ['choices']
+    assert '1 short choice(s)' in model.requests[1]['messages'][-1]['content']
+
+def test_failed_repair_raises(model):
+    model.replies += [called({'start_content': STORY, 'end': False, 'choices': []}),
+                      called({'choices': ['Knock.']})]
+
+    with pytest.raises(MalformedCompletion):
+        complete('continuation', continuation_messages('Once upon a time.', 'Walk on.'))
+
+def test_unparseable_arguments_are_regenerated_once(model):
+    model.replies += [called('{"start_content": "Once upon'),
+                      called({'start_content': STORY, 'end': True, 'choices': ['Ignored.']})]
+
+    [part] = complete('continuation', continuation_messages('Once upon a time.', 'Walk on.'))
+
+    assert (part['end'], part['choices']) == (True, [])
+    assert model.requests[1]['function_call'] == {'name': 'continue_story'}
+
+    model.replies += [called('not json'), called('still not json')]
+    with pytest.raises(MalformedCompletion):
+        complete('continuation', continuation_messages('Once upon a time.', 'Walk on.'))
+
+def test_tagged_text_answers_are_parsed(model):
+    model.replies.append(said(f"[title]The Door[start_content]{STORY}[choice_text]Open it.[choice_text]Knock."))
+
+    [part] = complete('opening', story_messages(['Fantasy'], []))
+
+    assert (part['title'], part['choices']) == ('The Door', ['Open it.', 'Knock.'])
+    assert len(model.requests) == 1
+
+def test_parse_tagged_salvages_what_it_finds():
+    assert parse_tagged("[title]A[start_content]B[choice_text]C[choice_text]D") == \
+        {'title': 'A', 'start_content': 'B', 'choices': ['C', 'D'], 'end': False}
+    assert parse_tagged("[end_content]The end.") == {'start_content': 'The end.', 'choices': [], 'end': True}
+    assert parse_tagged("Just a story.[choice_text]Go.") == {'start_content': 'Just a story.', 'choices': ['Go.'], 'end': False}
+    assert parse_tagged("[title]Only a title") == {'title': 'Only a title', 'choices': [], 'end': False}
@@ -1,8 +1,7 @@
 from functools import wraps
-from flask import flash, redirect, url_for, render_template
+from flask import flash, redirect, url_for, render_template, current_app, abort
 from flask_login import current_user
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired
-from flask_mail import Message
 
 def email_confirmed_required(f):
     @wraps(f)
@@ -30,6 +29,29 @@ def email_confirmed_required(f):
     
     return decorated_function
 
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        """
+        Decorator to restrict a view to administrators.
+
+        Administrators are the users whose usernames are listed in the 'ADMIN_USERNAMES' config value.
+        Anyone else gets a 404, so the admin pages don't reveal that they exist.
+
+        Args:
+            f (function): The function to be decorated.
+
+        Returns:
+            function: The decorated function.
+        """
+
+        if not current_user.is_authenticated or current_user.username not in current_app.config.get('ADMIN_USERNAMES', []):
+            abort(404)
+
+        return f(*args, **kwargs)
+
+    return decorated_function
+
 def send_confirmation_email(mail, app, email):
     """
     Send a confirmation email to a user.
@@ -47,6 +69,8 @@ def send_confirmation_email(mail, app, email):
     confirm_url = url_for('confirm_email', token=token, _external=True)
     html = render_template('/users/activate.html', confirm_url=confirm_url)
     subject = "Please confirm your email"
+
+    from flask_mail import Message
     msg = Message(subject, recipients=[email], html=html)
     mail.send(msg)
 
@@ -67,6 +91,8 @@ def send_reset_email(mail, app, email):
     reset_url = url_for('password_reset', token=token, _external=True)
     html = render_template('/users/activate.html', reset_url=reset_url)
     subject = "A password reset was requested."
+
+    from flask_mail import Message
     msg = Message(subject, recipients=[email], html=html)
     mail.send(msg)
 